@@ -63,7 +63,7 @@ from lib.gcloud import (
     get_storage_bucket,
     start_instance_from_image,
 )
-from lib.io import export_csv, gzip_file, temporary_directory
+from lib.io import gzip_file, temporary_directory
 from lib.memory_efficient import table_read_column
 from lib.net import download
 from lib.pipeline import DataPipeline
@@ -75,8 +75,7 @@ from lib.publish import (
     merge_location_breakout_tables,
     merge_output_tables,
     publish_global_tables,
-    publish_location_breakouts,
-    publish_location_aggregates,
+    publish_location_aggregates_from_tables,
     publish_subset_latest,
 )
 
@@ -280,12 +279,20 @@ def cache_pull() -> Response:
 
 
 @profiled_route("/update_table")
-def update_table(table_name: str = None, job_group: str = None, parallel_jobs: int = 8) -> Response:
+def update_table(
+    table_name: str = None,
+    job_group: str = None,
+    parallel_jobs: int = 8,
+    incremental: str = "false",
+) -> Response:
     table_name = _get_request_param("table", table_name)
     job_group = _get_request_param("job_group", job_group) or "default"
     process_count = _get_request_param("parallel_jobs", str(parallel_jobs))
     # Default to 1 if invalid process count is given
     process_count = safe_int_cast(process_count) or 1
+    # Skipping data sources with unchanged inputs must be explicitly requested
+    incremental_param = _get_request_param("incremental", incremental).lower()
+    incremental = BOOL_STRING_MAP.get(incremental_param, False)
 
     # Early exit: table name not found
     if table_name not in list(get_table_names()):
@@ -319,10 +326,28 @@ def update_table(table_name: str = None, job_group: str = None, parallel_jobs: i
         # When running the data pipeline, use as many parallel processes as allowed and avoid
         # downloading files multiple times.
         run_options = dict(process_count=process_count, skip_existing=True)
+        intermediate_folder = workdir / "intermediate"
+
+        # Download the previous intermediate files and the manifests of the inputs used to
+        # produce them, so data sources whose inputs have not changed are not run again
+        if incremental:
+            intermediate_file_names = []
+            for data_source in data_pipeline.data_sources:
+                file_name = data_source.uuid(data_pipeline.table)
+                intermediate_file_names += [f"{file_name}.csv", f"{file_name}.manifest.json"]
+            download_folder(
+                GCS_BUCKET_TEST,
+                "intermediate",
+                intermediate_folder,
+                lambda x: x.name in intermediate_file_names,
+            )
+            run_options["intermediate_folder"] = intermediate_folder
 
-        # Produce the intermediate files from the data source
+        # Produce the intermediate files from the data sources, or only from those whose inputs
+        # have changed when running incrementally
         intermediate_results = data_pipeline.parse(workdir, **run_options)
-        data_pipeline._save_intermediate_results(workdir / "intermediate", intermediate_results)
+        report = data_pipeline._save_intermediate_results(intermediate_folder, intermediate_results)
+        logger.log_info(f"Skipped data sources with unchanged inputs: {report['skipped']}")
         intermediate_files = list(map(str, (workdir / "intermediate").glob("*.csv")))
         logger.log_info(f"Created intermediate tables: {intermediate_files}")
 
@@ -363,20 +388,13 @@ def combine_table(table_name: str = None) -> Response:
             lambda x: x.name in intermediate_file_names,
         )
 
-        # Re-load all intermediate results
-        intermediate_results = data_pipeline._load_intermediate_results(workdir / "intermediate")
+        # Combine all intermediate results using a streaming merge, writing one block at a time
+        intermediate_files = data_pipeline._intermediate_files(workdir / "intermediate")
         logger.log_info(f"Loaded intermediate tables {intermediate_file_names}")
-
-        # Limit the number of processes to avoid OOM in big datasets
-        process_count = 4
-
-        # Combine all intermediate results into a single dataframe
-        pipeline_output = data_pipeline.combine(intermediate_results, process_count=process_count)
-        logger.log_info(f"Combined intermediate tables into {table_name}")
-
-        # Output combined data to disk
         output_path = workdir / "tables" / f"{table_name}.csv"
-        export_csv(pipeline_output, output_path, schema=data_pipeline.schema)
+        output_blocks = data_pipeline.combine_files(intermediate_files)
+        data_pipeline._export_output(output_blocks, output_path)
+        logger.log_info(f"Combined intermediate tables into {table_name}")
         logger.log_info(f"Exported combined {table_name} to CSV")
 
         # Upload results to the test bucket because these are not prod files
@@ -518,14 +536,16 @@ def publish_v3_latest_tables() -> Response:
 
 @profiled_route("/publish_v3_location_subsets")
 def publish_v3_location_subsets(
-    location_key_from: str = None, location_key_until: str = None
+    location_key_from: str = None, location_key_until: str = None, parallel_jobs: int = 8
 ) -> Response:
     location_key_from = _get_request_param("location_key_from", location_key_from)
     location_key_until = _get_request_param("location_key_until", location_key_until)
+    process_count = _get_request_param("parallel_jobs", str(parallel_jobs))
+    # Default to 1 if invalid process count is given
+    process_count = safe_int_cast(process_count) or 1
 
     with temporary_directory() as workdir:
         input_folder = workdir / "input"
-        intermediate_folder = workdir / "temp"
         output_folder = workdir / "output"
         input_folder.mkdir(parents=True, exist_ok=True)
         output_folder.mkdir(parents=True, exist_ok=True)
@@ -550,22 +570,19 @@ def publish_v3_location_subsets(
         )
         logger.log_info(f"Downloaded {sum(1 for _ in input_folder.glob('**/*.csv'))} CSV files")
 
-        # Break out each table into separate folders based on the location key
-        publish_location_breakouts(input_folder, intermediate_folder, use_table_names=V3_TABLE_LIST)
-        logger.log_info("Created all table location breakouts")
-
         # Create a folder which will host all the location aggregates
         location_aggregates_folder = output_folder / "location"
         location_aggregates_folder.mkdir(parents=True, exist_ok=True)
 
-        # Aggregate the tables for each location independently
-        publish_location_aggregates(
-            intermediate_folder,
+        # Aggregate the tables for each location in a single pass over the global tables
+        publish_location_aggregates_from_tables(
+            input_folder,
             location_aggregates_folder,
             location_keys,
             use_table_names=V3_TABLE_LIST,
+            process_count=process_count,
         )
-        logger.log_info("Aggregated all table breakouts by location")
+        logger.log_info("Aggregated all tables by location")
 
         # Upload the results to the prod bucket
         upload_folder(GCS_BUCKET_PROD, "v3", output_folder)
@@ -14,9 +14,15 @@
 
 import warnings
 from typing import Dict, List
-from pandas import DataFrame
+import numpy
+from pandas import DataFrame, Series, concat, factorize
 from pandas.api.types import is_numeric_dtype
-from .cast import safe_float_cast
+
+# Columns of the structured anomaly reports, with one row per anomaly found
+ANOMALY_REPORT_COLUMNS = ["key", "column", "anomaly", "last_date"]
+
+# Message used to describe each type of anomaly found in a report
+_ANOMALY_MESSAGES = {"stale": "Stale column detected: "}
 
 
 def _detect_perform_action(msg: str, tags: List[str], action: str):
@@ -43,7 +49,7 @@ def detect_null_columns(
     schema: Dict[str, type], data: DataFrame, tags: List[str], action: str = "warn"
 ) -> None:
     for column in data.columns:
-        if sum(~data[column].isnull()) == 0:
+        if not data[column].notna().any():
             _detect_perform_action("Null column detected: " + column, tags, action)
 
 
@@ -55,10 +61,10 @@ def detect_zero_columns(
             continue
         if not is_numeric_dtype(data[column]):
             continue
-        if sum(~data[column].isnull()) == 0:
+        if not data[column].notna().any():
             # Already flagged by detect_null_columns
             continue
-        if sum(data[column].apply(safe_float_cast).fillna(0).apply(abs)) < 1:
+        if data[column].abs().sum() < 1:
             _detect_perform_action("All-zeroes column detected: " + column, tags, action)
 
 
@@ -77,6 +83,62 @@ def detect_stale_columns(
             _detect_perform_action("Stale column detected: " + column, tags, action)
 
 
+def stale_columns_report(schema: Dict[str, type], data: DataFrame) -> DataFrame:
+    """
+    Equivalent to running `detect_stale_columns` on the records of each key, but computed for all
+    keys at once. A column is stale for a key if it has values for that key, but none of them are
+    found in the last 3 dates of that key.
+
+    Arguments:
+        schema: Schema of the table, which determines whether it has a date column.
+        data: Table with a `key` column to check for stale columns.
+    Returns:
+        DataFrame: Anomaly report with `ANOMALY_REPORT_COLUMNS`, sorted by key and with the columns
+            in the same order as the input table for each key.
+    """
+    if "date" not in schema:
+        return DataFrame(columns=ANOMALY_REPORT_COLUMNS)
+
+    data = data[data["key"].notna() & data["date"].notna()]
+    key_codes, keys = factorize(data["key"], sort=True)
+    date_codes, dates = factorize(data["date"], sort=True)
+
+    # Find the earliest of the last 3 dates of each key
+    key_dates = DataFrame({"key": key_codes, "date": date_codes}).drop_duplicates()
+    key_dates = key_dates.sort_values(["key", "date"], ascending=[True, False])
+    key_dates = key_dates[key_dates.groupby("key").cumcount() < 3]
+    first_recent_date = key_dates.groupby("key")["date"].min().reindex(range(len(keys))).values
+
+    report = []
+    for column_idx, column in enumerate(data.columns):
+        # Find the last date with a value of this column for each key, or -1 if there are none
+        valid_dates = numpy.where(data[column].notna().values, date_codes, -1)
+        last_date = Series(valid_dates).groupby(key_codes).max().reindex(range(len(keys))).values
+        stale_keys = numpy.flatnonzero((last_date >= 0) & (last_date < first_recent_date))
+        report.append(
+            DataFrame(
+                {
+                    "key": keys.take(stale_keys),
+                    "column": column,
+                    "anomaly": "stale",
+                    "last_date": dates.take(last_date[stale_keys]),
+                    "_column_idx": column_idx,
+                }
+            )
+        )
+
+    if not report:
+        return DataFrame(columns=ANOMALY_REPORT_COLUMNS)
+    report = concat(report).sort_values(["key", "_column_idx"], kind="stable")
+    return report[ANOMALY_REPORT_COLUMNS].reset_index(drop=True)
+
+
+def report_anomalies(report: DataFrame, tags: List[str], action: str = "warn") -> None:
+    """ Performs the action for every anomaly in a report, tagged with the key it belongs to """
+    for key, column, anomaly in zip(report["key"], report["column"], report["anomaly"]):
+        _detect_perform_action(_ANOMALY_MESSAGES[anomaly] + column, tags + [key], action)
+
+
 def detect_anomaly_all(
     schema: Dict[str, type], data: DataFrame, tags: List[str], action: str = "warn"
 ) -> None:
@@ -13,16 +13,22 @@
 # limitations under the License.
 
 import json
+import os
 import uuid
 from pathlib import Path
-from typing import Any, Callable, Dict, List
+from typing import Any, Callable, Dict, Iterator, List, Optional, TextIO
 
 from pandas import DataFrame
 
+from lib.concurrent import thread_map
 from lib.data_source import DataSource
 from lib.net import get_retry
 
 
+# Maximum number of pages downloaded concurrently from the same service
+ARCGIS_MAX_WORKERS = 8
+
+
 def _download_arcgis(
     url: str, offset: int = 0, log_func: Callable[[str], None] = None
 ) -> List[Dict[str, Any]]:
@@ -44,6 +50,105 @@ def _download_arcgis(
     return [row["attributes"] for row in data]
 
 
+def _download_arcgis_page(
+    url: str, offset: int, page_size: int, log_func: Callable[[str], None] = None
+) -> List[Dict[str, Any]]:
+    """
+    Download the `page_size` records starting at `offset`, making more requests if the service
+    returns fewer records than requested before reaching the end of the data.
+    """
+    records = []
+    while len(records) < page_size:
+        rows = _download_arcgis(url, offset=offset + len(records), log_func=log_func)
+        if len(rows) == 0:
+            break
+        records += rows
+    return records[:page_size]
+
+
+def _download_arcgis_count(url: str) -> Optional[int]:
+    """ Outputs the number of records reported by an ArcGIS data source, if it supports it """
+    try:
+        return int(get_retry(url + "&returnCountOnly=true", timeout=60).json()["count"])
+    except Exception:
+        return None
+
+
+def _write_records(fd: TextIO, records: List[Dict[str, Any]]) -> None:
+    for record in records:
+        fd.write(json.dumps(record) + "\n")
+
+
+def download_arcgis_records(
+    url: str,
+    file_path: Path,
+    max_workers: int = ARCGIS_MAX_WORKERS,
+    log_func: Callable[[str], None] = None,
+) -> None:
+    """
+    Downloads all the records from an ArcGIS data source into `file_path`, writing one JSON record
+    per line. The first page determines the maximum number of records per request and, if the
+    service reports the total number of records, the remaining pages are downloaded concurrently.
+
+    Arguments:
+        url: Query URL of the ArcGIS data source.
+        file_path: Path of the file where the records are written to.
+        max_workers: Maximum number of pages downloaded at the same time.
+        log_func: Function used to log the contents of failed responses.
+    """
+    temp_path = file_path.parent / f"{file_path.name}.tmp"
+    try:
+        with open(temp_path, "w") as fd:
+            rows = _download_arcgis(url, offset=0, log_func=log_func)
+            _write_records(fd, rows)
+            page_size = offset = len(rows)
+
+            # Download all the pages within the record count concurrently, preserving their order.
+            # Only a few pages are downloaded ahead of the one being written, to bound memory usage.
+            count = _download_arcgis_count(url) if page_size > 0 else None
+            if count is not None and count > offset:
+                map_iter = range(offset, count, page_size)
+                map_func = lambda x: _download_arcgis_page(
+                    url, x, min(page_size, count - x), log_func=log_func
+                )
+                map_opts = dict(
+                    max_workers=max_workers,
+                    max_pending=2 * max_workers,
+                    desc="Downloading ArcGIS pages",
+                )
+                for rows in thread_map(map_func, map_iter, **map_opts):
+                    _write_records(fd, rows)
+                offset = count
+
+            # Records may have been added after the count was made, so keep going until the end
+            while page_size > 0:
+                rows = _download_arcgis(url, offset=offset, log_func=log_func)
+                if len(rows) == 0:
+                    break
+                _write_records(fd, rows)
+                offset += len(rows)
+
+        os.replace(temp_path, file_path)
+
+    finally:
+        if temp_path.exists():
+            temp_path.unlink()
+
+
+def read_arcgis_records(file_path: str) -> Iterator[Dict[str, Any]]:
+    """
+    Reads the records downloaded by `download_arcgis_records` one at a time.
+
+    Arguments:
+        file_path: Path of the file containing one JSON record per line.
+    Returns:
+        Iterator[Dict[str, Any]]: Records from the data source in the order they were downloaded.
+    """
+    with open(file_path, "r") as fd:
+        for line in fd:
+            yield json.loads(line)
+
+
 class ArcGISDataSource(DataSource):
     def fetch(
         self,
@@ -62,24 +167,12 @@ class ArcGISDataSource(DataSource):
             file_path = (
                 output_folder
                 / "snapshot"
-                / ("%s.%s" % (uuid.uuid5(uuid.NAMESPACE_DNS, url_base), "json"))
+                / ("%s.%s" % (uuid.uuid5(uuid.NAMESPACE_DNS, url_base), "jsonl"))
             )
 
             # Avoid download if the file exists and flag is set
             if not skip_existing or not file_path.exists():
-
-                # Download the data in chunks
-                offset = 0
-                records = []
-                for _ in range(int(1e6)):
-                    rows = _download_arcgis(url_base, offset=offset, log_func=self)
-                    if len(rows) == 0:
-                        break
-                    records += rows
-                    offset += len(rows)
-
-                with open(file_path, "w") as fd:
-                    json.dump({"features": records}, fd)
+                download_arcgis_records(url_base, file_path, log_func=self.log_error)
 
             # Add downloaded file to the list
             downloaded_files[opts.get("name", idx)] = str(file_path.absolute())
@@ -89,7 +182,5 @@ class ArcGISDataSource(DataSource):
     def parse(self, sources: Dict[str, str], aux: Dict[str, DataFrame], **parse_opts) -> DataFrame:
         dataframes = {}
         for name, file_path in sources.items():
-            with open(file_path, "r") as fd:
-                records = json.load(fd)["features"]
-                dataframes[name] = DataFrame.from_records(records)
+            dataframes[name] = DataFrame.from_records(read_arcgis_records(file_path))
         return self.parse_dataframes(dataframes, aux, **parse_opts)
@@ -58,7 +58,7 @@ class CachedDataSource(DataSource):
 
             # Download the cache items into the snapshots directory
             file_paths = list(_generate_snapshot_paths(output_folder, cache_urls.values()))
-            list(parallel_download(list(cache_urls.values()), file_paths))
+            parallel_download(list(cache_urls.values()), file_paths, engine="asyncio")
             sources[cache_key] = {
                 date: file_path for date, file_path in zip(cache_urls.keys(), file_paths)
             }
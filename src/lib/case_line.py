@@ -13,8 +13,9 @@
 # limitations under the License.
 
 import re
-from typing import Any, Callable, Dict, List
-from pandas import DataFrame
+from typing import Any, Callable, Dict, Iterable, List
+import numpy
+from pandas import DataFrame, Series, concat, factorize
 from unidecode import unidecode
 from lib.cast import age_group, isna, safe_int_cast
 from lib.constants import SRC
@@ -67,6 +68,72 @@ DEFAULT_BIN_ADAPTERS = {
 }
 
 
+def _apply_bin_adapter(values: Series, adapter: Callable[[Any], str]) -> Series:
+    """ Applies the adapter once per distinct value and maps the buckets back using their codes """
+    codes, uniques = factorize(values)
+    # Null values have code -1, which picks the trailing bucket
+    buckets = [adapter(value) for value in uniques] + [adapter(numpy.nan)]
+    buckets = numpy.array(buckets, dtype=object)
+    return Series(buckets[codes], index=values.index, name=values.name)
+
+
+def _prepare_cases(
+    cases: DataFrame, index_columns: List[str], bin_adapters: Dict[str, Callable[[Any], str]]
+) -> Dict[str, Callable[[Any], str]]:
+    """ Validates the case-line columns and outputs the bin adapters which apply to them """
+    assert all(
+        col in cases.columns for col in index_columns
+    ), f"Expected all columns {index_columns} to be in {cases.columns}"
+
+    # Columns with only null values are not read as strings, for example in a chunk of a file
+    string_columns = cases.select_dtypes(include="object")
+    assert all(
+        col in string_columns or cases[col].isna().all() for col in index_columns
+    ), f"Expected for all {index_columns} to be of type string"
+
+    # Fill in the bin adapters with default implementations
+    bin_adapters = {**(bin_adapters or {}), **DEFAULT_BIN_ADAPTERS}
+    return {col: adapter for col, adapter in bin_adapters.items() if col in cases.columns}
+
+
+def _count_cases(
+    cases: DataFrame, index_columns: List[str], bin_adapters: Dict[str, Callable[[Any], str]]
+) -> DataFrame:
+    """
+    Counts the cases of each statistic grouped by date, index columns and buckets. The output is
+    indexed by those columns and has one column per statistic.
+    """
+    group_columns = index_columns + list(bin_adapters.keys())
+    date_columns = [col for col in cases.columns if col.startswith("date_")]
+    value_columns = [col.split("date_")[-1] for col in date_columns]
+    cases = cases[group_columns + date_columns].copy()
+
+    # Apply the bin adapters to all of the known, allowed bucket types
+    for col, adapter in bin_adapters.items():
+        cases[col] = _apply_bin_adapter(cases[col], adapter)
+
+    # Index columns are all expected to be of str type so we replace NaN with empty string
+    # Replacement necessary to work around https://github.com/pandas-dev/pandas/issues/3729
+    for col in group_columns:
+        cases[col] = cases[col].where(cases[col].notna(), "")
+
+    # Melt all the statistics into a single date column, so they are counted in one groupby
+    records = cases.melt(
+        id_vars=group_columns, value_vars=date_columns, var_name="_statistic", value_name="date"
+    )
+    records = records.dropna(subset=["date"])
+
+    index_columns = ["date"] + group_columns
+    if len(records) == 0:
+        empty = DataFrame(columns=index_columns + value_columns)
+        return empty.astype({col: int for col in value_columns}).set_index(index_columns)
+
+    counts = records.groupby(index_columns + ["_statistic"]).size()
+    counts = counts.unstack("_statistic", fill_value=0).reindex(columns=date_columns, fill_value=0)
+    counts.columns = value_columns
+    return counts
+
+
 def convert_cases_to_time_series(
     cases: DataFrame,
     index_columns: List = None,
@@ -98,42 +165,49 @@ def convert_cases_to_time_series(
         DataFrame: time-series formatted data table
     """
     index_columns = ["key"] if index_columns is None else index_columns
+    bin_adapters = _prepare_cases(cases, index_columns, bin_adapters)
+    return _count_cases(cases, index_columns, bin_adapters).reset_index()
 
-    assert all(
-        col in cases.columns for col in index_columns
-    ), f"Expected all columns {index_columns} to be in {cases.columns}"
 
-    string_columns = cases.select_dtypes(include="object")
-    assert all(
-        col in string_columns for col in index_columns
-    ), f"Expected for all {index_columns} to be of type string"
+def _merge_counts(counts: List[DataFrame]) -> DataFrame:
+    """ Adds up the counts output by `_count_cases` for different chunks of the same data """
+    counts = concat(counts)
+    return counts.groupby(level=list(range(counts.index.nlevels))).sum()
 
-    # Fill in the bin adapters with default implementations
-    bin_adapters = {**(bin_adapters or {}), **DEFAULT_BIN_ADAPTERS}
-    bin_adapters = {col: adapter for col, adapter in bin_adapters.items() if col in cases.columns}
 
-    # Remove all columns which are not indexable
-    index_columns = ["date"] + index_columns + list(bin_adapters.keys())
-    cases = cases[[col for col in cases.columns if col in index_columns or col.startswith("date_")]]
-    cases = cases.copy()
+def convert_cases_to_time_series_chunked(
+    chunks: Iterable[DataFrame],
+    index_columns: List = None,
+    bin_adapters: Dict[str, Callable[[Any], str]] = None,
+) -> DataFrame:
+    """
+    Same as `convert_cases_to_time_series` but for case-line data split into chunks, for example
+    the output of `read_file(path, chunksize=...)`. Cases are counted one chunk at a time, so only
+    the counts and a single chunk are held in memory at once.
+
+    Arguments:
+        chunks: DataFrames in the case-line format, all of them with the same columns
+        index_columns: Columns which will be used for grouping regardless of buckets
+        bin_adapters: Map of <column name, adapter> where the adapter takes a case value as input
+            outputs a bucket value, for example age adapter `(3) -> "0-9"`
+    Returns:
+        DataFrame: time-series formatted data table
+    """
+    index_columns = ["key"] if index_columns is None else index_columns
 
-    # Apply the bin adapters to all of the known, allowed bucket types
-    for col, adapter in bin_adapters.items():
-        cases[col] = cases[col].apply(adapter)
-
-    # Go from individual case records to key-grouped records in a flat table
-    merged: DataFrame = None
-    for value_column in [col.split("date_")[-1] for col in cases.columns if "date_" in col]:
-        subset = cases.rename(columns={"date_{}".format(value_column): "date"})[index_columns]
-        # Index columns are all expected to be of str type so we replace NaN with empty string
-        # Replacement necessary to work around https://github.com/pandas-dev/pandas/issues/3729
-        subset = subset.dropna(subset=["date"]).fillna("")
-        subset[value_column] = 1
-        subset = subset.groupby(index_columns).sum().reset_index()
-        if merged is None:
-            merged = subset
-        else:
-            merged = merged.merge(subset, how="outer")
-
-    # We can fill all missing records as zero since we know we have "perfect" information
-    return merged.fillna(0)
+    counts: DataFrame = None
+    partial_counts: List[DataFrame] = []
+    for cases in chunks:
+        chunk_adapters = _prepare_cases(cases, index_columns, bin_adapters)
+        partial_counts.append(_count_cases(cases, index_columns, chunk_adapters))
+
+        # Merge the partial counts once they outgrow the merged counts, which keeps the cost of
+        # merging proportional to the size of the partial counts
+        if counts is None or sum(len(df) for df in partial_counts) >= len(counts):
+            counts = _merge_counts(([] if counts is None else [counts]) + partial_counts)
+            partial_counts = []
+
+    assert counts is not None, "Expected at least one chunk of case-line data"
+    if partial_counts:
+        counts = _merge_counts([counts] + partial_counts)
+    return counts.reset_index()
@@ -16,7 +16,10 @@ import datetime
 import warnings
 from typing import Any, Dict, Callable, Optional
 
+import numpy
 import pandas
+from pandas import Int64Dtype, Series
+from pandas.api.types import infer_dtype
 
 
 def _clean_numeric(value: Any) -> str:
@@ -109,6 +112,99 @@ def column_converters(schema: Dict[str, Any]) -> Dict[str, Callable]:
     return converters
 
 
+# Kinds of object columns which can be cast by numpy with the same semantics as `float()`
+_NUMERIC_OBJECT_KINDS = ("empty", "boolean", "integer", "floating", "mixed-integer-float")
+
+# Largest magnitude for which integers are exactly representable as floats
+_MAX_EXACT_FLOAT_INT = 2 ** 53
+
+
+def _cast_float_column(values: Series) -> Series:
+    """ Vectorized equivalent of `values.apply(safe_float_cast)` """
+    if values.dtype.kind in "biuf":
+        return values.astype(float)
+    if isinstance(values.dtype, Int64Dtype):
+        return Series(values.to_numpy(dtype=float, na_value=numpy.nan), index=values.index)
+
+    kind = infer_dtype(values, skipna=True)
+    if values.dtype != object or not (kind == "string" or kind in _NUMERIC_OBJECT_KINDS):
+        return values.apply(safe_float_cast)
+
+    mask = values.notna().values
+    array = values.values[mask]
+    if kind == "string":
+        # Empty strings are null, and the rest are cleaned up the same way as `_clean_numeric`
+        non_empty = array != ""
+        mask[mask] = non_empty
+        strings = Series(array[non_empty], dtype=object).str.replace(",", "", regex=False)
+        minus_sign = strings.str.startswith("−")
+        strings[minus_sign] = strings[minus_sign].str.replace("−", "-", regex=False)
+        array = strings.values
+
+    result = numpy.full(len(values), numpy.nan)
+    try:
+        # Numpy casts objects using `float()`, so parsed values are identical
+        result[mask] = array.astype(float)
+    except (TypeError, ValueError, OverflowError):
+        return values.apply(safe_float_cast)
+    return Series(result, index=values.index)
+
+
+def _cast_int_column(values: Series) -> Series:
+    """ Vectorized equivalent of `values.apply(safe_int_cast)` using a nullable Int64 column """
+    if isinstance(values.dtype, Int64Dtype):
+        return values
+    if values.dtype.kind in "biu":
+        try:
+            return values.astype(Int64Dtype())
+        except (TypeError, ValueError, OverflowError):
+            return values.apply(safe_int_cast)
+
+    floats = _cast_float_column(values)
+    if floats.dtype != float:
+        return values.apply(safe_int_cast)
+
+    # Integers are truncated, and non-finite values are null like in `safe_int_cast`
+    floats = floats.values
+    mask = numpy.isfinite(floats)
+    if (numpy.abs(floats[mask]) >= _MAX_EXACT_FLOAT_INT).any():
+        return values.apply(safe_int_cast)
+    integers = numpy.trunc(numpy.where(mask, floats, 0)).astype(numpy.int64)
+    return Series(pandas.arrays.IntegerArray(integers, ~mask), index=values.index)
+
+
+def _cast_str_column(values: Series) -> Series:
+    """ Vectorized equivalent of `values.apply(safe_str_cast)` """
+    mask = values.notna()
+    if values.dtype == object and infer_dtype(values, skipna=True) in ("empty", "string"):
+        return values.where(mask, None)
+
+    result = Series(None, index=values.index, dtype=object)
+    result[mask] = values[mask].map(str)
+    return result
+
+
+def cast_column(values: Series, dtype: Any) -> Series:
+    """
+    Converts all the values of a column to the given schema dtype. This is equivalent to applying
+    the corresponding converter from `column_converters` to each value, but performs most of the
+    work using vectorized operations. Integer columns use the nullable Int64 type.
+
+    Arguments:
+        values: Column to be converted.
+        dtype: Schema dtype of the column, one of "str", "int" or "float".
+    Returns:
+        Series: Column with the converted values and null in place of the invalid ones.
+    """
+    if dtype == "int" or dtype == pandas.Int64Dtype():
+        return _cast_int_column(values)
+    if dtype == "float":
+        return _cast_float_column(values)
+    if dtype == "str":
+        return _cast_str_column(values)
+    raise ValueError(f"Unsupported dtype {dtype}")
+
+
 def age_group(age: int, bin_size: int = 10, age_cutoff: int = 90) -> str:
     """
     Categorical age group given a specific age, codified into a function to enforce consistency.
@@ -12,11 +12,12 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+from collections import deque
 from concurrent.futures import ProcessPoolExecutor as Pool
 from concurrent.futures import ThreadPoolExecutor as ThreadPool
 from functools import partial
 from multiprocessing import cpu_count, get_context
-from typing import Any, Callable, Dict, Iterable, Type, Union
+from typing import Any, Callable, Dict, Iterable, Iterator, Type, Union
 
 from pandas import DataFrame, Series
 
@@ -36,15 +37,37 @@ def _get_pool(pool_type: Type, max_workers: int) -> Pool:
         raise TypeError(f"Unknown pool type: {pool_type}")
 
 
+def _bounded_imap(
+    pool: Pool, map_func: Callable, map_iter: Iterable[Any], max_pending: int
+) -> Iterator[Any]:
+    """
+    Same as `pool.imap`, but only submits up to `max_pending` items ahead of the last result which
+    was output, so neither the inputs nor the results of the whole iterable are held in memory.
+    """
+    pending = deque()
+    for item in map_iter:
+        pending.append(pool.submit(map_func, item))
+        if len(pending) >= max_pending:
+            yield pending.popleft().result()
+    while pending:
+        yield pending.popleft().result()
+
+
 def _parallel_map(
     pool_type: Type, map_func: Callable, map_iter: Iterable[Any], **tqdm_kwargs
 ) -> Iterable[Any]:
     chunk_size = tqdm_kwargs.pop("chunk_size", 1)
+    max_pending = tqdm_kwargs.pop("max_pending", None)
     max_workers = tqdm_kwargs.pop("max_workers", min(32, cpu_count() + 4))
     total = tqdm_kwargs.pop("total", len(map_iter) if hasattr(map_iter, "__len__") else None)
     progress_bar = pbar(total=total, **tqdm_kwargs)
     with _get_pool(pool_type, max_workers) as pool:
-        for result in pool.imap(map_func, map_iter, chunksize=chunk_size):
+        # All items are submitted at once unless the number of pending items is bounded
+        if max_pending is None:
+            map_results = pool.imap(map_func, map_iter, chunksize=chunk_size)
+        else:
+            map_results = _bounded_imap(pool, map_func, map_iter, max_pending)
+        for result in map_results:
             progress_bar.update(1)
             yield result
     progress_bar.close()
@@ -13,6 +13,7 @@
 # limitations under the License.
 
 import os
+import tempfile
 from pathlib import Path
 
 SRC = Path(os.path.dirname(__file__)) / ".."
@@ -43,6 +44,12 @@ GCP_ENV_SERVICE_ACCOUNT = "GCS_SERVICE_ACCOUNT"
 # different processes.
 GLOBAL_DISABLE_PROGRESS = "TQDM_DISABLE"
 
+# Location of the on-disk cache of preprocessed auxiliary tables, which can be overridden with an
+# environment variable for the same reasons as above. Only the most recently used entries are kept.
+AUXILIARY_CACHE_ENV = "AUXILIARY_CACHE_FOLDER"
+AUXILIARY_CACHE_FOLDER = Path(tempfile.gettempdir()) / "covid-19-open-data" / "auxiliary"
+AUXILIARY_CACHE_MAX_ENTRIES = 32
+
 # Used to filter read_opts from a parse_opts argument
 READ_OPTS = (
     "dtype",
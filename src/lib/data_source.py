@@ -12,12 +12,15 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import hashlib
+import inspect
 import re
 import time
 import uuid
-from functools import partial
+from collections.abc import MutableMapping
+from functools import lru_cache, partial
 from pathlib import Path
-from typing import Any, Dict, List, Optional, Set
+from typing import Any, Dict, Iterator, List, Optional, Set
 
 import numpy
 from pandas import DataFrame
@@ -25,8 +28,9 @@ from pandas import DataFrame
 from .error_logger import ErrorLogger
 from .cast import isna
 from .concurrent import thread_map
-from .constants import READ_OPTS
-from .io import read_file, fuzzy_text
+from .constants import READ_OPTS, SRC
+from .io import file_digest, read_file, fuzzy_text
+from .key_resolver import KeyResolver
 from .net import download_snapshot
 from .time import datetime_isoformat
 from .utils import (
@@ -39,6 +43,83 @@ from .utils import (
 )
 
 
+# Imports from other pipeline packages, either absolute or relative to a sibling package
+_PIPELINE_IMPORT_PATTERN = re.compile(r"^\s*(?:from|import)\s+(?:pipelines\.|\.\.)(\w+)", re.M)
+
+
+def _source_packages(source_file: Path) -> List[Path]:
+    """
+    Folders containing the code used by a data source, which are its own pipeline package plus any
+    other pipeline packages imported from it.
+    """
+    pipelines_root = (SRC / "pipelines").resolve()
+    source_file = source_file.resolve()
+    if pipelines_root not in source_file.parents or source_file.parent == pipelines_root:
+        return [source_file.parent]
+
+    packages = set()
+    pending = [pipelines_root / source_file.relative_to(pipelines_root).parts[0]]
+    while pending:
+        package = pending.pop()
+        if package in packages or not package.is_dir():
+            continue
+        packages.add(package)
+        for code_file in package.rglob("*.py"):
+            code = code_file.read_text(encoding="utf-8", errors="ignore")
+            pending.extend(pipelines_root / name for name in _PIPELINE_IMPORT_PATTERN.findall(code))
+
+    return sorted(packages)
+
+
+@lru_cache(maxsize=None)
+def _code_version(source_file: str) -> str:
+    """
+    Fingerprint of the code used to produce the outputs of a data source, which is the contents of
+    every file in its package, including the packages it imports from, plus all the shared library
+    modules.
+    """
+    code_files = [(SRC / "lib", path) for path in (SRC / "lib").glob("*.py")]
+    for package in _source_packages(Path(source_file)):
+        code_files += [(package.parent, path) for path in package.rglob("*") if path.is_file()]
+
+    code_hash = hashlib.sha256()
+    for root, code_file in sorted(code_files):
+        if "__pycache__" not in code_file.parts:
+            name = code_file.relative_to(root).as_posix()
+            code_hash.update(f"{name}={file_digest(code_file)};".encode())
+    return code_hash.hexdigest()
+
+
+class _AuxiliaryTablesView(MutableMapping):
+    """
+    Mapping of auxiliary tables which makes a copy of each table the first time it is accessed, so
+    the shared tables are never modified and tables which are not used are never copied.
+    """
+
+    def __init__(self, tables: Dict[str, DataFrame]):
+        self._tables = dict(tables)
+        self._copies: Dict[str, DataFrame] = {}
+
+    def __getitem__(self, name: str) -> DataFrame:
+        if name not in self._copies:
+            self._copies[name] = self._tables[name].copy()
+        return self._copies[name]
+
+    def __setitem__(self, name: str, table: DataFrame) -> None:
+        self._tables[name] = table
+        self._copies[name] = table
+
+    def __delitem__(self, name: str) -> None:
+        del self._tables[name]
+        self._copies.pop(name, None)
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self._tables)
+
+    def __len__(self) -> int:
+        return len(self._tables)
+
+
 class DataSource(ErrorLogger):
     """
     Interface for data sources. A data source consists of a series of steps performed in the
@@ -207,6 +288,9 @@ class DataSource(ErrorLogger):
         cache: Dict[str, str],
         aux: Dict[str, DataFrame],
         skip_existing: bool = False,
+        table_name: str = None,
+        previous_manifest: Dict[str, Any] = None,
+        key_resolver: KeyResolver = None,
     ) -> DataFrame:
         """
         Executes the fetch, parse and merge steps for this data source.
@@ -216,6 +300,14 @@ class DataSource(ErrorLogger):
             cache: Map of data sources that are stored in the cache layer (used for daily-only).
             aux: Map of auxiliary DataFrames used as part of the processing of this DataSource.
             skip_existing: Flag indicating whether to use the locally stored snapshots if possible.
+            table_name: Name of the output table, used to record the manifest of this run's inputs
+                in the `attrs` of the output. See `DataSource.manifest`.
+            previous_manifest: Manifest of the inputs used to produce the existing output. If the
+                inputs have not changed, the parse and merge steps are skipped and the output is
+                an empty DataFrame with the "unchanged" flag set in its `attrs`.
+            key_resolver: Index over the metadata auxiliary table used to resolve the keys of the
+                records, shared by all data sources using the same auxiliary tables. If not
+                provided, one is built for this run.
 
         Returns:
             DataFrame: Processed data, with columns defined in config.yaml corresponding to the
@@ -231,39 +323,72 @@ class DataSource(ErrorLogger):
         # Fetch the data, feeding the cached resources to the fetch step
         data = self.fetch(output_folder, cache, fetch_opts, skip_existing=skip_existing)
 
-        # Make yet another copy of the auxiliary table to avoid affecting future steps in `parse`
+        # Skip the rest of the steps if none of the inputs have changed since the previous run
+        manifest = None if table_name is None else self.manifest(table_name, data)
+        if manifest is not None and manifest == previous_manifest:
+            self.log_info("Data source inputs unchanged, skipping run")
+            unchanged = DataFrame()
+            unchanged.attrs.update(manifest=manifest, unchanged=True)
+            return unchanged
+
+        # Tables are copied when accessed during `parse` to avoid affecting future steps
         parse_opts = dict(self.config.get("parse", {}))
-        data = self.parse(data, {name: df.copy() for name, df in aux.items()}, **parse_opts)
+        data = self.parse(data, _AuxiliaryTablesView(aux), **parse_opts)
 
         # Merge expects for null values to be NaN (otherwise grouping does not work as expected)
         data.replace([None], numpy.nan, inplace=True)
 
         # Get a set with all the known keys so we can use the information during the merge step
-        known_keys = set(aux["metadata"]["key"].values)
-        merge_func = lambda x: self.merge(x, aux, known_keys)
+        metadata = aux["metadata"]
+        known_keys = set(metadata["key"].values)
+
+        # The rest of the steps get their own view, so the shared tables are never modified either
+        aux_view = _AuxiliaryTablesView(aux)
+        merge_func = lambda x: self.merge(x, aux_view, known_keys)
 
-        # Merging is done record by record, but can be sped up if we build a map first aggregating
-        # by the non-temporal fields and only matching the aggregated records with keys
+        # Merging record by record is only done when explicitly requested by the config
         merge_opts = dict(self.config.get("merge", {}))
-        key_merge_columns = [
-            col for col in data if col in aux["metadata"].columns and len(data[col].unique()) > 1
-        ]
-        if not key_merge_columns or (merge_opts and merge_opts.get("serial")):
+        if merge_opts and merge_opts.get("serial"):
             data["key"] = data.apply(merge_func, axis=1)
 
+        # Otherwise all records are resolved in a single batched pass using a prebuilt index, as
+        # long as the merge step has not been overridden by this data source
+        elif type(self).merge is DataSource.merge:
+            key_resolver = key_resolver or KeyResolver(metadata)
+            keys, unmatched = key_resolver.resolve(data)
+
+            # Records with the same values for all the match columns are only logged once
+            match_columns = KeyResolver.match_columns(unmatched.columns)
+            unmatched = unmatched.drop_duplicates(subset=match_columns or None)
+            for record in unmatched.to_dict("records"):
+                self.log_error(f"No key match found", record=record)
+            data["key"] = keys
+            data.reset_index(drop=True, inplace=True)
+
         else:
-            # Build a _vec column used to merge the key back from the groups into data
-            make_key_vec = lambda x: "|".join([str(x[col]) for col in key_merge_columns])
-            data["_vec"] = data[key_merge_columns].apply(make_key_vec, axis=1)
+            # Merging is done record by record, but can be sped up if we build a map first
+            # aggregating by the non-temporal fields and only matching those records with keys
+            key_merge_columns = [
+                col
+                for col in data
+                if col in metadata.columns and len(data[col].unique()) > 1
+            ]
+            if not key_merge_columns:
+                data["key"] = data.apply(merge_func, axis=1)
+
+            else:
+                # Build a _vec column used to merge the key back from the groups into data
+                make_key_vec = lambda x: "|".join([str(x[col]) for col in key_merge_columns])
+                data["_vec"] = data[key_merge_columns].apply(make_key_vec, axis=1)
 
-            # Iterate only over the grouped data to merge with the metadata key
-            grouped_data = data.groupby("_vec").first().reset_index()
-            grouped_data["key"] = grouped_data.apply(merge_func, axis=1)
+                # Iterate only over the grouped data to merge with the metadata key
+                grouped_data = data.groupby("_vec").first().reset_index()
+                grouped_data["key"] = grouped_data.apply(merge_func, axis=1)
 
-            # Merge the grouped data which has key back with the original data
-            if "key" in data.columns:
-                data = data.drop(columns=["key"])
-            data = data.merge(grouped_data[["key", "_vec"]], on="_vec").drop(columns=["_vec"])
+                # Merge the grouped data which has key back with the original data
+                if "key" in data.columns:
+                    data = data.drop(columns=["key"])
+                data = data.merge(grouped_data[["key", "_vec"]], on="_vec").drop(columns=["_vec"])
 
         # Drop records which have no key merged
         # TODO: log records with missing key somewhere on disk
@@ -346,15 +471,46 @@ class DataSource(ErrorLogger):
 
         # Derive localities from all regions
         pooling_func = parse_opts.get("pooling_function", "sum")
-        localities = derive_localities(aux["localities"], data, pooling_func=pooling_func)
+        localities = derive_localities(aux_view["localities"], data, pooling_func=pooling_func)
         if len(localities) > 0:
             data = data.append(localities)
 
-        # Return the final dataframe
+        # Return the final dataframe along with the manifest of the inputs used to produce it
+        if manifest is not None:
+            data.attrs.update(manifest=manifest)
         time_elapsed = time.monotonic() - time_start
         self.log_info(f"Data source finished", seconds=time_elapsed, record_count=len(data))
         return data
 
+    def manifest(self, table_name: str, sources: Dict[Any, str]) -> Optional[Dict[str, Any]]:
+        """
+        Describes all the inputs of a run of this data source: the configuration, a fingerprint of
+        the code and the contents of each of the fetched snapshots. If two runs have the same
+        manifest, they are expected to produce the same output.
+
+        Arguments:
+            table_name: Name of the table which this data source is producing output for.
+            sources: Dictionary of <name, local path> output by the fetch step.
+        Returns:
+            Optional[Dict[str, Any]]: The manifest of the inputs, or None if the inputs could not
+                be determined, like when the data source does not fetch any files.
+        """
+        snapshots = {}
+        for name, path in (sources or {}).items():
+            if not isinstance(path, (str, Path)) or not Path(path).is_file():
+                return None
+            snapshots[str(name)] = file_digest(path)
+
+        # Data sources which download their data during the parse step cannot be skipped
+        if not snapshots:
+            return None
+
+        return {
+            "uuid": self.uuid(table_name),
+            "code_version": _code_version(inspect.getfile(self.__class__)),
+            "snapshots": snapshots,
+        }
+
     def uuid(self, table_name: str) -> str:
         """
         Generates a deterministic identifier based on this data source's class and configuration.
@@ -0,0 +1,133 @@
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import math
+from typing import Tuple
+
+import numpy
+from scipy.spatial import cKDTree
+
+
+# Radius of the Earth in kilometers used to compute distances
+EARTH_RADIUS = 6373.0
+
+
+def haversine_distance(
+    lat1: numpy.ndarray,
+    lon1: numpy.ndarray,
+    lat2: numpy.ndarray,
+    lon2: numpy.ndarray,
+    radius: float = EARTH_RADIUS,
+) -> numpy.ndarray:
+    """
+    Compute the distance between pairs of <latitude, longitude> coordinates in kilometers.
+
+    Arguments:
+        lat1: Latitude of the first point of each pair, in radians.
+        lon1: Longitude of the first point of each pair, in radians.
+        lat2: Latitude of the second point of each pair, in radians.
+        lon2: Longitude of the second point of each pair, in radians.
+        radius: Radius of the sphere, which determines the units of the output.
+    Returns:
+        numpy.ndarray: Distance between each pair of points.
+    """
+
+    # Compute the pairwise deltas
+    lat_diff = numpy.asarray(lat2) - lat1
+    lon_diff = numpy.asarray(lon2) - lon1
+
+    # Apply Haversine formula
+    a = numpy.sin(lat_diff / 2) ** 2
+    a += numpy.cos(lat1) * numpy.cos(lat2) * numpy.sin(lon_diff / 2) ** 2
+    c = numpy.arctan2(numpy.sqrt(a), numpy.sqrt(1 - a)) * 2
+
+    return radius * c
+
+
+def _unit_vectors(lat: numpy.ndarray, lon: numpy.ndarray) -> numpy.ndarray:
+    """ Converts <latitude, longitude> coordinates in radians to points in the unit sphere """
+    lat, lon = numpy.asarray(lat, dtype=float), numpy.asarray(lon, dtype=float)
+    cos_lat = numpy.cos(lat)
+    return numpy.stack([cos_lat * numpy.cos(lon), cos_lat * numpy.sin(lon), numpy.sin(lat)], 1)
+
+
+class GeoIndex:
+    """
+    Spatial index of <latitude, longitude> coordinates, which answers nearest neighbor queries for
+    many points at once. Coordinates are indexed as points in the unit sphere using a KD-tree, and
+    the straight-line distance between them is used to find the points nearest to each query, since
+    it increases monotonically with the distance along the surface of the sphere.
+    """
+
+    def __init__(self, lat: numpy.ndarray, lon: numpy.ndarray, radius: float = EARTH_RADIUS):
+        """
+        Arguments:
+            lat: Latitude of each indexed point, in radians.
+            lon: Longitude of each indexed point, in radians.
+            radius: Radius of the sphere, which determines the units of the distances.
+        """
+        self.lat = numpy.asarray(lat, dtype=float)
+        self.lon = numpy.asarray(lon, dtype=float)
+        self.radius = radius
+        self._tree = cKDTree(_unit_vectors(self.lat, self.lon))
+
+    def __len__(self) -> int:
+        return len(self.lat)
+
+    def nearest(
+        self, lat: numpy.ndarray, lon: numpy.ndarray, k: int, max_distance: float
+    ) -> Tuple[numpy.ndarray, numpy.ndarray, numpy.ndarray]:
+        """
+        Finds up to `k` indexed points nearest to each query point, which are strictly closer than
+        `max_distance` to it.
+
+        Arguments:
+            lat: Latitude of each query point, in radians.
+            lon: Longitude of each query point, in radians.
+            k: Maximum number of points to output for each query point.
+            max_distance: Output only points closer than this distance to the query point.
+        Returns:
+            Tuple[numpy.ndarray, numpy.ndarray, numpy.ndarray]: Position of the query point,
+                position of the indexed point and haversine distance between them for every match,
+                sorted by query point and then by distance.
+        """
+        lat, lon = numpy.asarray(lat, dtype=float), numpy.asarray(lon, dtype=float)
+        empty = numpy.array([], dtype=int)
+        if len(self) == 0 or len(lat) == 0 or k <= 0:
+            return empty, empty, numpy.array([], dtype=float)
+
+        # Convert the maximum distance to the chord length between points in the unit sphere, with
+        # a small margin so points are only discarded after computing their exact distance
+        angle = min(max_distance / self.radius, math.pi)
+        chord = 2 * math.sin(angle / 2) * (1 + 1e-9) + 1e-12
+
+        k = min(k, len(self))
+        _, point_idx = self._tree.query(_unit_vectors(lat, lon), k=k, distance_upper_bound=chord)
+        point_idx = point_idx.reshape(len(lat), k)
+
+        # Missing neighbors are reported with an index equal to the number of points
+        query_idx = numpy.repeat(numpy.arange(len(lat)), k)
+        point_idx = point_idx.ravel()
+        mask = point_idx < len(self)
+        query_idx, point_idx = query_idx[mask], point_idx[mask]
+
+        # Compute the exact distances and filter out the points at or beyond the maximum distance
+        distance = haversine_distance(
+            lat[query_idx], lon[query_idx], self.lat[point_idx], self.lon[point_idx], self.radius
+        )
+        mask = distance < max_distance
+        query_idx, point_idx, distance = query_idx[mask], point_idx[mask], distance[mask]
+
+        order = numpy.lexsort((point_idx, distance, query_idx))
+        return query_idx[order], point_idx[order], distance[order]
@@ -13,13 +13,14 @@
 # limitations under the License.
 
 import gzip
+import hashlib
 import os
 import re
 import shutil
 import tempfile
 import uuid
 from contextlib import contextmanager
-from functools import partial
+from functools import lru_cache, partial
 from pathlib import Path
 from typing import Any, Callable, Dict, IO, Iterable, Iterator, List, Optional, TextIO, Union
 from zipfile import ZipFile
@@ -27,37 +28,69 @@ from zipfile import ZipFile
 import numpy
 import pandas
 from bs4 import BeautifulSoup, Tag
-from pandas import DataFrame, Int64Dtype
+from pandas import DataFrame, Int64Dtype, Series
+from pandas.api.types import infer_dtype
 from tqdm import tqdm
 from unidecode import unidecode
 
-from .cast import column_converters, isna, safe_int_cast
+from .cast import cast_column, column_converters, isna, safe_int_cast
 from .constants import GLOBAL_DISABLE_PROGRESS
 
 
-def fuzzy_text(text: str, remove_regex: str = r"[^a-z\s]", remove_spaces: bool = True):
-    # TODO: handle bad inputs (like empty text)
-    text = unidecode(str(text)).lower()
-    for token in ("y", "and", "of"):
-        text = re.sub(f" {token} ", " ", text)
+# Maximum number of distinct inputs remembered by `fuzzy_text`
+FUZZY_TEXT_CACHE_SIZE = 1 << 16
+
+# Words removed from the text when they are found in between other words
+_FUZZY_TEXT_TOKENS = [f" {token} " for token in ("y", "and", "of")]
+
+# Words removed from the text when they are found at its start or its end, in order
+_FUZZY_TEXT_AFFIXES = [
+    re.compile(pattern)
+    for word in ("county", "region", "borough", "province", "department", "district")
+    for pattern in (f"^{word} ", f" {word}$")
+]
+
+_FUZZY_TEXT_SPACES = re.compile(r"\s+")
+
+
+@lru_cache(maxsize=FUZZY_TEXT_CACHE_SIZE)
+def _fuzzy_text(text: str, remove_regex: str, remove_spaces: bool) -> str:
+    text = unidecode(text).lower()
+    for token in _FUZZY_TEXT_TOKENS:
+        text = text.replace(token, " ")
     if remove_regex:
         text = re.sub(remove_regex, "", text)
-    text = re.sub(r"^county ", "", text)
-    text = re.sub(r" county$", "", text)
-    text = re.sub(r"^region ", "", text)
-    text = re.sub(r" region$", "", text)
-    text = re.sub(r"^borough ", "", text)
-    text = re.sub(r" borough$", "", text)
-    text = re.sub(r"^province ", "", text)
-    text = re.sub(r" province$", "", text)
-    text = re.sub(r"^department ", "", text)
-    text = re.sub(r" department$", "", text)
-    text = re.sub(r"^district ", "", text)
-    text = re.sub(r" district$", "", text)
-    text = re.sub(r"\s+", "" if remove_spaces else " ", text)
+    for affix in _FUZZY_TEXT_AFFIXES:
+        text = affix.sub("", text)
+    text = _FUZZY_TEXT_SPACES.sub("" if remove_spaces else " ", text)
     return text.strip()
 
 
+def fuzzy_text(text: str, remove_regex: str = r"[^a-z\s]", remove_spaces: bool = True):
+    # TODO: handle bad inputs (like empty text)
+    return _fuzzy_text(str(text), remove_regex, remove_spaces)
+
+
+def fuzzy_text_series(
+    values: Series, remove_regex: str = r"[^a-z\s]", remove_spaces: bool = True
+) -> Series:
+    """
+    Equivalent to `values.apply(fuzzy_text)`, but each distinct value is only normalized once and
+    the output is broadcast back to all the values which share it.
+
+    Arguments:
+        values: Series of values to normalize, which are converted to strings first.
+        remove_regex: Characters to ignore (and delete) from the values.
+        remove_spaces: Whether to remove all whitespace or collapse it into a single space.
+    Returns:
+        Series: Normalized values, with the same index as the input.
+    """
+    codes, uniques = pandas.factorize(values.astype(str))
+    fuzzy = [fuzzy_text(value, remove_regex, remove_spaces) for value in uniques]
+    fuzzy = numpy.array(fuzzy, dtype=object)
+    return Series(fuzzy[codes], index=values.index, name=values.name, dtype=object)
+
+
 def parse_dtype(dtype_name: str) -> Any:
     """
     Parse a dtype name into its pandas name. Only the following dtypes are supported in
@@ -239,6 +272,57 @@ def _format_call(format_func: Callable[[Any], str], val: Any) -> str:
     return "" if isna(val, skip_pandas_nan=True) else format_func(val)
 
 
+def _format_float_values(values: numpy.ndarray) -> numpy.ndarray:
+    """ Vectorized equivalent of formatting each value using `_dtype_formatter(float)` """
+    text = numpy.empty(len(values), dtype=object)
+
+    # Negative zero compares equal to zero, so it needs to be formatted separately
+    negative_zero = (values == 0) & numpy.signbit(values)
+    text[negative_zero] = "-0.0"
+
+    # Values are often repeated, so each of the unique values is only rounded and formatted once
+    unique_values, inverse = numpy.unique(values[~negative_zero], return_inverse=True)
+
+    # Numpy rounding only matches `round()` when the value has no more than 6 decimals already
+    rounded = numpy.round(unique_values, 6)
+    inexact = (numpy.abs(unique_values) >= 2 ** 33) | (rounded != unique_values)
+    if inexact.any():
+        rounded[inexact] = [round(value, 6) for value in unique_values[inexact].tolist()]
+
+    unique_text = numpy.array([str(value) for value in rounded.tolist()], dtype=object)
+    text[~negative_zero] = unique_text[inverse]
+    return text
+
+
+def _format_column(values: Series, dtype: Any) -> Series:
+    """
+    Vectorized equivalent of formatting each value of a column using `_format_call` with the
+    formatter from `_dtype_formatter(dtype)`.
+
+    Arguments:
+        values: Column to be formatted, already converted to the appropriate type.
+        dtype: dtype object.
+    Returns:
+        Series: Column with the string representation of each value, and empty string for nulls.
+    """
+    mask = values.notna().values
+    text = numpy.full(len(values), "", dtype=object)
+
+    if (dtype == "float" or dtype == float) and values.dtype == float:
+        text[mask] = _format_float_values(values.values[mask])
+    elif (dtype == "int" or isinstance(dtype, Int64Dtype)) and values.dtype.kind in "iu":
+        text[mask] = values.values[mask].astype(str)
+    elif (dtype == "int" or isinstance(dtype, Int64Dtype)) and isinstance(values.dtype, Int64Dtype):
+        text[mask] = values.to_numpy(dtype=numpy.int64, na_value=0)[mask].astype(str)
+    elif (dtype == "str" or dtype == str) and infer_dtype(values, skipna=True) == "string":
+        text[mask] = values.values[mask]
+    else:
+        format_func = partial(_format_call, _dtype_formatter(dtype))
+        return values.apply(format_func)
+
+    return Series(text, index=values.index)
+
+
 def export_csv(
     data: DataFrame, path: Union[Path, str] = None, schema: Dict[str, Any] = None, **csv_opts
 ) -> Optional[str]:
@@ -263,23 +347,16 @@ def export_csv(
     header = schema.keys() if schema is not None else data.columns
     header = [column for column in header if column in data.columns]
 
-    if schema is None:
-        formatters = {col: _dtype_formatter(str) for col in header}
-    else:
-        formatters = {col: _dtype_formatter(dtype) for col, dtype in schema.items()}
-
     # Convert all columns to appropriate type
-    for column, converter in column_converters(schema or {}).items():
+    for column, dtype in (schema or {}).items():
         if column in header:
-            converter = partial(converter, skip_pandas_nan=True)
-            data[column] = data[column].fillna(numpy.nan).apply(converter)
+            data[column] = cast_column(data[column].fillna(numpy.nan), dtype)
 
     # Format the data as a string one column at a time
     data_fmt = DataFrame(columns=header, index=data.index)
-    for column, format_func in formatters.items():
-        if column in header:
-            map_func = partial(_format_call, format_func)
-            data_fmt[column] = data[column].apply(map_func)
+    for column in header:
+        dtype = schema[column] if schema is not None else str
+        data_fmt[column] = _format_column(data[column], dtype)
 
     return data_fmt.to_csv(path_or_buf=path, index=False, **csv_opts)
 
@@ -343,6 +420,23 @@ def temporary_file(file_name: str = None) -> Iterator[Path]:
         yield file_path
 
 
+def file_digest(path: Union[Path, str], block_size: int = 2 ** 20) -> str:
+    """
+    Computes a hash of the contents of a file, reading it in blocks to keep memory usage constant.
+
+    Arguments:
+        path: Location of the file to be hashed.
+        block_size: Number of bytes read from the file at a time.
+    Returns:
+        str: Hex digest of the SHA-256 hash of the file contents.
+    """
+    digest = hashlib.sha256()
+    with open(path, "rb") as fd:
+        for block in iter(lambda: fd.read(block_size), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
 def gzip_file(file_in: Union[Path, str, IO], file_out: Union[Path, str]) -> None:
     """
     Compress a single file into a GZIP archive.
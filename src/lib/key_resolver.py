@@ -0,0 +1,280 @@
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import re
+from typing import Any, Dict, List, Optional, Pattern, Tuple
+
+import numpy
+from pandas import DataFrame, Series, isna
+
+from .io import fuzzy_text, fuzzy_text_series
+
+
+# Columns used to filter the metadata table, in the same order as `DataSource.merge`
+METADATA_FILTER_COLUMNS = tuple(
+    f"{prefix}_{suffix}"
+    for prefix in ("country", "subregion1", "subregion2", "locality")
+    for suffix in ("code", "name")
+)
+
+# Subregion columns compared against the match string, in order of precedence
+MATCH_STRING_COLUMN_PREFIXES = ("subregion1", "subregion2", "locality")
+
+# Sentinel used to represent null values in the hash map keys, since NaN != NaN
+_NULL = ("__null__",)
+
+# Flags used to describe how a record constrains each metadata column
+_FILTER_NULL, _FILTER_EQUAL = 0, 1
+
+_EMPTY = numpy.empty(0, dtype=int)
+
+
+def _hashable(value: Any) -> Any:
+    return _NULL if isna(value) else value
+
+
+def _build_value_map(values: Series) -> Dict[Any, numpy.ndarray]:
+    """ Maps each non-null value to the positions where it appears in `values` """
+    positions: Dict[Any, List[int]] = {}
+    for idx, value in enumerate(values):
+        if not isna(value):
+            positions.setdefault(value, []).append(idx)
+    return {value: numpy.array(idx_list) for value, idx_list in positions.items()}
+
+
+class KeyResolver:
+    """
+    Prebuilt index over the metadata table used to resolve location keys for many records at
+    once. It returns the same keys as `DataSource.merge` would for each individual record, but
+    replaces the repeated boolean masking of the metadata table with hash lookups and tests all
+    the `match_string` regular expressions through a single combined pattern first.
+
+    The index is built lazily: the hash map for a given combination of filter columns is only
+    created the first time a record constrained by those columns is resolved, and then reused.
+    """
+
+    def __init__(self, metadata: DataFrame):
+        metadata = metadata.reset_index(drop=True)
+        self._size = len(metadata)
+        self._keys = metadata["key"].values
+        self._known_keys = set(self._keys)
+
+        # Keep the raw column values around to verify constraints without masking the table
+        self._columns: Dict[str, numpy.ndarray] = {
+            col: metadata[col].values for col in METADATA_FILTER_COLUMNS if col in metadata.columns
+        }
+        self._nulls: Dict[str, numpy.ndarray] = {
+            col: metadata[col].isna().values for col in self._columns
+        }
+
+        # Fuzzy columns are normally precomputed by the pipeline, but compute them if missing
+        def _fuzzy_column(column: str) -> Series:
+            if column not in metadata.columns:
+                return Series([None] * self._size, dtype=object)
+            if f"{column}_fuzzy" in metadata.columns:
+                return metadata[f"{column}_fuzzy"]
+            return fuzzy_text_series(metadata[column])
+
+        # Hash maps used to compare the match string against the different columns
+        match_string = metadata.get("match_string", Series([None] * self._size, dtype=object))
+        self._match_maps: Dict[str, Dict[Any, numpy.ndarray]] = {
+            "match_string_fuzzy": _build_value_map(_fuzzy_column("match_string")),
+            "match_string": _build_value_map(match_string),
+        }
+        for prefix in MATCH_STRING_COLUMN_PREFIXES:
+            code_values = metadata.get(f"{prefix}_code", Series([None] * self._size))
+            self._match_maps[f"{prefix}_code"] = _build_value_map(code_values)
+            self._match_maps[f"{prefix}_name_fuzzy"] = _build_value_map(
+                _fuzzy_column(f"{prefix}_name")
+            )
+
+        # Compile each regex only once, plus a combined pattern to quickly discard non-matches
+        self._regex_positions: List[int] = []
+        self._regex_patterns: List[Pattern] = []
+        for idx, pattern in enumerate(match_string):
+            if isna(pattern):
+                continue
+            try:
+                self._regex_patterns.append(re.compile(pattern, re.IGNORECASE))
+                self._regex_positions.append(idx)
+            except re.error:
+                continue
+        self._regex_positions = numpy.array(self._regex_positions, dtype=int)
+
+        # Patterns with groups are left out of the combined pattern, since their group numbers
+        # would change and any backreferences would no longer point to the right group
+        self._regex_grouped = numpy.array(
+            [regex.groups > 0 for regex in self._regex_patterns], dtype=bool
+        )
+        try:
+            combined = "|".join(
+                f"(?:{regex.pattern})"
+                for regex, grouped in zip(self._regex_patterns, self._regex_grouped)
+                if not grouped
+            )
+            self._regex_combined: Optional[Pattern] = re.compile(combined, re.IGNORECASE)
+        except re.error:
+            self._regex_combined = None
+        self._regex_cache: Dict[str, numpy.ndarray] = {}
+
+        # Hash maps of <filter values tuple, positions> keyed by the tuple of filter columns
+        self._filter_maps: Dict[Tuple[str, ...], Dict[Tuple, numpy.ndarray]] = {}
+
+    def _filter_map(self, columns: Tuple[str, ...]) -> Dict[Tuple, numpy.ndarray]:
+        if columns not in self._filter_maps:
+            groups: Dict[Tuple, List[int]] = {}
+            column_values = [self._columns[col] for col in columns]
+            for idx, values in enumerate(zip(*column_values)):
+                groups.setdefault(tuple(map(_hashable, values)), []).append(idx)
+            self._filter_maps[columns] = {
+                key: numpy.array(idx_list) for key, idx_list in groups.items()
+            }
+        return self._filter_maps[columns]
+
+    def _regex_matches(self, search_string: Any) -> numpy.ndarray:
+        """ Positions of the metadata rows whose `match_string` regex matches the input """
+        if not isinstance(search_string, str):
+            return _EMPTY
+        if search_string not in self._regex_cache:
+            # Patterns with groups are always tested, the rest only if the combined pattern matches
+            candidates = self._regex_grouped
+            if self._regex_combined is None or self._regex_combined.match(search_string):
+                candidates = numpy.ones(len(self._regex_patterns), dtype=bool)
+            mask = numpy.zeros(len(self._regex_patterns), dtype=bool)
+            for idx in numpy.flatnonzero(candidates):
+                mask[idx] = bool(self._regex_patterns[idx].match(search_string))
+            self._regex_cache[search_string] = self._regex_positions[mask]
+        return self._regex_cache[search_string]
+
+    def _constraints(self, record: Dict[str, Any]) -> List[Tuple[str, int, Any]]:
+        constraints = []
+        for column in self._columns:
+            if column not in record:
+                continue
+            value = record[column]
+            if isna(value):
+                constraints.append((column, _FILTER_NULL, None))
+            elif value:
+                constraints.append((column, _FILTER_EQUAL, value))
+        return constraints
+
+    def _candidates(self, constraints: List[Tuple[str, int, Any]]) -> numpy.ndarray:
+        """ Positions of the metadata rows satisfying all constraints """
+        if not constraints:
+            return numpy.arange(self._size)
+        columns = tuple(column for column, _, _ in constraints)
+        lookup = tuple(_NULL if flag == _FILTER_NULL else value for _, flag, value in constraints)
+        return self._filter_map(columns).get(lookup, _EMPTY)
+
+    def _satisfies(
+        self, positions: numpy.ndarray, constraints: List[Tuple[str, int, Any]]
+    ) -> numpy.ndarray:
+        """ Subset of `positions` for which the metadata rows satisfy all constraints """
+        mask = numpy.ones(len(positions), dtype=bool)
+        for column, flag, value in constraints:
+            if flag == _FILTER_NULL:
+                mask &= self._nulls[column][positions]
+            else:
+                mask &= self._columns[column][positions] == value
+        return positions[mask]
+
+    def lookup(self, record: Dict[str, Any]) -> Optional[str]:
+        """
+        Outputs the key for a single record, following the same rules as `DataSource.merge`.
+
+        Arguments:
+            record: Mapping of column names to values for the record being resolved.
+        Returns:
+            Optional[str]: The matched key, or None if no unambiguous match is found.
+        """
+        # Exact key match might be possible and it's the fastest option
+        if "key" in record and not isna(record["key"]):
+            return record["key"] if record["key"] in self._known_keys else None
+
+        # Start by filtering the auxiliary dataset as much as possible
+        constraints = self._constraints(record)
+        candidates = self._candidates(constraints)
+
+        # Auxiliary dataset might have a single record left, then we are done
+        if len(candidates) == 1:
+            return self._keys[candidates[0]]
+
+        if "match_string" not in record:
+            return None
+
+        def _unique_match(positions: numpy.ndarray) -> Optional[str]:
+            positions = self._satisfies(positions, constraints)
+            return self._keys[positions[0]] if len(positions) == 1 else None
+
+        # Provided match string could be identical to `match_string` (or with simple fuzzy match)
+        raw_string = record["match_string"]
+        match_string = fuzzy_text(raw_string)
+        lookups = [
+            ("match_string_fuzzy", match_string),
+            ("match_string", raw_string),
+        ]
+
+        # Provided match string could be a subregion code / name
+        for column_prefix in MATCH_STRING_COLUMN_PREFIXES:
+            lookups.append((f"{column_prefix}_code", raw_string))
+            lookups.append((f"{column_prefix}_name_fuzzy", match_string))
+
+        for map_name, value in lookups:
+            key = _unique_match(self._match_maps[map_name].get(_hashable(value), _EMPTY))
+            if key is not None:
+                return key
+
+        # Last resort is to match the `match_string` column with a regex from aux
+        for search_string in (match_string, raw_string):
+            key = _unique_match(self._regex_matches(search_string))
+            if key is not None:
+                return key
+
+        return None
+
+    @staticmethod
+    def match_columns(columns: List[str]) -> List[str]:
+        """ Subset of `columns` used to match records, in the order they are compared """
+        candidates = ("key",) + METADATA_FILTER_COLUMNS + ("match_string",)
+        return [col for col in candidates if col in columns]
+
+    def resolve(self, data: DataFrame) -> Tuple[Series, DataFrame]:
+        """
+        Resolves the keys for all records in `data` in a single batched pass. Records which share
+        the same values for all the columns relevant to matching are only resolved once.
+
+        Arguments:
+            data: Table with any of the columns used by `DataSource.merge` to match records.
+        Returns:
+            Tuple[Series, DataFrame]: The keys aligned with the index of `data`, with None for
+                records that could not be matched, and the subset of `data` that was unmatched.
+        """
+        match_columns = self.match_columns(data.columns)
+
+        # Without any match columns, all records are resolved the same way
+        if not match_columns:
+            keys = Series([self.lookup({})] * len(data), index=data.index, dtype=object)
+            return keys, data[keys.isna()]
+
+        # Resolve each unique combination of match column values only once
+        cache: Dict[Tuple, Optional[str]] = {}
+        keys = []
+        for values in zip(*[data[col].values for col in match_columns]):
+            cache_key = tuple(map(_hashable, values))
+            if cache_key not in cache:
+                cache[cache_key] = self.lookup(dict(zip(match_columns, values)))
+            keys.append(cache[cache_key])
+
+        keys = Series(keys, index=data.index, dtype=object)
+        return keys, data[keys.isna()]
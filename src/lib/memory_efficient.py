@@ -13,20 +13,27 @@
 # limitations under the License.
 
 import csv
+import heapq
 import json
+import math
 import shutil
-import warnings
+from functools import partial
 from pathlib import Path
-from typing import Dict, Iterable, List, TextIO
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Optional, TextIO, Tuple
 
-from .io import line_reader, open_file_like, read_table, temporary_directory, temporary_file
+from .cast import column_converters, safe_float_cast
+from .concurrent import process_map
+from .io import line_reader, open_file_like, temporary_directory, temporary_file
 
 
-# Any CSV file under 100 MB can use the fast in-memory JSON converter
-JSON_FAST_CONVERTER_SIZE_BYTES = 100 * 1000 * 1000
+# Default amount of memory used to hold records while sorting a table
+TABLE_SORT_MEMORY_BUDGET_BYTES = 500 * 1000 * 1000
 
-# Any CSV file above 1 GB should not be converted to JSON
-JSON_MAX_SIZE_BYTES = 1 * 1000 * 1000 * 1000
+# Approximate memory used by each value of a record, in addition to its characters
+RECORD_VALUE_OVERHEAD_BYTES = 64
+
+# Maximum number of sorted runs merged at once, which are all open at the same time
+TABLE_SORT_MAX_MERGE_FANIN = 64
 
 
 def skip_head_reader(file_handle: TextIO, skip_count: int = 1, **read_opts) -> Iterable[str]:
@@ -51,16 +58,64 @@ def get_table_columns(table_path: Path) -> List[str]:
         return list(next(reader))
 
 
-def table_sort(table_path: Path, output_path: Path, sort_columns: List[str] = None) -> None:
+def _record_size(record: List[str]) -> int:
+    """ Rough estimate of the memory used by a record read by `csv.reader` """
+    return sum(len(value) for value in record) + RECORD_VALUE_OVERHEAD_BYTES * len(record)
+
+
+def _read_sort_run(run_path: Path) -> Iterator[List[str]]:
+    with open(run_path, "r", newline="") as fd:
+        yield from csv.reader(fd)
+
+
+def _write_sort_run(run_path: Path, records: Iterable[List[str]]) -> None:
+    with open(run_path, "w", newline="") as fd:
+        csv.writer(fd).writerows(records)
+
+
+def _sort_run(run_path: Path, sort_indices: List[int]) -> Path:
+    """ Sorts the records of a run in place, used to generate sorted runs in parallel """
+    records = list(_read_sort_run(run_path))
+    records.sort(key=lambda x: tuple([x[idx] for idx in sort_indices]))
+    _write_sort_run(run_path, records)
+    return run_path
+
+
+def _merge_sort_runs(run_paths: List[Path], output_path: Path, sort_key: Callable) -> Path:
+    """ Merges the sorted runs, in order, into a single run and then deletes them """
+    merge_inputs = [_read_sort_run(run_path) for run_path in run_paths]
+    _write_sort_run(output_path, heapq.merge(*merge_inputs, key=sort_key))
+    for run_path in run_paths:
+        run_path.unlink()
+    return output_path
+
+
+def table_sort(
+    table_path: Path,
+    output_path: Path,
+    sort_columns: List[str] = None,
+    memory_budget: int = TABLE_SORT_MEMORY_BUDGET_BYTES,
+    process_count: int = 1,
+    max_merge_fanin: int = TABLE_SORT_MAX_MERGE_FANIN,
+) -> None:
     """
     Memory-efficient method used to perform a lexical sort of all the rows of this table, excluding
-    the table header. This puts the entire table in memory, so it's not exactly memory efficient but
-    it's still better than using pandas.
+    the table header. The sort is stable, so rows with equal values in `sort_columns` keep the
+    same relative order as in the input.
+
+    Tables which do not fit within `memory_budget` are sorted externally: the rows are split into
+    runs which are sorted individually and spilled to temporary files, and then the runs are
+    combined using k-way merges which only hold one record from each run in memory. When there are
+    more than `max_merge_fanin` runs, they are merged in several passes.
 
     Arguments:
         table_path: Path of the table to be sorted.
         output_path: Output location for the sorted table.
-        sort_columns: Columns used to sort by, defaults to all.
+        sort_columns: Columns used to sort by, defaults to the first column.
+        memory_budget: Approximate number of bytes of records to hold in memory at once, which is
+            split across all the processes when sorting runs in parallel.
+        process_count: Maximum number of processes used to sort the runs in parallel.
+        max_merge_fanin: Maximum number of runs merged at once.
     """
     columns = {name: idx for idx, name in enumerate(get_table_columns(table_path))}
     if not sort_columns:
@@ -69,18 +124,127 @@ def table_sort(table_path: Path, output_path: Path, sort_columns: List[str] = No
         col in columns for col in sort_columns
     ), f"Not all columns in input present from list {sort_columns}"
     sort_indices = [columns[name] for name in sort_columns]
+    sort_key = lambda x: tuple([x[idx] for idx in sort_indices])
 
-    records = []
-    with open_file_like(table_path, "r") as fd:
-        for record in csv.reader(skip_head_reader(fd, skip_empty=True)):
-            records.append(record)
+    # Each process sorting runs in parallel holds a whole run in memory
+    run_budget = memory_budget // max(1, process_count)
+    assert max_merge_fanin > 1, f"Merge fan-in must be greater than 1, found {max_merge_fanin}"
+
+    with temporary_directory() as workdir:
+
+        # Read records until the memory budget is exhausted, and then spill them into a run
+        run_paths = []
+        records = []
+        records_size = 0
+        with open_file_like(table_path, "r") as fd:
+            for record in csv.reader(skip_head_reader(fd, skip_empty=True)):
+                records.append(record)
+                records_size += _record_size(record)
+                if records_size >= run_budget:
+                    run_paths.append(workdir / f"run_{len(run_paths)}.csv")
+                    if process_count <= 1:
+                        records.sort(key=sort_key)
+                    _write_sort_run(run_paths[-1], records)
+                    records = []
+                    records_size = 0
+
+        # Runs written without sorting are sorted in parallel
+        if run_paths and process_count > 1:
+            map_func = partial(_sort_run, sort_indices=sort_indices)
+            map_opts = dict(max_workers=process_count, desc="Sorting table runs")
+            run_paths = list(process_map(map_func, run_paths, **map_opts))
+
+        # Merge consecutive runs until few enough remain, which keeps the original order of runs
+        merge_pass = 0
+        while len(run_paths) > max_merge_fanin:
+            run_paths = [
+                _merge_sort_runs(
+                    run_paths[idx : idx + max_merge_fanin],
+                    workdir / f"merge_{merge_pass}_{idx}.csv",
+                    sort_key,
+                )
+                for idx in range(0, len(run_paths), max_merge_fanin)
+            ]
+            merge_pass += 1
+
+        # Since runs are merged in order, rows with equal keys preserve their original order
+        records.sort(key=sort_key)
+        merge_inputs = [_read_sort_run(run_path) for run_path in run_paths] + [records]
+
+        with open_file_like(output_path, mode="w") as fd_out:
+            writer = csv.writer(fd_out)
+            writer.writerow(columns.keys())
+            writer.writerows(heapq.merge(*merge_inputs, key=sort_key))
+
+
+def table_is_sorted(table_path: Path, sort_columns: List[str]) -> bool:
+    """
+    Memory-efficient method used to check whether the rows of a table are lexically sorted by the
+    given columns.
+
+    Arguments:
+        table_path: Path of the table to be checked.
+        sort_columns: Columns which the table is expected to be sorted by.
+    Returns:
+        bool: True if the rows are sorted by `sort_columns`, False otherwise.
+    """
+    with open_file_like(table_path, mode="r") as fd:
+        reader = csv.reader(line_reader(fd, skip_empty=True))
+        columns = {name: idx for idx, name in enumerate(next(reader))}
+        sort_indices = [columns[name] for name in sort_columns if name in columns]
+
+        last_key = None
+        for record in reader:
+            key = tuple([record[idx] for idx in sort_indices])
+            if last_key is not None and key < last_key:
+                return False
+            last_key = key
+
+    return True
+
+
+def _sorted_table_records(
+    table_path: Path, sort_columns: List[str], output_columns: List[str]
+) -> Iterator[Tuple[Tuple[str, ...], List[Optional[str]]]]:
+    """
+    Reads the records of a sorted table as pairs of <sort key, values of `output_columns`>. No
+    records are output if any of the sort columns is missing from the table.
+    """
+    with open_file_like(table_path, mode="r") as fd:
+        reader = csv.reader(line_reader(fd, skip_empty=True))
+        columns = {name: idx for idx, name in enumerate(next(reader))}
+        if not all(name in columns for name in sort_columns):
+            return
+
+        sort_indices = [columns[name] for name in sort_columns]
+        output_indices = [columns.get(name) for name in output_columns]
+
+        last_key = None
+        for record in reader:
+            key = tuple([record[idx] for idx in sort_indices])
+            if last_key is not None and key < last_key:
+                raise RuntimeError(f"Table {table_path} was not sorted by {sort_columns}")
+            last_key = key
+            yield key, [(None if idx is None else record[idx]) for idx in output_indices]
 
-    with open_file_like(output_path, mode="w") as fd_out:
-        writer = csv.writer(fd_out)
-        writer.writerow(columns.keys())
 
-        for record in sorted(records, key=lambda x: tuple([x[idx] for idx in sort_indices])):
-            writer.writerow(record)
+def table_merge_sorted(
+    tables: List[Path], sort_columns: List[str], output_columns: List[str]
+) -> Iterator[Tuple[Tuple[str, ...], List[Optional[str]]]]:
+    """
+    Performs a k-way merge of tables which are already sorted by `sort_columns`, reading a single
+    record at a time from each of them. Records with the same sort key are output in the same
+    order as `tables`, and preserve their relative order within each table.
+
+    Arguments:
+        tables: List of paths for the sorted CSV files being merged.
+        sort_columns: Columns which all the tables are sorted by.
+        output_columns: Columns to output for each record, using None when missing from a table.
+    Returns:
+        Iterator[Tuple[Tuple[str, ...], List[Optional[str]]]]: Pairs of <sort key, record values>.
+    """
+    readers = [_sorted_table_records(table, sort_columns, output_columns) for table in tables]
+    yield from heapq.merge(*readers, key=lambda item: item[0])
 
 
 def table_join(
@@ -468,62 +632,70 @@ def table_concat(tables: List[Path], output_path: Path) -> None:
                     csv_writer.writerow(record)
 
 
-def _convert_csv_to_json_records_slow(schema: Dict[str, type], csv_file: Path, output_file) -> None:
+def _json_value_converters(schema: Dict[str, type], columns: List[str]) -> List[Callable]:
     """
-    Slow but memory efficient method to convert the provided CSV file to a record-like JSON format
+    Converters for each of the `columns` which output JSON-serializable values, using the types
+    from `schema`. Non-finite numbers are output as null, and columns which are not part of the
+    schema are output as strings with null for empty values.
     """
-    with open_file_like(output_file, mode="w") as fd_out:
-        # Write the header first
-        columns = get_table_columns(csv_file)
-        columns_str = ",".join([f'"{col}"' for col in columns])
-        fd_out.write(f'{{"columns":[{columns_str}],"data":[')
+    converters = column_converters({col: schema[col] for col in columns if col in schema})
+
+    def _default_convert(value: str) -> Optional[str]:
+        return None if value == "" else value
 
-        # Read the CSV file in chunks but keep only the values
-        first_record = True
-        for chunk in read_table(csv_file, schema=schema, chunksize=256):
-            if first_record:
-                first_record = False
-            else:
-                fd_out.write(",")
-            fd_out.write(chunk.to_json(orient="values")[1:-1])
+    def _finite(cast_func: Callable) -> Callable:
+        def _convert(value: str) -> Any:
+            value = cast_func(value)
+            return value if value is None or math.isfinite(value) else None
 
-        fd_out.write("]}")
+        return _convert
 
+    value_converters = []
+    for col in columns:
+        cast_func = converters.get(col, _default_convert)
+        if cast_func is safe_float_cast:
+            cast_func = _finite(cast_func)
+        value_converters.append(cast_func)
+    return value_converters
 
-def _convert_csv_to_json_records_fast(
+
+def _convert_csv_to_json_records_streaming(
     schema: Dict[str, type], csv_file: Path, output_file: Path
 ) -> None:
     """
-    Fast but memory intensive method to convert the provided CSV file to a record-like JSON format
+    Fast and memory efficient method to convert the provided CSV file to a record-like JSON format,
+    which reads and writes a single record at a time.
     """
-    table = read_table(csv_file, schema=schema)
-    json_dict = json.loads(table.to_json(orient="split"))
-    del json_dict["index"]
-    with open_file_like(output_file, mode="w") as fd:
-        json.dump(json_dict, fd)
+    encode = json.JSONEncoder(separators=(",", ":"), allow_nan=False).encode
+    with open_file_like(csv_file, mode="r") as fd_in, open_file_like(output_file, mode="w") as fd:
+        reader = csv.reader(line_reader(fd_in, skip_empty=True))
+        columns = next(reader)
+        converters = _json_value_converters(schema, columns)
+
+        # Write the header first, then each record as a list of values
+        fd.write(f'{{"columns":{encode(columns)},"data":[')
+        for idx, record in enumerate(reader):
+            if idx > 0:
+                fd.write(",")
+            fd.write(encode([convert(value) for convert, value in zip(converters, record)]))
+        fd.write("]}")
 
 
 def convert_csv_to_json_records(
-    schema: Dict[str, type],
-    csv_file: Path,
-    output_file: Path,
-    skip_size_threshold: int = None,
-    fast_size_threshold: int = None,
+    schema: Dict[str, type], csv_file: Path, output_file: Path, skip_size_threshold: int = None
 ) -> None:
+    """
+    Converts the provided CSV file to a record-like JSON format in a single streaming pass, so the
+    memory usage does not depend on the size of the file.
 
-    if skip_size_threshold is None:
-        skip_size_threshold = JSON_MAX_SIZE_BYTES
-    if fast_size_threshold is None:
-        fast_size_threshold = JSON_FAST_CONVERTER_SIZE_BYTES
-
+    Arguments:
+        schema: Dictionary of <column, dtype> used to convert the values of each column.
+        csv_file: Path of the CSV file being converted.
+        output_file: Path of the resulting JSON file.
+        skip_size_threshold: Optional size in bytes above which files are not converted.
+    """
     file_size = csv_file.stat().st_size
-    json_coverter_method = _convert_csv_to_json_records_fast
-
-    if skip_size_threshold > 0 and file_size > skip_size_threshold:
+    if skip_size_threshold and file_size > skip_size_threshold:
         raise ValueError(f"Size of {csv_file} too large for conversion: {file_size // 1E6} MB")
 
-    if fast_size_threshold > 0 and file_size > fast_size_threshold:
-        warnings.warn(f"Size of {csv_file} too large for fast method: {file_size // 1E6} MB")
-        json_coverter_method = _convert_csv_to_json_records_slow
-
-    json_coverter_method(schema, csv_file, output_file)
+    _convert_csv_to_json_records_streaming(schema, csv_file, output_file)
@@ -13,18 +13,117 @@
 # limitations under the License.
 
 import datetime
+import json
+import os
+import threading
 import time
 import uuid
 from pathlib import Path
-from typing import Any, BinaryIO, Dict, List, Optional, Union
+from typing import Any, BinaryIO, Callable, Dict, Iterable, List, Optional, Union
+from urllib.parse import urlparse
 
 import requests
+from requests.adapters import HTTPAdapter
 from .concurrent import thread_map
 from .error_logger import ErrorLogger
 from .io import pbar, open_file_like
 from .time import date_today
 
 
+# Size of the chunks written to disk while downloading a file
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+
+# Maximum number of connections kept open to each host
+SESSION_POOL_SIZE = 32
+
+# Maximum number of days after the last date that worked for a URL template checked one by one
+DATE_PROBE_LINEAR_DAYS = 7
+
+# Sessions are shared by all downloads to the same host, so connections can be reused
+_sessions: Dict[str, requests.Session] = {}
+_sessions_lock = threading.Lock()
+
+
+def get_session(url: str) -> requests.Session:
+    """
+    Outputs the session used for all requests made to the host of `url`, which keeps a pool of
+    connections to that host open between requests.
+
+    Args:
+        url: URL which will be requested using the session.
+
+    Returns:
+        requests.Session: Session shared by all requests to the same host.
+    """
+    host = urlparse(url).netloc
+    with _sessions_lock:
+        if host not in _sessions:
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=SESSION_POOL_SIZE)
+            session = requests.Session()
+            session.mount("http://", adapter)
+            session.mount("https://", adapter)
+            _sessions[host] = session
+        return _sessions[host]
+
+
+def _validators_path(file_path: Path) -> Path:
+    return file_path.parent / f"{file_path.name}.validators.json"
+
+
+def _read_validators(file_path: Path, url: str) -> Dict[str, str]:
+    """ Conditional request headers for the snapshot at `file_path` if downloaded from `url` """
+    validators_path = _validators_path(file_path)
+    if not file_path.exists() or not validators_path.exists():
+        return {}
+    try:
+        with open(validators_path, "r") as fd:
+            validators = json.load(fd)
+    except Exception:
+        return {}
+    if validators.get("url") != url:
+        return {}
+
+    headers = {}
+    if validators.get("etag"):
+        headers["If-None-Match"] = validators["etag"]
+    if validators.get("last_modified"):
+        headers["If-Modified-Since"] = validators["last_modified"]
+    return headers
+
+
+def _write_validators(file_path: Path, url: str, response: requests.Response) -> None:
+    """ Saves the cache validators from `response`, or removes them if there are none """
+    validators_path = _validators_path(file_path)
+    validators = {
+        "url": url,
+        "etag": response.headers.get("ETag"),
+        "last_modified": response.headers.get("Last-Modified"),
+    }
+    if validators["etag"] or validators["last_modified"]:
+        with open(validators_path, "w") as fd:
+            json.dump(validators, fd)
+    elif validators_path.exists():
+        validators_path.unlink()
+
+
+def snapshot_path(url: str, output_folder: Path, ext: str = None) -> Path:
+    """
+    Outputs the deterministic path in the snapshots folder where the contents of `url` are
+    downloaded to by `download_snapshot`.
+
+    Args:
+        url: URL to download a resource from
+        output_folder: Root folder where snapshot, intermediate and tables will be placed.
+        ext: Force extension when creating output file, handy when it cannot be guessed from URL.
+
+    Returns:
+        Path: Location of the snapshot for the given URL.
+    """
+    if ext is None:
+        ext = url.split(".")[-1]
+    return output_folder / "snapshot" / ("%s.%s" % (uuid.uuid5(uuid.NAMESPACE_DNS, url), ext))
+
+
 def download_snapshot(
     url: str,
     output_folder: Path,
@@ -62,9 +161,7 @@ def download_snapshot(
     (output_folder / "snapshot").mkdir(parents=True, exist_ok=True)
 
     # Create a deterministic file name
-    if ext is None:
-        ext = url.split(".")[-1]
-    file_path = output_folder / "snapshot" / ("%s.%s" % (uuid.uuid5(uuid.NAMESPACE_DNS, url), ext))
+    file_path = snapshot_path(url, output_folder, ext=ext)
 
     # If we are told to skip download and the file already exist, early exit
     if skip_existing and file_path.exists():
@@ -95,23 +192,162 @@ def _download_snapshot_simple(
     logger: ErrorLogger = ErrorLogger(),
     **download_opts,
 ) -> Optional[str]:
-    """See: download_snapshot for argument descriptions."""
-    with open(file_path, "wb") as file_handle:
-        try:
-            logger.log_info(f"Downloading {url}")
-            download(url, file_handle, **download_opts)
-        except Exception as exc:
-            # In case of failure, delete the file
-            file_path.unlink()
-            if ignore_failure:
-                return None
-            else:
-                raise exc
+    """
+    See: download_snapshot for argument descriptions. If the snapshot was previously downloaded
+    from the same URL, the request is made conditional on the contents having changed, and the
+    existing file is reused if the server responds with 304 Not Modified.
+    """
+    # Write into a temporary file, so the existing snapshot is kept if nothing is downloaded. The
+    # temporary file is only created once the server responds with new contents.
+    temp_path = file_path.parent / f"{file_path.name}.{os.getpid()}.{threading.get_ident()}.tmp"
+    headers = {**_read_validators(file_path, url), **download_opts.pop("headers", {})}
+    try:
+        logger.log_info(f"Downloading {url}")
+        response = download(url, temp_path, headers=headers, **download_opts)
+    except Exception as exc:
+        # In case of failure, delete the partial download but keep any previous snapshot
+        if temp_path.exists():
+            temp_path.unlink()
+        if ignore_failure:
+            return None
+        else:
+            raise exc
+
+    if response.status_code == 304:
+        logger.log_info(f"Snapshot of {url} not modified")
+    else:
+        os.replace(temp_path, file_path)
+        _write_validators(file_path, url, response)
 
     # Output the downloaded file path
     return str(file_path.absolute())
 
 
+def _date_state_path(file_path: Path) -> Path:
+    return file_path.parent / f"{file_path.name}.date.json"
+
+
+def _read_date_state(file_path: Path, url: str) -> Optional[datetime.date]:
+    """ Reads the last date which worked for the URL template downloaded into `file_path` """
+    state_path = _date_state_path(file_path)
+    try:
+        with open(state_path, "r") as fd:
+            state = json.load(fd)
+        if state.get("url") == url:
+            return datetime.date.fromisoformat(state["date"])
+    except Exception:
+        pass
+    return None
+
+
+def _write_date_state(file_path: Path, url: str, date: datetime.date) -> None:
+    with open(_date_state_path(file_path), "w") as fd:
+        json.dump({"url": url, "date": date.isoformat()}, fd)
+
+
+def url_probe(
+    spoof_browser: bool = True, timeout: int = 60, **download_opts
+) -> Callable[[str], bool]:
+    """
+    Creates a function which checks whether a URL exists, using HEAD requests unless the server
+    does not support them, in which case a GET request is made without reading its contents.
+
+    Args:
+        spoof_browser: Pretend to be a web browser by adding user agent string to headers.
+        timeout: Number of seconds to wait for a response.
+        download_opts: Other download options, which are ignored.
+
+    Returns:
+        Callable[[str], bool]: Function which outputs whether the given URL can be downloaded,
+            which is false if the server cannot be reached.
+    """
+    headers = {"User-Agent": "Safari"} if spoof_browser else {}
+    request_options = dict(headers=headers, allow_redirects=True, timeout=timeout)
+    use_head = True
+
+    def _probe(url: str) -> bool:
+        nonlocal use_head
+        session = get_session(url)
+        try:
+            if use_head:
+                with session.head(url, **request_options) as response:
+                    if response.status_code not in (403, 405, 501):
+                        return response.ok
+                use_head = False
+
+            with session.get(url, stream=True, **request_options) as response:
+                return response.ok
+
+        # URLs which cannot be reached, like when the connection fails or times out, do not exist
+        except requests.exceptions.RequestException:
+            return False
+
+    return _probe
+
+
+def _gallop_latest_date(
+    exists: Callable[[datetime.date], bool], min_date: datetime.date, max_date: datetime.date
+) -> Optional[datetime.date]:
+    """
+    Gallops backwards from `max_date` in exponentially increasing steps until a date for which
+    `exists` is true is found, and then performs a binary search between that date and the last
+    one which did not exist. This assumes that all dates before an existing one also exist.
+    """
+    missing_date, step = None, 1
+    cur_date = max_date
+    while not exists(cur_date):
+        missing_date = cur_date
+        if cur_date <= min_date:
+            return None
+        cur_date = max(min_date, max_date - datetime.timedelta(days=step))
+        step *= 2
+
+    if missing_date is not None:
+        while (missing_date - cur_date).days > 1:
+            mid_date = cur_date + datetime.timedelta(days=(missing_date - cur_date).days // 2)
+            if exists(mid_date):
+                cur_date = mid_date
+            else:
+                missing_date = mid_date
+
+    return cur_date
+
+
+def _latest_date(
+    exists: Callable[[datetime.date], bool],
+    min_date: datetime.date,
+    max_date: datetime.date,
+    hint: Optional[datetime.date] = None,
+) -> Optional[datetime.date]:
+    """
+    Finds the most recent date between `min_date` and `max_date` for which `exists` is true. If a
+    `hint` of a date which existed before is given, only the dates after it are searched unless
+    the hint itself no longer exists.
+    """
+    if hint is not None and min_date <= hint <= max_date:
+        # Check the few dates after a recent hint one by one, starting from the most recent
+        if (max_date - hint).days <= DATE_PROBE_LINEAR_DAYS:
+            cur_date = max_date
+            while cur_date > hint:
+                if exists(cur_date):
+                    return cur_date
+                cur_date -= datetime.timedelta(days=1)
+            if exists(hint):
+                return hint
+
+        # Otherwise use the hint as the lower bound of the search
+        else:
+            cur_date = _gallop_latest_date(exists, hint, max_date)
+            if cur_date is not None:
+                return cur_date
+
+        max_date = hint - datetime.timedelta(days=1)
+
+    if max_date < min_date:
+        return None
+    return _gallop_latest_date(exists, min_date, max_date)
+
+
 def _download_snapshot_try_date(
     url: str,
     file_path: Path,
@@ -121,23 +357,39 @@ def _download_snapshot_try_date(
     **download_opts,
 ) -> Optional[str]:
     """
-    Same as `_download_snapshot_simple` but trying to replace {date} in the URL with dates between
-    today and 2020-01-01 until one works.
+    Same as `_download_snapshot_simple` but replacing {date} in the URL with the most recent date
+    between tomorrow and 2020-01-01 that works. The last date that worked is saved next to the
+    snapshot, so following downloads only need to check the few dates after it.
     """
     min_date = datetime.date.fromisoformat("2020-01-01")
-    cur_date = datetime.date.fromisoformat(date_today(offset=1))
-    while cur_date >= min_date:
+    max_date = datetime.date.fromisoformat(date_today(offset=1))
+    hint = _read_date_state(file_path, url)
+
+    # Probe whether the URL exists for each date only once, using lightweight requests
+    probe = url_probe(**download_opts)
+    probed_dates: Dict[datetime.date, bool] = {}
+
+    def _exists(date: datetime.date) -> bool:
+        if date not in probed_dates:
+            probed_dates[date] = probe(url.format(date=date.strftime(date_format)))
+        return probed_dates[date]
+
+    while max_date >= min_date:
+        cur_date = _latest_date(_exists, min_date, max_date, hint=hint)
+        if cur_date is None:
+            break
         try:
-            date_str = cur_date.strftime(date_format)
-            return _download_snapshot_simple(
-                url.format(date=date_str),
+            file_path_str = _download_snapshot_simple(
+                url.format(date=cur_date.strftime(date_format)),
                 file_path,
-                ignore_failure=ignore_failure,
                 logger=logger,
                 **download_opts,
             )
-        except requests.exceptions.HTTPError:
-            cur_date -= datetime.timedelta(days=1)
+            _write_date_state(file_path, url, cur_date)
+            return file_path_str
+        except requests.exceptions.RequestException:
+            # The probe might not agree with the actual download, so keep looking before it
+            max_date, hint = cur_date - datetime.timedelta(days=1), None
 
     if ignore_failure:
         return None
@@ -147,54 +399,89 @@ def _download_snapshot_try_date(
 
 def download(
     url: str,
-    file_handle: BinaryIO,
+    file_handle: Union[BinaryIO, Path, str],
     progress: bool = False,
     spoof_browser: bool = True,
     timeout: int = 60,
     data: Dict[str, Any] = None,
-) -> None:
+    headers: Dict[str, str] = None,
+) -> requests.Response:
     """
     Based on https://stackoverflow.com/a/37573701. It downloads the contents from the provided URL
-    and writes them into a writeable binary stream.
+    and writes them into a writeable binary stream, one chunk at a time. Requests to the same host
+    reuse the connections of a shared session.
 
     Args:
         url: The endpoint where contents are to be downloaded from
-        file_handle: Writeable stream to write contents to
+        file_handle: Writeable stream or file path to write contents to
         progress: Display progress during the download using the lib.utils.pbar function
         spoof_browser: Pretend to be a web browser by adding user agent string to headers
+        headers: Additional headers sent with the request, like conditional request headers
+
+    Returns:
+        requests.Response: The response, whose body has already been consumed. Nothing is written
+            if the server responds with 304 Not Modified to a conditional request.
     """
-    with open_file_like(file_handle, "wb") as fd:
-        headers = {"User-Agent": "Safari"} if spoof_browser else {}
-        request_options = {
-            "url": url,
-            "headers": headers,
-            "allow_redirects": True,
-            "timeout": timeout,
-            "data": data,
-        }
-        if not progress:
-            req = requests.get(**request_options)
-            req.raise_for_status()
-            fd.write(req.content)
-        else:
-            block_size = 1024
-            req = requests.get(**request_options, stream=True)
-            req.raise_for_status()
-            total_size = int(req.headers.get("content-length", 0))
-            progress_bar = pbar(total=total_size, unit="iB", unit_scale=True)
-            for data in req.iter_content(block_size):
-                progress_bar.update(len(data))
-                fd.write(data)
-            progress_bar.close()
+    request_headers = {"User-Agent": "Safari"} if spoof_browser else {}
+    request_headers.update(headers or {})
+    request_options = {
+        "url": url,
+        "headers": request_headers,
+        "allow_redirects": True,
+        "timeout": timeout,
+        "data": data,
+        "stream": True,
+    }
+    with get_session(url).get(**request_options) as req:
+        req.raise_for_status()
+        if req.status_code == 304:
+            return req
+
+        with open_file_like(file_handle, "wb") as fd:
+            progress_bar = None
+            if progress:
+                total_size = int(req.headers.get("content-length", 0))
+                progress_bar = pbar(total=total_size, unit="iB", unit_scale=True)
+            for chunk in req.iter_content(DOWNLOAD_CHUNK_SIZE):
+                fd.write(chunk)
+                if progress_bar is not None:
+                    progress_bar.update(len(chunk))
+            if progress_bar is not None:
+                progress_bar.close()
+
+    return req
 
 
 def parallel_download(
-    url_list: List[str], path_list: List[Union[str, Path]], **download_opts
-) -> None:
+    url_list: List[str],
+    path_list: List[Union[str, Path]],
+    engine: str = "thread",
+    **download_opts,
+) -> Iterable[Any]:
+    """
+    Downloads the contents of each URL into the corresponding path in parallel.
+
+    Args:
+        url_list: URLs to download the contents from.
+        path_list: Paths where the contents of each URL are written to.
+        engine: Either "thread", which calls `download` from a thread pool, or "asyncio", which
+            uses `lib.net_async.bulk_download` to scale to many more concurrent requests.
+        download_opts: Keyword arguments passed to the download function of the engine.
+    """
+    assert len(url_list) == len(path_list)
+
+    if engine == "asyncio":
+        # Only import the asyncio engine when needed, since it depends on aiohttp
+        from .net_async import bulk_download
+
+        return bulk_download(url_list, path_list, **download_opts)
+
+    if engine != "thread":
+        raise ValueError(f"Unknown download engine {engine}")
+
     def _download_idx(idx: int) -> None:
         download(url_list[idx], path_list[idx], **download_opts)
 
-    assert len(url_list) == len(path_list)
     return thread_map(_download_idx, range(len(url_list)))
 
 
@@ -207,7 +494,7 @@ def get_retry(
     response_exception = None
     for _ in range(max_retries):
         try:
-            res = requests.get(url, **request_opts)
+            res = get_session(url).get(url, **request_opts)
             res.raise_for_status()
             return res
         except Exception as exc:
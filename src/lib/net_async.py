@@ -0,0 +1,245 @@
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import asyncio
+import os
+import random
+from pathlib import Path
+from typing import Dict, List, Optional, Union
+from urllib.parse import urlparse
+
+import aiohttp
+
+from .error_logger import ErrorLogger
+from .io import pbar
+from .net import _read_validators, _write_validators
+
+
+# Size of the chunks read from each response and written to disk
+BULK_DOWNLOAD_CHUNK_SIZE = 256 * 1024
+
+# Default maximum number of concurrent requests made to the same host
+BULK_DOWNLOAD_MAX_PER_HOST = 8
+
+# Default maximum number of bytes held in memory by all downloads at the same time
+BULK_DOWNLOAD_MAX_INFLIGHT_BYTES = 64 * 1024 * 1024
+
+# Response status codes which are considered transient errors and retried
+_RETRY_STATUS_CODES = (408, 429, 500, 502, 503, 504)
+
+
+class _RetryableError(Exception):
+    pass
+
+
+class _ByteBudget:
+    """ Counter of bytes held in memory, which waits until enough bytes are released """
+
+    def __init__(self, max_bytes: int):
+        self._available = max_bytes
+        self._max_bytes = max_bytes
+        self._condition = asyncio.Condition()
+
+    async def acquire(self, size: int) -> int:
+        # Requests larger than the whole budget are capped, so they can eventually go through
+        size = min(size, self._max_bytes)
+        async with self._condition:
+            await self._condition.wait_for(lambda: self._available >= size)
+            self._available -= size
+        return size
+
+    async def release(self, size: int) -> None:
+        async with self._condition:
+            self._available += size
+            self._condition.notify_all()
+
+
+async def _download_file(
+    session: aiohttp.ClientSession,
+    host_limits: Dict[str, asyncio.Semaphore],
+    byte_budget: _ByteBudget,
+    url: str,
+    file_path: Path,
+    max_retries: int,
+    backoff: float,
+    conditional: bool,
+    logger: ErrorLogger,
+) -> None:
+    host_limit = host_limits[urlparse(url).netloc]
+    temp_path = file_path.parent / f"{file_path.name}.{os.getpid()}.{id(file_path)}.tmp"
+    headers = _read_validators(file_path, url) if conditional else {}
+
+    for attempt in range(max_retries + 1):
+        try:
+            request = session.get(url, allow_redirects=True, headers=headers)
+            async with host_limit, request as response:
+                if response.status in _RETRY_STATUS_CODES:
+                    raise _RetryableError(f"Status {response.status} downloading {url}")
+                response.raise_for_status()
+
+                # The existing file is kept if it has not been modified since it was downloaded
+                if response.status == 304:
+                    logger.log_info(f"Snapshot of {url} not modified")
+                    return
+
+                # Hold memory for one chunk while the body is streamed into a temporary file
+                chunk_size = min(BULK_DOWNLOAD_CHUNK_SIZE, response.content_length or 1e12)
+                reserved = await byte_budget.acquire(int(chunk_size))
+                try:
+                    with open(temp_path, "wb") as fd:
+                        async for chunk in response.content.iter_chunked(reserved or 1):
+                            fd.write(chunk)
+                finally:
+                    await byte_budget.release(reserved)
+
+            os.replace(temp_path, file_path)
+            if conditional:
+                _write_validators(file_path, url, response)
+            return
+
+        except (
+            _RetryableError,
+            aiohttp.ClientConnectionError,
+            aiohttp.ClientPayloadError,
+            asyncio.TimeoutError,
+        ) as exc:
+            if attempt == max_retries:
+                raise exc
+
+            # Exponential back-off with full jitter, so retries to the same host are spread out
+            logger.log_warning(f"Retrying download of {url}", attempt=attempt + 1)
+            await asyncio.sleep(random.uniform(0, backoff * 2 ** attempt))
+
+        # Partial downloads are removed on any failure, including when the task is cancelled
+        finally:
+            if temp_path.exists():
+                temp_path.unlink()
+
+
+async def _download_all(
+    url_list: List[str],
+    path_list: List[Path],
+    max_per_host: int,
+    max_inflight_bytes: int,
+    max_retries: int,
+    backoff: float,
+    timeout: int,
+    headers: Dict[str, str],
+    conditional: bool,
+    ignore_failure: bool,
+    progress: bool,
+    logger: ErrorLogger,
+) -> List[Optional[str]]:
+    host_limits = {urlparse(url).netloc: asyncio.Semaphore(max_per_host) for url in url_list}
+    byte_budget = _ByteBudget(max_inflight_bytes)
+    progress_bar = pbar(total=len(url_list), desc="Downloading") if progress else None
+
+    async def _download(url: str, file_path: Path) -> Optional[str]:
+        try:
+            await _download_file(
+                session,
+                host_limits,
+                byte_budget,
+                url,
+                file_path,
+                max_retries,
+                backoff,
+                conditional,
+                logger,
+            )
+            return str(file_path.absolute())
+        except Exception as exc:
+            if not ignore_failure:
+                raise exc
+            logger.log_warning(f"Unable to download {url}", exception=exc)
+            return None
+        finally:
+            if progress_bar is not None:
+                progress_bar.update(1)
+
+    connector = aiohttp.TCPConnector(limit=0, limit_per_host=max_per_host)
+    client_timeout = aiohttp.ClientTimeout(total=None, sock_connect=timeout, sock_read=timeout)
+    async with aiohttp.ClientSession(
+        connector=connector, timeout=client_timeout, headers=headers
+    ) as session:
+        try:
+            return list(
+                await asyncio.gather(
+                    *[_download(url, Path(path)) for url, path in zip(url_list, path_list)]
+                )
+            )
+        finally:
+            if progress_bar is not None:
+                progress_bar.close()
+
+
+def bulk_download(
+    url_list: List[str],
+    path_list: List[Union[str, Path]],
+    max_per_host: int = BULK_DOWNLOAD_MAX_PER_HOST,
+    max_inflight_bytes: int = BULK_DOWNLOAD_MAX_INFLIGHT_BYTES,
+    max_retries: int = 4,
+    backoff: float = 1.0,
+    timeout: int = 60,
+    spoof_browser: bool = True,
+    headers: Dict[str, str] = None,
+    conditional: bool = False,
+    ignore_failure: bool = False,
+    progress: bool = True,
+    logger: ErrorLogger = ErrorLogger(),
+) -> List[Optional[str]]:
+    """
+    Downloads the contents of each URL into the corresponding path using a single event loop, so
+    the number of concurrent downloads is not bound by the size of a thread pool. This function is
+    synchronous and can be called from any code which is not already running an event loop.
+
+    Args:
+        url_list: URLs to download the contents from.
+        path_list: Paths where the contents of each URL are written to.
+        max_per_host: Maximum number of concurrent requests to the same host.
+        max_inflight_bytes: Maximum number of bytes held in memory by all downloads at once.
+        max_retries: Number of times a download is retried after a transient error.
+        backoff: Base number of seconds to wait before retrying, doubled after each attempt.
+        timeout: Number of seconds to wait for connections and for each read to complete.
+        spoof_browser: Pretend to be a web browser by adding user agent string to headers.
+        headers: Additional headers sent with every request.
+        conditional: Make each request conditional on the validators saved by a previous download
+            of the same URL, keeping the existing file if the server responds with 304.
+        ignore_failure: If true, output `None` for failed downloads instead of raising.
+        progress: Display the number of completed downloads using the lib.utils.pbar function.
+        logger: ErrorLogger instance to use for logging of events.
+
+    Returns:
+        List[Optional[str]]: Absolute path of each downloaded file, in the same order as the input
+            URLs, or None if the download failed and `ignore_failure` is set.
+    """
+    assert len(url_list) == len(path_list)
+    request_headers = {"User-Agent": "Safari"} if spoof_browser else {}
+    request_headers.update(headers or {})
+    return asyncio.run(
+        _download_all(
+            list(url_list),
+            list(path_list),
+            max_per_host=max_per_host,
+            max_inflight_bytes=max_inflight_bytes,
+            max_retries=max_retries,
+            backoff=backoff,
+            timeout=timeout,
+            headers=request_headers,
+            conditional=conditional,
+            ignore_failure=ignore_failure,
+            progress=progress,
+            logger=logger,
+        )
+    )
@@ -12,26 +12,100 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import hashlib
 import importlib
+import inspect
+import json
+import os
+import pickle
 import traceback
 from pathlib import Path
-from functools import partial
+from functools import lru_cache, partial
 from multiprocessing import cpu_count
 from typing import Any, Dict, Iterable, List, Optional, Tuple, Union
 
 import yaml
+import numpy
+import pandas
 import requests
 from pandas import DataFrame, concat
 
-from .anomaly import detect_anomaly_all, detect_stale_columns
-from .cast import column_converters
-from .constants import SRC, CACHE_URL
+from .anomaly import detect_anomaly_all, report_anomalies, stale_columns_report
+from .cast import cast_column
+from .constants import (
+    AUXILIARY_CACHE_ENV,
+    AUXILIARY_CACHE_FOLDER,
+    AUXILIARY_CACHE_MAX_ENTRIES,
+    CACHE_URL,
+    SRC,
+)
 from .concurrent import process_map
 from .data_source import DataSource
 from .error_logger import ErrorLogger
-from .io import read_file, read_table, fuzzy_text, export_csv, parse_dtype, pbar
+from .io import (
+    export_csv,
+    file_digest,
+    fuzzy_text_series,
+    parse_dtype,
+    pbar,
+    read_file,
+    temporary_directory,
+)
+from .key_resolver import KeyResolver
 from .lazy_property import lazy_property
-from .utils import combine_tables, drop_na_records, filter_output_columns
+from .memory_efficient import get_table_columns, table_is_sorted, table_merge_sorted, table_sort
+from .utils import combine_tables, drop_na_records
+
+# Minimum number of records checked by each process during full verification
+VERIFY_MIN_SHARD_SIZE = 1_000_000
+
+
+def _read_auxiliary_cache(path: Path) -> Dict[str, DataFrame]:
+    """ Loads the auxiliary tables pickled into `path` """
+    with open(path, "rb") as fd:
+        return pickle.load(fd)
+
+
+@lru_cache(maxsize=1)
+def _attach_auxiliary_tables(path: Path) -> Dict[str, DataFrame]:
+    """
+    Loads the auxiliary tables published into `path` in a worker process. The tables are not in
+    shared memory: each worker holds its own private copy, but only reads the file once instead of
+    receiving the tables with every task. The tables must be treated as read-only, since they are
+    shared by all data sources run by the worker. Workers belong to a single pipeline, so only the
+    tables of the last path are kept.
+    """
+    return _read_auxiliary_cache(path)
+
+
+@lru_cache(maxsize=1)
+def _attach_key_resolver(path: Path) -> KeyResolver:
+    """ Index over the metadata table published into `path`, which each worker only builds once """
+    return KeyResolver(_attach_auxiliary_tables(path)["metadata"])
+
+
+@lru_cache(maxsize=None)
+def _auxiliary_code_version() -> str:
+    """
+    Fingerprint of the code used to preprocess the auxiliary tables, which is the source of the
+    modules defining the functions used to read them and compute their derived columns.
+    """
+    code_hash = hashlib.sha256()
+    preprocess_funcs = (DataPipeline._read_auxiliary_tables, read_file, fuzzy_text_series)
+    for code_file in sorted(set(inspect.getsourcefile(func) for func in preprocess_funcs)):
+        code_hash.update(f"{Path(code_file).name}={file_digest(code_file)};".encode())
+    return code_hash.hexdigest()
+
+
+def _prune_auxiliary_cache(cache_folder: Path, max_entries: int) -> None:
+    """ Deletes all but the `max_entries` most recently used entries of the auxiliary cache """
+    entries = sorted(cache_folder.glob("*.pickle"), key=lambda x: x.stat().st_mtime, reverse=True)
+    for entry in entries[max_entries:]:
+        try:
+            entry.unlink()
+        except FileNotFoundError:
+            # Another process might have pruned the same entry
+            pass
 
 
 class DataPipeline(ErrorLogger):
@@ -67,28 +141,76 @@ class DataPipeline(ErrorLogger):
         self.data_sources: List[DataSource] = data_sources
         self.table: str = name.replace("_", "-")
         self._auxiliary: Dict[str, Union[Path, str]] = auxiliary
+        self._auxiliary_tables_path: Optional[Path] = None
         self.config = config
 
-    @lazy_property
-    def auxiliary_tables(self):
-        """ Auxiliary datasets passed to the pipelines during processing """
-
-        # Metadata table can be overridden but must always be present
-        auxiliary = {"metadata": SRC / "data" / "metadata.csv", **self._auxiliary}
+    @staticmethod
+    def _read_auxiliary_tables(auxiliary: Dict[str, Path]) -> Dict[str, DataFrame]:
+        """ Reads the auxiliary tables from disk and precomputes commonly used columns """
 
         # Load the auxiliary tables into memory
         aux = {name: read_file(table) for name, table in auxiliary.items()}
 
         # Precompute some useful transformations in the auxiliary input files
-        aux["metadata"]["match_string_fuzzy"] = aux["metadata"].match_string.apply(fuzzy_text)
+        aux["metadata"]["match_string_fuzzy"] = fuzzy_text_series(aux["metadata"].match_string)
         for column in ("subregion1", "subregion2", "locality"):
             # Apply fuzzy comparison for name fields
-            aux["metadata"][f"{column}_name_fuzzy"] = aux["metadata"][f"{column}_name"].apply(
-                fuzzy_text
+            aux["metadata"][f"{column}_name_fuzzy"] = fuzzy_text_series(
+                aux["metadata"][f"{column}_name"]
             )
 
         return aux
 
+    @staticmethod
+    def _auxiliary_cache_path(auxiliary: Dict[str, Path]) -> Path:
+        """ Location of the cached auxiliary tables, which depends on the contents of each file """
+        cache_folder = Path(os.getenv(AUXILIARY_CACHE_ENV) or AUXILIARY_CACHE_FOLDER)
+        cache_hash = hashlib.sha256(f"{_auxiliary_code_version()}.{pandas.__version__}".encode())
+        for name, path in sorted(auxiliary.items()):
+            cache_hash.update(f"{name}={file_digest(path)};".encode())
+        return cache_folder / f"{cache_hash.hexdigest()}.pickle"
+
+    @lazy_property
+    def auxiliary_tables(self):
+        """ Auxiliary datasets passed to the pipelines during processing """
+
+        # Metadata table can be overridden but must always be present
+        auxiliary = {"metadata": SRC / "data" / "metadata.csv", **self._auxiliary}
+
+        # Reuse the preprocessed tables from a previous run if none of the files have changed
+        cache_path = self._auxiliary_cache_path(auxiliary)
+        if cache_path.exists():
+            try:
+                aux = _read_auxiliary_cache(cache_path)
+                self._auxiliary_tables_path = cache_path
+
+                # Mark the entry as recently used, so it is not pruned
+                os.utime(cache_path)
+                return aux
+            except Exception as exc:
+                self.log_warning(f"Unable to read auxiliary cache {cache_path}", exception=exc)
+
+        aux = self._read_auxiliary_tables(auxiliary)
+
+        # Write to a temporary file first, so other processes never read a partial cache file
+        try:
+            cache_path.parent.mkdir(parents=True, exist_ok=True)
+            temp_path = cache_path.with_suffix(f".{os.getpid()}.tmp")
+            with open(temp_path, "wb") as fd:
+                pickle.dump(aux, fd, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(temp_path, cache_path)
+            self._auxiliary_tables_path = cache_path
+            _prune_auxiliary_cache(cache_path.parent, AUXILIARY_CACHE_MAX_ENTRIES)
+        except Exception as exc:
+            self.log_warning(f"Unable to write auxiliary cache {cache_path}", exception=exc)
+
+        return aux
+
+    @lazy_property
+    def key_resolver(self) -> KeyResolver:
+        """ Index over the metadata auxiliary table shared by all data sources run serially """
+        return KeyResolver(self.auxiliary_tables["metadata"])
+
     @staticmethod
     def load(name: str) -> "DataPipeline":
         """
@@ -138,25 +260,71 @@ class DataPipeline(ErrorLogger):
         output_columns = list(self.schema.keys())
 
         # Make sure all columns are present and have the appropriate type
-        for column, converter in column_converters(self.schema).items():
+        for column, dtype in self.schema.items():
             if column not in data:
                 data[column] = None
-            data[column] = data[column].apply(converter)
+            data[column] = cast_column(data[column], dtype)
 
         # Filter only output columns and output the sorted data
         return drop_na_records(data[output_columns], ["date", "key"]).sort_values(output_columns)
 
+    @lazy_property
+    def _manifest_fingerprint(self) -> str:
+        """ Fingerprint of the pipeline inputs shared by all data sources, stored in manifests """
+        auxiliary = {"metadata": SRC / "data" / "metadata.csv", **self._auxiliary}
+        return hashlib.sha256(
+            f"{self._auxiliary_cache_path(auxiliary).stem}.{self.schema}".encode()
+        ).hexdigest()
+
+    def _manifest_path(self, intermediate_folder: Path, data_source: DataSource) -> Path:
+        return intermediate_folder / f"{data_source.uuid(self.table)}.manifest.json"
+
+    def _previous_manifests(self, intermediate_folder: Path) -> Dict[str, Dict[str, Any]]:
+        """
+        Reads the manifests of the inputs used to produce the existing intermediate results,
+        keyed by data source uuid. Manifests produced with different pipeline inputs are ignored.
+        """
+        manifests = {}
+        for data_source in self.data_sources:
+            uuid = data_source.uuid(self.table)
+            manifest_path = self._manifest_path(intermediate_folder, data_source)
+            if not manifest_path.exists() or not (intermediate_folder / f"{uuid}.csv").exists():
+                continue
+            try:
+                with open(manifest_path, "r") as fd:
+                    manifest = json.load(fd)
+            except Exception as exc:
+                self.log_warning(f"Unable to read manifest {manifest_path}", exception=exc)
+                continue
+            if manifest.pop("pipeline", None) == self._manifest_fingerprint:
+                manifests[uuid] = manifest
+        return manifests
+
     @staticmethod
     def _run_wrapper(
         output_folder: Path,
         cache: Dict[str, str],
-        aux: Dict[str, DataFrame],
+        aux: Union[Path, Dict[str, DataFrame]],
         data_source: DataSource,
+        table_name: str = None,
+        previous_manifests: Dict[str, Dict[str, Any]] = None,
+        key_resolver: KeyResolver = None,
         **source_opts,
     ) -> Optional[DataFrame]:
         """ Workaround necessary for multiprocess pool, which does not accept lambda functions """
         try:
-            return data_source.run(output_folder, cache, aux, **source_opts)
+            # Worker processes receive the location of the published auxiliary tables
+            if isinstance(aux, Path):
+                key_resolver = _attach_key_resolver(aux)
+                aux = _attach_auxiliary_tables(aux)
+            source_opts["key_resolver"] = key_resolver
+
+            # Let the data source know what inputs were used to produce its previous output
+            if table_name is not None:
+                uuid = data_source.uuid(table_name)
+                source_opts["previous_manifest"] = (previous_manifests or {}).get(uuid)
+
+            return data_source.run(output_folder, cache, aux, table_name=table_name, **source_opts)
         except Exception:
             data_source_name = data_source.__class__.__name__
             data_source.log_error(
@@ -168,7 +336,11 @@ class DataPipeline(ErrorLogger):
         return None
 
     def parse(
-        self, output_folder: Path, process_count: int = None, **source_opts
+        self,
+        output_folder: Path,
+        process_count: int = None,
+        intermediate_folder: Path = None,
+        **source_opts,
     ) -> Iterable[Tuple[DataSource, DataFrame]]:
         """
         Performs the fetch and parse steps for each of the data sources in this pipeline.
@@ -177,6 +349,10 @@ class DataPipeline(ErrorLogger):
             output_folder: Root path of the outputs where "snapshot", "intermediate" and "tables"
                 will be created and populated with CSV files.
             process_count: Maximum number of processes to run in parallel.
+            intermediate_folder: Location of the intermediate results from a previous run. When
+                provided, data sources whose inputs have not changed since their intermediate
+                results were saved are skipped, and output an empty DataFrame flagged as
+                "unchanged" in its `attrs`. See `DataPipeline._save_intermediate_results`.
         Returns:
             Iterable[Tuple[DataSource, DataFrame]]: Pairs of <data source, results> for each data
                 source, where the results are the output of `DataSource.parse()`.
@@ -189,26 +365,45 @@ class DataPipeline(ErrorLogger):
             cache = {}
             self.log_error("Cache unavailable")
 
-        # Make a copy of the auxiliary table to prevent modifying it for everyone, but this way
-        # we allow for local modification (which might be wanted for optimization purposes)
-        aux_copy = {name: df.copy() for name, df in self.auxiliary_tables.items()}
+        # Default to using as many processes as CPUs
+        if process_count is None:
+            process_count = cpu_count()
+        data_sources_count = len(self.data_sources)
+        run_in_series = process_count <= 1 or data_sources_count <= 1
+
+        # The auxiliary tables are not copied here, since each data source makes its own copy of
+        # the tables it uses. When running in a process pool, only the location of the published
+        # tables is sent to the workers, each of which loads its own copy of the tables once
+        # instead of receiving them pickled with every task.
+        aux = self.auxiliary_tables
+        if not run_in_series:
+            if self._auxiliary_tables_path is not None:
+                aux = self._auxiliary_tables_path
+            else:
+                self.log_warning("Auxiliary tables not cached, sending them with every task")
 
         # Create a function to be used during mapping. The nestedness is an unfortunate outcome of
         # the multiprocessing module's limitations when dealing with lambda functions, coupled with
         # the "sandboxing" we implement to ensure resiliency.
-        map_func = partial(DataPipeline._run_wrapper, output_folder, cache, aux_copy, **source_opts)
+        map_func = partial(DataPipeline._run_wrapper, output_folder, cache, aux, **source_opts)
 
-        # Default to using as many processes as CPUs
-        if process_count is None:
-            process_count = cpu_count()
+        # Data sources run serially share the same index over the metadata table
+        if run_in_series:
+            map_func = partial(map_func, key_resolver=self.key_resolver)
+
+        # The manifests are recorded for every run, but only compared if there are previous ones
+        map_func = partial(map_func, table_name=self.table)
+        if intermediate_folder is not None:
+            map_func = partial(
+                map_func, previous_manifests=self._previous_manifests(intermediate_folder)
+            )
 
         # Used to display progress during processing
-        data_sources_count = len(self.data_sources)
         progress_label = f"Run {self.name} pipeline"
         map_opts = dict(total=data_sources_count, desc=progress_label)
 
         # If the process count is less than one, run in series (useful to evaluate performance)
-        if process_count <= 1 or data_sources_count <= 1:
+        if run_in_series:
             map_result = pbar(map(map_func, self.data_sources), **map_opts)
         else:
             map_opts.update(dict(max_workers=process_count))
@@ -218,69 +413,139 @@ class DataPipeline(ErrorLogger):
         # This operation is parallelized but output order is preserved
         yield from zip(self.data_sources, map_result)
 
+    @property
+    def _index_columns(self) -> List[str]:
+        """ Columns which uniquely identify each record of this pipeline's output """
+        return [col for col in ("date", "key") if col in self.schema]
+
     def _save_intermediate_results(
         self,
         intermediate_folder: Path,
         intermediate_results: Iterable[Tuple[DataSource, DataFrame]],
-    ) -> None:
+    ) -> Dict[str, List[str]]:
+        """
+        Exports the results of each data source into `intermediate_folder`, along with a manifest
+        of the inputs used to produce them. Results flagged as "unchanged" keep the existing
+        intermediate output.
+
+        Arguments:
+            intermediate_folder: Output folder for the intermediate results.
+            intermediate_results: Pairs of <data source, results> output by `DataPipeline.parse`.
+        Returns:
+            Dict[str, List[str]]: Report with the names of the data sources which were
+                "recomputed", "skipped" because their inputs did not change, or "failed".
+        """
+        report: Dict[str, List[str]] = {"recomputed": [], "skipped": [], "failed": []}
         for data_source, result in intermediate_results:
-            if result is not None:
-                self.log_info(f"Exporting results from {data_source.__class__.__name__}")
+            data_source_name = data_source.__class__.__name__
+            manifest_path = self._manifest_path(intermediate_folder, data_source)
+            if result is not None and result.attrs.get("unchanged"):
+                self.log_info(f"Reusing previous results from {data_source_name}")
+                report["skipped"].append(data_source_name)
+            elif result is not None:
+                self.log_info(f"Exporting results from {data_source_name}")
                 file_name = f"{data_source.uuid(self.table)}.csv"
+
+                # Remove the previous manifest first, in case the export does not complete
+                if manifest_path.exists():
+                    manifest_path.unlink()
+
+                # Intermediate results are sorted so they can be combined using a streaming merge
+                manifest = result.attrs.get("manifest")
+                sort_columns = [col for col in self._index_columns if col in result.columns]
+                result = result.sort_values(sort_columns, kind="mergesort", na_position="first")
                 export_csv(result, intermediate_folder / file_name, schema=self.schema)
+
+                # Record the inputs used to produce these results, so future runs can skip them
+                if manifest is not None:
+                    with open(manifest_path, "w") as fd:
+                        json.dump({**manifest, "pipeline": self._manifest_fingerprint}, fd)
+                report["recomputed"].append(data_source_name)
             else:
-                data_source_name = data_source.__class__.__name__
                 self.log_error(
                     "No output while saving intermediate results",
                     source_name=data_source_name,
                     source_config=data_source.config,
                 )
+                report["failed"].append(data_source_name)
 
-    def _load_intermediate_results(
-        self, intermediate_folder: Path
-    ) -> Iterable[Tuple[DataSource, DataFrame]]:
+        self.log_info(
+            f"Saved intermediate results: {len(report['recomputed'])} recomputed, "
+            f"{len(report['skipped'])} skipped and {len(report['failed'])} failed",
+            **report,
+        )
+        return report
 
+    def _intermediate_files(self, intermediate_folder: Path) -> List[Path]:
+        intermediate_files = []
         for data_source in self.data_sources:
             intermediate_path = intermediate_folder / f"{data_source.uuid(self.table)}.csv"
-            try:
-                yield (data_source, read_table(intermediate_path, schema=self.schema))
-            except Exception as exc:
+            if intermediate_path.exists():
+                intermediate_files.append(intermediate_path)
+            else:
                 data_source_name = data_source.__class__.__name__
                 self.log_error(
                     "Failed to load intermediate output",
                     source_name=data_source_name,
                     source_config=data_source.config,
-                    exception=exc,
                 )
+        return intermediate_files
 
-    def _split_combine_inputs(
-        self, intermediate_results: Iterable[Tuple[DataSource, DataFrame]], combine_chunk_size: int
-    ) -> List[DataFrame]:
-        combine_inputs = concat(intermediate_results)
-        combine_inputs_columns = combine_inputs.columns
-        idx_col = "date" if "date" in combine_inputs.columns else "key"
-        combine_inputs.dropna(subset=[idx_col], inplace=True)
-        combine_inputs.set_index(idx_col, inplace=True)
-        index = combine_inputs.index.unique()
-
-        new_chunk = lambda: DataFrame(columns=combine_inputs_columns).set_index(idx_col)
-        current_chunk = new_chunk()
-        current_chunk_len = 0
+    def _combine_block(self, columns: List[str], records: List[List[str]]) -> DataFrame:
+        """ Combines a block of records which contains all the records for each of its indices """
+        block = DataFrame.from_records(records, columns=columns)
 
-        for idx in sorted(index):
-            idx_chunk = combine_inputs.loc[idx]
-            idx_chunk_len = len(idx_chunk)
+        # Convert the values prior to combining them, since unparseable values count as null
+        for column, dtype in self.schema.items():
+            block[column] = cast_column(block[column], dtype)
 
-            if idx_chunk_len > 0 and current_chunk_len + idx_chunk_len > combine_chunk_size:
-                current_chunk_len = 0
-                yield current_chunk.reset_index()
-                current_chunk = new_chunk()
+        return self.output_table(combine_tables([block], self._index_columns))
 
-            current_chunk_len += idx_chunk_len
-            current_chunk = current_chunk.append(idx_chunk)
+    def combine_files(
+        self, intermediate_files: List[Path], block_size: int = 2 ** 16
+    ) -> Iterable[DataFrame]:
+        """
+        Combine the intermediate results from the provided CSV files, giving preference to values
+        coming from the latter files. The files are read using a streaming k-way merge over their
+        index columns, so only `block_size` records are held in memory at any given time.
 
-        if len(current_chunk) > 0:
-            yield current_chunk.reset_index()
+        Arguments:
+            intermediate_files: Paths to the intermediate results, in order of precedence.
+            block_size: Approximate number of records combined at once.
+        Returns:
+            Iterable[DataFrame]: Blocks of the combined output in the order of the index columns,
+                each already processed by `DataPipeline.output_table()`.
+        """
+        columns = list(self.schema.keys())
+        index_columns = self._index_columns
+
+        with temporary_directory() as workdir:
+
+            # Sort any file which was not sorted when saved, like those from older versions
+            merge_inputs = []
+            for idx, file_path in enumerate(intermediate_files):
+                file_columns = get_table_columns(file_path)
+                if not all(col in file_columns for col in index_columns):
+                    self.log_error(f"Missing index columns in intermediate output {file_path}")
+                    continue
+                if not table_is_sorted(file_path, index_columns):
+                    sorted_path = workdir / f"{idx}.csv"
+                    table_sort(file_path, sorted_path, sort_columns=index_columns)
+                    file_path = sorted_path
+                merge_inputs.append(file_path)
+
+            # Accumulate records until the block is full, without splitting records of same index
+            records = []
+            last_key = None
+            for key, record in table_merge_sorted(merge_inputs, index_columns, columns):
+                if key != last_key and len(records) >= block_size:
+                    yield self._combine_block(columns, records)
+                    records = []
+                records.append(record)
+                last_key = key
+
+            if records:
+                yield self._combine_block(columns, records)
 
     def combine(
         self,
@@ -294,43 +559,65 @@ class DataPipeline(ErrorLogger):
 
         Arguments:
             intermediate_results: collection of results from individual data sources.
-            process_count: Maximum number of processes to run in parallel.
-            combine_chunk_size: Maximum number of rows to send to combine grouping function.
+            process_count: Unused, kept for backwards compatibility since the combine step is now
+                performed by a streaming merge.
+            combine_chunk_size: Approximate number of rows to combine at once.
         """
+        with temporary_directory() as workdir:
+            self._save_intermediate_results(workdir, intermediate_results)
+            intermediate_files = self._intermediate_files(workdir)
+            return self._concat_output(self.combine_files(intermediate_files, combine_chunk_size))
+
+    def _concat_output(self, output_blocks: Iterable[DataFrame]) -> DataFrame:
+        output_blocks = list(output_blocks)
+        if not output_blocks:
+            self.log_error("Empty result for data pipeline {}".format(self.name))
+            return DataFrame(columns=self.schema.keys())
+        return concat(output_blocks)
 
-        # Default to using as many processes as CPUs
+    def _export_output(self, output_blocks: Iterable[DataFrame], output_path: Path) -> None:
+        """ Writes the blocks output by `combine_files` into a CSV file one block at a time """
+        for idx, output_block in enumerate(output_blocks):
+            export_opts = dict(header=idx == 0, mode="w" if idx == 0 else "a")
+            export_csv(output_block, output_path, schema=self.schema, **export_opts)
+
+        # Make sure the table exists even when there are no results
+        if not output_path.exists():
+            self.log_error("Empty result for data pipeline {}".format(self.name))
+            export_csv(DataFrame(columns=self.schema.keys()), output_path, schema=self.schema)
+
+    def anomaly_report(self, pipeline_output: DataFrame, process_count: int = None) -> DataFrame:
+        """
+        Detects the anomalies of each key in the data pipeline combined outputs. When more than one
+        process is used for large outputs, the keys are split into contiguous ranges which are
+        checked in parallel.
+
+        Arguments:
+            pipeline_output: Output of `DataPipeline.combine()`.
+            process_count: Maximum number of processes to run in parallel, defaults to the number
+                of CPUs.
+        Returns:
+            DataFrame: Anomaly report with `ANOMALY_REPORT_COLUMNS`, sorted by key.
+        """
         if process_count is None:
             process_count = cpu_count()
 
-        # Combine all intermediate outputs into a single DataFrame
-        output_chunk_count = 1
-        if not intermediate_results:
-            self.log_error("Empty result for data pipeline {}".format(self.name))
-            pipeline_output = [DataFrame(columns=self.schema.keys())]
-        else:
+        keys = numpy.sort(pipeline_output["key"].dropna().unique())
+        max_shard_count = -(-len(pipeline_output) // VERIFY_MIN_SHARD_SIZE)
+        shard_count = max(1, min(process_count, len(keys), max_shard_count))
+        map_func = partial(stale_columns_report, self.schema)
+        if shard_count <= 1:
+            return map_func(pipeline_output)
 
-            # Get rid of all columns which are not part of the output to speed up data combination
-            intermediate_tables = (
-                result[filter_output_columns(result.columns, self.schema)]
-                for _, result in intermediate_results
-            )
+        # Assign each record to the shard which holds its key range
+        pipeline_output = pipeline_output[pipeline_output["key"].notna()]
+        shard_bounds = [shard[0] for shard in numpy.array_split(keys, shard_count)[1:]]
+        shard_idx = numpy.searchsorted(shard_bounds, pipeline_output["key"].values, side="right")
+        map_iter = [shard for _, shard in pipeline_output.groupby(shard_idx)]
 
-            # Parallelize combine step into N processes
-            combine_inputs = self._split_combine_inputs(intermediate_tables, combine_chunk_size)
-            map_iter = [[chunk] for chunk in combine_inputs]
-            map_func = partial(combine_tables, index=["date", "key"])
-            map_opts = dict(max_workers=process_count, desc=f"Combining {self.name} outputs")
-            pipeline_output = process_map(map_func, map_iter, **map_opts)
-            output_chunk_count = len(map_iter)
-            del combine_inputs
-
-        # Return data using the pipeline's output parameters
-        map_opts = dict(
-            total=output_chunk_count,
-            max_workers=process_count,
-            desc=f"Cleaning {self.name} outputs",
-        )
-        return concat(process_map(self.output_table, pipeline_output, **map_opts))
+        progress_label = f"Verify {self.name} pipeline"
+        map_opts = dict(max_workers=shard_count, desc=progress_label)
+        return concat(process_map(map_func, map_iter, **map_opts), ignore_index=True)
 
     def verify(
         self, pipeline_output: DataFrame, level: str = "simple", process_count: int = cpu_count()
@@ -357,19 +644,8 @@ class DataPipeline(ErrorLogger):
         if level == "full":
 
             # Perform stale column detection for each known key
-            map_iter = pipeline_output.key.unique()
-            # TODO: convert into a regular function since lambdas cannot be pickled
-            map_func = lambda key: detect_stale_columns(
-                self.schema, pipeline_output[pipeline_output.key == key], (self.name, key)
-            )
-            progress_label = f"Verify {self.name} pipeline"
-            if process_count <= 1 or len(map_iter) <= 1:
-                map_func = pbar(map(map_func, map_iter), total=len(map_iter), desc=progress_label)
-            else:
-                map_func = process_map(map_func, map_iter, desc=progress_label)
-
-            # Consume the results
-            _ = list(map_func)
+            report = self.anomaly_report(pipeline_output, process_count=process_count)
+            report_anomalies(report, [self.name])
 
         return pipeline_output
 
@@ -378,8 +654,10 @@ class DataPipeline(ErrorLogger):
         output_folder: Path,
         process_count: int = cpu_count(),
         verify_level: str = "simple",
+        incremental: bool = False,
+        output_path: Path = None,
         **source_opts,
-    ) -> DataFrame:
+    ) -> Optional[DataFrame]:
         """
         Main method which executes all the associated [DataSource] objects and combines their
         outputs.
@@ -390,28 +668,46 @@ class DataPipeline(ErrorLogger):
             process_count: Maximum number of processes to run in parallel.
             verify_level: Level of anomaly detection to perform on outputs. Possible values are:
                 None, "simple" and "full".
+            incremental: Flag indicating whether data sources whose inputs have not changed since
+                their intermediate results were saved should be skipped. Defaults to False, since
+                the outputs of some data sources depend on more than their downloaded snapshots,
+                like the current date or data downloaded during the parse step.
+            output_path: Path of the CSV file where the combined outputs are written to. When no
+                verification is requested, the outputs are written one block at a time without
+                ever holding the whole table in memory.
             source_opts: Options to relay to the DataSource.run() method.
         Returns:
-            DataFrame: Processed and combined outputs from all the individual data sources into a
-                single table.
+            Optional[DataFrame]: Processed and combined outputs from all the individual data
+                sources into a single table, or None if they were written to `output_path` one
+                block at a time.
         """
-        # TODO: break out fetch & parse steps
-        intermediate_results = self.parse(output_folder, process_count=process_count, **source_opts)
+        # Data sources with the same inputs as the saved intermediate results are not run again
+        intermediate_folder = output_folder / "intermediate"
+        intermediate_results = self.parse(
+            output_folder,
+            process_count=process_count,
+            intermediate_folder=intermediate_folder if incremental else None,
+            **source_opts,
+        )
 
         # Save all intermediate results (to allow for reprocessing)
-        intermediate_folder = output_folder / "intermediate"
         self._save_intermediate_results(intermediate_folder, intermediate_results)
 
-        # Re-load all intermediate results
-        intermediate_results = self._load_intermediate_results(intermediate_folder)
+        # Combine all intermediate results using a streaming merge
+        intermediate_files = self._intermediate_files(intermediate_folder)
+        output_blocks = self.combine_files(intermediate_files)
 
-        # Combine all intermediate results into a single dataframe
-        # NOTE: Limit the number of processes to avoid OOM in big datasets
-        pipeline_output = self.combine(intermediate_results, process_count=min(process_count, 4))
+        # The whole table is only needed in memory when it is verified or returned
+        if output_path is not None and verify_level is None:
+            self._export_output(output_blocks, output_path)
+            return None
 
         # Perform anomaly detection on the combined outputs
+        pipeline_output = self._concat_output(output_blocks)
         pipeline_output = self.verify(
             pipeline_output, level=verify_level, process_count=process_count
         )
 
+        if output_path is not None:
+            export_csv(pipeline_output.copy(), output_path, schema=self.schema)
         return pipeline_output
@@ -13,29 +13,32 @@
 # limitations under the License.
 
 import cProfile
+import csv
 import datetime
 import gzip
 import shutil
 import traceback
 from argparse import ArgumentParser
 from functools import partial
+from itertools import groupby
 from pathlib import Path
 from pstats import Stats
-from typing import Dict, Iterable, List, Optional, TextIO
+from typing import Dict, Iterable, Iterator, List, Optional, Set, TextIO, Tuple
 
+from lib.concurrent import process_map
 from lib.constants import OUTPUT_COLUMN_ADAPTER, SRC, V2_TABLE_LIST, V3_TABLE_LIST
 from lib.error_logger import ErrorLogger
-from lib.io import pbar, read_lines, temporary_directory
+from lib.io import open_file_like, pbar, read_lines, temporary_directory
 from lib.memory_efficient import (
     convert_csv_to_json_records,
     get_table_columns,
     table_breakout,
     table_concat,
-    table_cross_product,
     table_drop_nan_columns,
     table_grouped_tail,
-    table_join,
+    table_is_sorted,
     table_merge,
+    table_merge_sorted,
     table_read_column,
     table_rename,
     table_sort,
@@ -115,32 +118,137 @@ def _get_tables_in_folder(tables_folder: Path, use_table_names: List[str]) -> Li
     return tables_found
 
 
-def _make_location_key_and_date_table(index_table: Path, output_path: Path) -> None:
-    # Use a temporary directory for intermediate files
-    with temporary_directory() as workdir:
+def _location_keys_and_dates(index_table: Path) -> Tuple[str, List[str], List[str]]:
+    # Make sure that there is an index table present
+    assert index_table.exists(), "Index table not found"
 
-        # Make sure that there is an index table present
-        assert index_table.exists(), "Index table not found"
+    # Index table will determine if we use "key" or "location_key" as column name
+    index_columns = get_table_columns(index_table)
+    location_key = "location_key" if "location_key" in index_columns else "key"
 
-        # Index table will determine if we use "key" or "location_key" as column name
-        index_columns = get_table_columns(index_table)
-        location_key = "location_key" if "location_key" in index_columns else "key"
+    # Keys are output in sorted order, which is how the merged table has always been sorted
+    location_keys = sorted(table_read_column(index_table, location_key))
 
-        # Create a single-column table with only the keys
-        keys_table_path = workdir / "location_keys.csv"
-        with open(keys_table_path, "w") as fd:
-            fd.write(f"{location_key}\n")
-            fd.writelines(f"{value}\n" for value in table_read_column(index_table, location_key))
+    # Add a date to each region from index up until tomorrow
+    max_date = (datetime.datetime.now() + datetime.timedelta(days=1)).date().isoformat()
+    dates = list(date_range("2020-01-01", max_date))
 
-        # Add a date to each region from index to allow iterative left joins
-        max_date = (datetime.datetime.now() + datetime.timedelta(days=1)).date().isoformat()
-        date_table_path = workdir / "dates.csv"
-        with open(date_table_path, "w") as fd:
-            fd.write("date\n")
-            fd.writelines(f"{value}\n" for value in date_range("2020-01-01", max_date))
+    return location_key, location_keys, dates
 
-        # Output all combinations of <key x date>
-        table_cross_product(keys_table_path, date_table_path, output_path)
+
+def _grouped_table_records(
+    table_path: Path, location_key: str, join_on: List[str], output_columns: List[str]
+) -> Iterator[Tuple[Optional[str], Dict[Tuple[str, ...], List[Optional[str]]]]]:
+    """
+    Reads a table sorted by `join_on` as pairs of <location key, records of that location> where
+    the records are keyed by the remaining join columns. Tables which are not joined by location
+    key are read into a single group with None as the location, which applies to all locations.
+    If there are several records with the same join key, the last one is used.
+    """
+    records = table_merge_sorted([table_path], join_on, output_columns)
+    if location_key not in join_on:
+        yield None, {key: values for key, values in records}
+        return
+
+    for location, group in groupby(records, key=lambda item: item[0][0]):
+        yield location, {key[1:]: values for key, values in group}
+
+
+def _sorted_tables(table_paths: List[Path], workdir: Path) -> List[Path]:
+    """ Sorts the tables which are not sorted by their join columns into `workdir` """
+    sorted_paths = []
+    for idx, table_file_path in enumerate(table_paths):
+        table_columns = get_table_columns(table_file_path)
+        join_on = [col for col in ("key", "location_key", "date") if col in table_columns]
+        if not table_is_sorted(table_file_path, join_on):
+            sorted_table_path = workdir / f"{idx}.{table_file_path.name}"
+            table_sort(table_file_path, sorted_table_path, join_on)
+            table_file_path = sorted_table_path
+        sorted_paths.append(table_file_path)
+    return sorted_paths
+
+
+def _merge_location_rows(
+    tables_folder: Path,
+    table_paths: List[Path],
+    workdir: Path,
+    location_filter: Optional[Set[str]] = None,
+) -> Tuple[List[str], Iterator[Tuple[str, List[List[Optional[str]]]]]]:
+    """
+    Performs a single-pass sorted merge join of `table_paths` over all combinations of <location
+    key x date>. Each table is read in order of <key, date> alongside the sorted location keys, and
+    the rows for each location key are only generated once the previous location has been output.
+    Tables which are not sorted by their join columns are sorted into `workdir` first.
+
+    Arguments:
+        tables_folder: Input directory where the index.csv file exists.
+        table_paths: Tables to merge, the columns of which will be output in the same order.
+        workdir: Temporary directory which must exist until all the rows have been read.
+        location_filter: Location keys to output, defaults to all the keys in the index table.
+    Returns:
+        Tuple[List[str], Iterator[Tuple[str, List[List[Optional[str]]]]]]: The output columns,
+            and pairs of <location key, rows> sorted by location key.
+    """
+    # All combinations of <location key x date> are output, but never held in memory at once
+    location_key, location_keys, dates = _location_keys_and_dates(tables_folder / "index.csv")
+
+    # Tables must be sorted by their join columns to be read in a single pass
+    table_paths = _sorted_tables(table_paths, workdir)
+
+    output_columns = [location_key, "date"]
+    table_readers = []
+    for table_file_path in table_paths:
+        # Join by <location key> or <location key x date> depending on what's available
+        table_columns = get_table_columns(table_file_path)
+        join_on = [col for col in ("key", "location_key", "date") if col in table_columns]
+        assert all(
+            col in output_columns[:2] for col in join_on
+        ), f"Join columns {join_on} not present in index table, found {output_columns[:2]}"
+
+        # Only the columns which are not part of the join are added to the output
+        table_output_columns = list({col: None for col in table_columns if col not in join_on})
+        output_columns += table_output_columns
+
+        records = _grouped_table_records(
+            table_file_path, location_key, join_on, table_output_columns
+        )
+        empty_values = [None] * len(table_output_columns)
+        table_readers.append(["date" in join_on, empty_values, records, next(records, None)])
+
+    last_location = None if location_filter is None else max(location_filter, default=None)
+
+    def _location_rows() -> Iterator[Tuple[str, List[List[Optional[str]]]]]:
+        for location, location_count in groupby(location_keys):
+            if location_filter is not None and location not in location_filter:
+                # Keys are sorted, so there is nothing left to output after the last filtered one
+                if last_location is None or location > last_location:
+                    break
+                continue
+
+            location_groups = []
+            for reader in table_readers:
+                by_date, _, records, head = reader
+
+                # Advance the table's records until they reach the current location key
+                while head is not None and head[0] is not None and head[0] < location:
+                    head = next(records, None)
+                reader[3] = head
+
+                matched = head is not None and head[0] in (None, location)
+                location_groups.append(head[1] if matched else {})
+
+            location_rows = []
+            for date in dates:
+                row = [location, date]
+                for reader, group in zip(table_readers, location_groups):
+                    by_date, empty_values = reader[0], reader[1]
+                    row += group.get((date,) if by_date else (), empty_values)
+                location_rows.append(row)
+
+            # Duplicate location keys are output once for each time they appear in the index
+            yield location, location_rows * len(list(location_count))
+
+    return output_columns, _location_rows()
 
 
 def merge_output_tables(
@@ -151,7 +259,8 @@ def merge_output_tables(
 ) -> None:
     """
     Build a flat view of all tables combined, joined by <key> or <key, date>. This function
-    requires index.csv to be present under `tables_folder`.
+    requires index.csv to be present under `tables_folder`. The output is written in a single
+    pass, without building all combinations of <key x date> first.
 
     Arguments:
         tables_folder: Input directory where all CSV files exist.
@@ -165,36 +274,18 @@ def merge_output_tables(
 
     # Use a temporary directory for intermediate files
     with temporary_directory() as workdir:
+        output_columns, location_rows = _merge_location_rows(tables_folder, table_paths, workdir)
 
-        # Use temporary files to avoid computing everything in memory
-        temp_input = workdir / "tmp.1.csv"
-        temp_output = workdir / "tmp.2.csv"
-
-        # Start with all combinations of <location key x date>
-        _make_location_key_and_date_table(tables_folder / "index.csv", temp_output)
-        temp_input, temp_output = temp_output, temp_input
-
-        for table_file_path in table_paths:
-            # Join by <location key> or <location key x date> depending on what's available
-            table_columns = get_table_columns(table_file_path)
-            join_on = [col for col in ("key", "location_key", "date") if col in table_columns]
-
-            # Iteratively perform left outer joins on all tables
-            table_join(temp_input, table_file_path, join_on, temp_output, how="outer")
-
-            # Flip-flop the temp files to avoid a copy
-            temp_input, temp_output = temp_output, temp_input
-
-        # Drop rows with null date or without a single dated record
-        # TODO: figure out a memory-efficient way to do this
+        merged_table_path = workdir / "merged.csv" if drop_empty_columns else output_path
+        with open_file_like(merged_table_path, mode="w") as fd_out:
+            writer = csv.writer(fd_out)
+            writer.writerow(output_columns)
+            for _, rows in location_rows:
+                writer.writerows(rows)
 
         # Remove columns which provide no data because they are only null values
         if drop_empty_columns:
-            table_drop_nan_columns(temp_input, temp_output)
-            temp_input, temp_output = temp_output, temp_input
-
-        # Ensure that the table is appropriately sorted and write to output location
-        table_sort(temp_input, output_path)
+            table_drop_nan_columns(merged_table_path, output_path)
 
 
 def merge_location_breakout_tables(
@@ -264,17 +355,27 @@ def _try_json_covert(
         return None
 
 
-def convert_tables_to_json(csv_folder: Path, output_folder: Path, **tqdm_kwargs) -> Iterable[Path]:
+def convert_tables_to_json(
+    csv_folder: Path, output_folder: Path, process_count: int = 1, **tqdm_kwargs
+) -> Iterable[Path]:
 
     # Convert all CSV files to JSON using values format
     map_iter = list(csv_folder.glob("**/*.csv"))
     map_opts = dict(total=len(map_iter), desc="Converting to JSON", **tqdm_kwargs)
     map_func = partial(_try_json_covert, get_schema(), csv_folder, output_folder)
-    return list(pbar(map(map_func, map_iter), **map_opts))
+
+    # Each file is converted in a streaming fashion, so they can be converted in parallel
+    if len(map_iter) > 1 and process_count > 1:
+        return list(process_map(map_func, map_iter, max_workers=process_count, **map_opts))
+    else:
+        return list(pbar(map(map_func, map_iter), **map_opts))
 
 
 def publish_location_breakouts(
-    tables_folder: Path, output_folder: Path, use_table_names: List[str] = None
+    tables_folder: Path,
+    output_folder: Path,
+    use_table_names: List[str] = None,
+    process_count: int = 1,
 ) -> List[Path]:
     """
     Breaks out each of the tables in `tables_folder` based on location key, and writes them into
@@ -283,6 +384,7 @@ def publish_location_breakouts(
     Arguments:
         tables_folder: Directory containing input CSV files.
         output_folder: Output path for the resulting location data.
+        process_count: Maximum number of tables to break out in parallel.
     """
     # Default to a known list of tables to use when none is given
     map_iter = _get_tables_in_folder(tables_folder, use_table_names or V2_TABLE_LIST)
@@ -290,7 +392,11 @@ def publish_location_breakouts(
     # Break out each table into separate folders based on the location key
     _logger.log_info(f"Breaking out tables {[x.stem for x in map_iter]}")
     map_func = partial(table_breakout, output_folder=output_folder, breakout_column="location_key")
-    return list(pbar(map(map_func, map_iter), desc="Breaking out tables", total=len(map_iter)))
+    map_opts = dict(total=len(map_iter), desc="Breaking out tables")
+    if process_count > 1:
+        return list(process_map(map_func, map_iter, max_workers=process_count, **map_opts))
+    else:
+        return list(pbar(map(map_func, map_iter), **map_opts))
 
 
 def _aggregate_location_breakouts(
@@ -306,11 +412,22 @@ def _aggregate_location_breakouts(
     return key_output_file
 
 
+def _aggregate_location_breakouts_chunk(
+    tables_folder: Path, output_folder: Path, keys: List[str], use_table_names: List[str] = None
+) -> List[Path]:
+    return [
+        _aggregate_location_breakouts(tables_folder, output_folder, key, use_table_names)
+        for key in keys
+    ]
+
+
 def publish_location_aggregates(
     breakout_folder: Path,
     output_folder: Path,
     location_keys: Iterable[str],
     use_table_names: List[str] = None,
+    process_count: int = 1,
+    chunk_size: int = 256,
     **tqdm_kwargs,
 ) -> List[Path]:
     """
@@ -320,19 +437,101 @@ def publish_location_aggregates(
         tables_folder: Directory containing input CSV files.
         output_folder: Output path for the resulting location data.
         location_keys: List of location keys to do aggregation for.
+        process_count: Maximum number of chunks of location keys to aggregate in parallel.
+        chunk_size: Number of location keys aggregated by each process at a time.
     """
-
-    # Create a main.csv file for each of the locations in parallel
     map_iter = list(location_keys)
     _logger.log_info(f"Aggregating outputs for {len(map_iter)} location keys")
+
+    # Create a main.csv file for each of the locations serially
+    if process_count <= 1:
+        map_opts = dict(total=len(map_iter), desc="Creating location subsets", **tqdm_kwargs)
+        map_func = partial(
+            _aggregate_location_breakouts,
+            breakout_folder,
+            output_folder,
+            use_table_names=use_table_names,
+        )
+        return list(pbar(map(map_func, map_iter), **map_opts))
+
+    # Otherwise, split the sorted keys into contiguous ranges which are aggregated in parallel
+    map_iter = sorted(map_iter)
+    map_iter = [map_iter[idx : idx + chunk_size] for idx in range(0, len(map_iter), chunk_size)]
     map_opts = dict(total=len(map_iter), desc="Creating location subsets", **tqdm_kwargs)
     map_func = partial(
-        _aggregate_location_breakouts,
+        _aggregate_location_breakouts_chunk,
         breakout_folder,
         output_folder,
         use_table_names=use_table_names,
     )
-    return list(pbar(map(map_func, map_iter), **map_opts))
+    results = process_map(map_func, map_iter, max_workers=process_count, **map_opts)
+    return [key_output_file for chunk in results for key_output_file in chunk]
+
+
+def _write_location_table(
+    output_folder: Path,
+    output_columns: List[str],
+    location_rows: Tuple[str, List[List[Optional[str]]]],
+) -> Path:
+    """ Writes the aggregated rows of a single location, dropping the columns without data """
+    location, rows = location_rows
+
+    # Remove columns which provide no data because they are only null values
+    not_nan_columns = [
+        idx
+        for idx in range(len(output_columns))
+        if any(row[idx] is not None and row[idx] != "" for row in rows)
+    ]
+
+    key_output_file = output_folder / f"{location}.csv"
+    with open_file_like(key_output_file, mode="w") as fd_out:
+        writer = csv.writer(fd_out)
+        writer.writerow([output_columns[idx] for idx in not_nan_columns])
+        writer.writerows([row[idx] for idx in not_nan_columns] for row in rows)
+    return key_output_file
+
+
+def publish_location_aggregates_from_tables(
+    tables_folder: Path,
+    output_folder: Path,
+    location_keys: Iterable[str] = None,
+    use_table_names: List[str] = None,
+    process_count: int = 1,
+    **tqdm_kwargs,
+) -> List[Path]:
+    """
+    Produces the same output as breaking out all tables with `publish_location_breakouts` and
+    then calling `publish_location_aggregates`, but reads each of the global tables only once in a
+    single streaming pass instead of opening every table breakout for each location key.
+
+    Arguments:
+        tables_folder: Directory containing the global CSV files, including index.csv.
+        output_folder: Output path for the resulting location data.
+        location_keys: List of location keys to do aggregation for, defaults to all in the index.
+        use_table_names: Tables which should be included in the aggregated outputs.
+        process_count: Maximum number of processes writing the rows of each location key, which
+            are still read from the tables in a single pass by the main process.
+    Returns:
+        List[Path]: The paths of the aggregated table for each location key.
+    """
+    # Default to a known list of tables to use when none is given
+    table_paths = _get_tables_in_folder(tables_folder, use_table_names or V2_TABLE_LIST)
+    location_filter = None if location_keys is None else set(location_keys)
+    total = None if location_filter is None else len(location_filter)
+
+    with temporary_directory() as workdir:
+        output_columns, location_rows = _merge_location_rows(
+            tables_folder, table_paths, workdir, location_filter=location_filter
+        )
+
+        map_func = partial(_write_location_table, output_folder, output_columns)
+        map_opts = dict(total=total, desc="Creating location subsets", **tqdm_kwargs)
+        if process_count <= 1:
+            return list(pbar(map(map_func, location_rows), **map_opts))
+
+        # Only a bounded number of locations are read ahead of the processes writing them
+        map_opts.update(max_workers=process_count, max_pending=4 * process_count)
+        return list(process_map(map_func, location_rows, **map_opts))
 
 
 def publish_global_tables(
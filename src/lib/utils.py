@@ -15,8 +15,9 @@
 import re
 from functools import partial, reduce
 from typing import Any, Callable, List, Dict, Tuple, Optional
+import numpy
 from numpy import unique
-from pandas import DataFrame, Series, concat, merge
+from pandas import DataFrame, Series, concat, factorize, merge
 from pandas.api.types import is_numeric_dtype
 from .cast import isna, safe_int_cast
 from .io import fuzzy_text
@@ -88,11 +89,60 @@ def agg_last_not_null(series: Series) -> Series:
     return reduce(lambda x, y: y if not isna(y) else x, series)
 
 
-def combine_tables(tables: List[DataFrame], index: List[str]) -> DataFrame:
-    """ Combine a list of tables, keeping the last non-null value for every column """
+def _last_not_null(data: DataFrame, index: List[str]) -> DataFrame:
+    """
+    Vectorized equivalent of aggregating `data` grouped by `index` with `agg_last_not_null`. Rows
+    are stably sorted by group, and the last valid position of every group is found for all the
+    value columns at once using a running maximum over the positions of the non-null values.
+    """
+    # Groups are numbered in sorted order, and rows with null index values get dropped
+    group_ids = data.groupby(index, sort=True).ngroup().values
+    order = numpy.argsort(group_ids, kind="stable")
+    order = order[group_ids[order] >= 0]
+    group_ids = group_ids[order]
+
+    row_count = len(order)
+    boundaries = group_ids[1:] != group_ids[:-1]
+    group_starts = numpy.flatnonzero(numpy.concatenate([[True], boundaries]))[:row_count]
+    group_ends = numpy.flatnonzero(numpy.concatenate([boundaries, [True]]))[:row_count]
+
+    # Positions of the non-null values, where the running maximum is the last valid position
+    value_columns = [col for col in data.columns if col not in index]
+    positions = numpy.arange(row_count)
+    valid = data[value_columns].notna().values[order]
+    last_valid = numpy.maximum.accumulate(numpy.where(valid, positions[:, None], -1), axis=0)
+    last_valid = last_valid[group_ends]
+    missing = last_valid < group_starts[:, None]
+
+    result = {col: data[col].values[order][group_starts] for col in index}
+    for idx, col in enumerate(value_columns):
+        values = data[col].iloc[order[numpy.maximum(last_valid[:, idx], 0)]]
+        if missing[:, idx].any():
+            values = values.where(~missing[:, idx])
+        result[col] = values.values
+
+    return DataFrame(result, columns=index + value_columns)
+
+
+def combine_tables(tables: List[DataFrame], index: List[str], engine: str = "numpy") -> DataFrame:
+    """
+    Combine a list of tables, keeping the last non-null value for every column.
+
+    Arguments:
+        tables: Tables to combine, in order of increasing precedence.
+        index: Columns used to identify the records being combined.
+        engine: Implementation used to combine the records, "numpy" for the vectorized kernel or
+            "python" to aggregate each group with `agg_last_not_null`.
+    Returns:
+        DataFrame: Combined table, with a single record per index sorted by the index columns.
+    """
     data = tables[0] if hasattr(tables, "__len__") and len(tables) == 1 else concat(tables)
-    grouped = data.groupby([col for col in index if col in data.columns])
-    return grouped.aggregate(agg_last_not_null).reset_index()
+    index = [col for col in index if col in data.columns]
+    if engine == "python":
+        return data.groupby(index).aggregate(agg_last_not_null).reset_index()
+    if engine == "numpy":
+        return _last_not_null(data, index)
+    raise ValueError(f"Unknown combine engine {engine}")
 
 
 def drop_na_records(table: DataFrame, keys: List[str], inplace: bool = False) -> DataFrame:
@@ -149,13 +199,135 @@ def grouped_transform(
     return data
 
 
+# Maximum number of cells in the padded matrix of groups used to compute each grouped cumsum
+_SEGMENT_CUMSUM_MAX_CELLS = 1 << 24
+
+
+def _segment_ffill(values: numpy.ndarray, row_starts: numpy.ndarray) -> numpy.ndarray:
+    """ Forward-fills null values within each group, given the position where each group starts """
+    if values.dtype.kind != "f":
+        return values
+    positions = numpy.where(numpy.isnan(values), -1, numpy.arange(len(values)))
+    last_valid = numpy.maximum.accumulate(positions)
+    return numpy.where(last_valid >= row_starts, values[numpy.maximum(last_valid, 0)], numpy.nan)
+
+
+def _segment_diff(values: numpy.ndarray, starts: numpy.ndarray, row_starts: numpy.ndarray):
+    """ Vectorized equivalent of `x.ffill().diff()` for each group of rows """
+    values = _segment_ffill(values, row_starts)
+    output = numpy.empty(len(values), dtype=float)
+    output[1:] = values[1:] - values[:-1]
+    output[starts] = numpy.nan
+    return output
+
+
+def _segment_cumsum(values: numpy.ndarray, starts: numpy.ndarray, row_starts: numpy.ndarray):
+    """
+    Vectorized equivalent of `x.fillna(0).cumsum()` for each group of rows. Groups are laid out as
+    the rows of a zero-padded matrix, so the cumulative sum of each one is computed sequentially
+    and produces the exact same floating point output as computing it separately.
+    """
+    if values.dtype.kind == "f":
+        values = numpy.where(numpy.isnan(values), 0, values)
+    output = numpy.empty_like(values)
+    offsets = numpy.arange(len(values)) - row_starts
+
+    # Sort the groups by length, so groups of similar length are processed together and the padded
+    # matrices remain small
+    lengths = numpy.diff(numpy.append(starts, len(values)))
+    group_order = numpy.argsort(lengths, kind="stable")
+    group_rank = numpy.empty_like(group_order)
+    group_rank[group_order] = numpy.arange(len(group_order))
+    row_ranks = group_rank[numpy.searchsorted(starts, row_starts)]
+    row_order = numpy.argsort(row_ranks, kind="stable")
+    sorted_lengths = lengths[group_order]
+    sorted_ends = numpy.cumsum(sorted_lengths)
+
+    chunk_start = 0
+    while chunk_start < len(group_order):
+        # Add groups to the chunk until the padded matrix would have too many cells
+        chunk_cells = numpy.arange(1, len(group_order) - chunk_start + 1)
+        chunk_cells *= sorted_lengths[chunk_start:]
+        chunk_size = max(1, numpy.searchsorted(chunk_cells, _SEGMENT_CUMSUM_MAX_CELLS, "right"))
+        chunk_end = chunk_start + chunk_size
+
+        first_row = sorted_ends[chunk_start - 1] if chunk_start > 0 else 0
+        rows = row_order[first_row : sorted_ends[chunk_end - 1]]
+        matrix_rows = row_ranks[rows] - chunk_start
+        matrix = numpy.zeros((chunk_size, sorted_lengths[chunk_end - 1]), dtype=values.dtype)
+        matrix[matrix_rows, offsets[rows]] = values[rows]
+        output[rows] = numpy.cumsum(matrix, axis=1)[matrix_rows, offsets[rows]]
+        chunk_start = chunk_end
+
+    return output
+
+
+def _grouped_segment_transform(
+    data: DataFrame,
+    keys: List[str],
+    segment_transform: Callable,
+    transform: Callable,
+    skip: List[str] = None,
+    prefix: Tuple[str, str] = None,
+) -> DataFrame:
+    """
+    Vectorized equivalent of `grouped_transform`, which sorts the data by `keys` and applies
+    `segment_transform` to all the rows of each value column at once, given the boundaries of each
+    group. Columns which are not numeric fall back to calling `transform` for each group.
+    """
+    assert keys[-1] == "date", '"date" key should be last'
+    group_keys = keys[:-1]
+
+    # Rows with null keys are not part of any group, which is handled by the original function
+    if len(data) == 0 or any(data[col].isnull().any() for col in group_keys):
+        return grouped_transform(data, keys, transform, skip=skip, prefix=prefix)
+
+    # Keep a copy of the columns that will not be transformed
+    data = data.sort_values(keys)
+    skip = [] if skip is None else skip
+    data_skipped = {col: data[col].copy() for col in skip if col in data}
+
+    # Find the position where the group of each row starts
+    boundaries = numpy.zeros(len(data), dtype=bool)
+    boundaries[0] = True
+    for col in group_keys:
+        col_values = data[col].values
+        boundaries[1:] |= col_values[1:] != col_values[:-1]
+    starts = numpy.flatnonzero(boundaries)
+    row_starts = numpy.maximum.accumulate(numpy.where(boundaries, numpy.arange(len(data)), 0))
+
+    prefix = ("", "") if prefix is None else prefix
+    value_columns = [column for column in data.columns if column not in keys + skip]
+
+    output_mask = data[value_columns].notna().any(axis=1).values
+    output = data[output_mask].copy()
+    for column in value_columns:
+        if output[column].isnull().all():
+            continue
+        output_column = prefix[0] + column.replace(prefix[1], "")
+        dtype = data[column].dtype
+        if isinstance(dtype, numpy.dtype) and dtype.kind in ("i", "u", "f"):
+            values = segment_transform(data[column].values, starts, row_starts)
+            output[output_column] = values[output_mask]
+        else:
+            output[output_column] = data.groupby(group_keys)[column].apply(transform)
+
+    # Restore the columns that were not transformed
+    for name, col in data_skipped.items():
+        output[name] = col
+
+    return output
+
+
 def grouped_diff(
     data: DataFrame,
     keys: List[str],
     skip: List[str] = None,
     prefix: Tuple[str, str] = ("new_", "total_"),
 ) -> DataFrame:
-    return grouped_transform(data, keys, lambda x: x.ffill().diff(), skip=skip, prefix=prefix)
+    return _grouped_segment_transform(
+        data, keys, _segment_diff, lambda x: x.ffill().diff(), skip=skip, prefix=prefix
+    )
 
 
 def grouped_cumsum(
@@ -164,7 +336,9 @@ def grouped_cumsum(
     skip: List[str] = None,
     prefix: Tuple[str, str] = ("total_", "new_"),
 ) -> DataFrame:
-    return grouped_transform(data, keys, lambda x: x.fillna(0).cumsum(), skip=skip, prefix=prefix)
+    return _grouped_segment_transform(
+        data, keys, _segment_cumsum, lambda x: x.fillna(0).cumsum(), skip=skip, prefix=prefix
+    )
 
 
 def stack_table(
@@ -198,18 +372,26 @@ def stack_table(
     stash_output = data[stash_columns].copy()
     data = data.drop(columns=stash_columns)
 
-    # Aggregate (stack) columns with respect to the value columns
+    # Aggregate all the value columns with respect to each stack column using a single groupby,
+    # with the stacked values replaced by their integer codes in order of appearance
+    stacked_columns: Dict[str, numpy.ndarray] = {}
     for col_stack in stack_columns:
-        col_stack_values = data[col_stack].dropna().unique()
+        codes, col_stack_values = factorize(data[col_stack])
+        mask = codes >= 0
+        if not mask.any():
+            continue
+        df = data.loc[mask, index_columns + value_columns]
+        df = df.groupby(index_columns + [codes[mask]]).sum().unstack(-1).reindex(output.index)
         for col_variable in value_columns:
-            df = data[index_columns + [col_variable, col_stack]].copy()
-            df = df.pivot_table(
-                values=col_variable, index=index_columns, columns=[col_stack], aggfunc="sum"
-            )
-            column_mapping = {suffix: f"{col_variable}_{suffix}" for suffix in col_stack_values}
-            df = df.rename(columns=column_mapping)
-            transfer_columns = list(column_mapping.values())
-            output[transfer_columns] = df[transfer_columns]
+            for code, suffix in enumerate(col_stack_values):
+                stacked_columns[f"{col_variable}_{suffix}"] = df[(col_variable, code)].values
+
+    # Transfer all the stacked columns at once, overwriting the ones which already exist
+    stacked = DataFrame(stacked_columns, index=output.index)
+    existing_columns = [col for col in stacked.columns if col in output.columns]
+    if existing_columns:
+        output[existing_columns] = stacked[existing_columns]
+    output = concat([output, stacked.drop(columns=existing_columns)], axis=1)
 
     # Restore the stashed columns, reset index and return
     output[stash_columns] = stash_output
@@ -304,10 +486,14 @@ def stratify_age_sex_ethnicity(data: DataFrame) -> DataFrame:
     has_age = "age" in data.columns
     if has_age:
 
-        # If a data source reports too many age buckets, compress all those > 90
-        data.loc[
-            data["age"].apply(lambda x: (safe_int_cast(str(x).split("-")[-1]) or 0) > 90), "age"
-        ] = "90-"
+        # If a data source reports too many age buckets, compress all those > 90. Only the distinct
+        # buckets are parsed, and the result is broadcast back to all records using their codes
+        age_codes, age_buckets = factorize(data["age"])
+        age_upper = Series(age_buckets.astype(str)).str.split("-").str[-1]
+        age_cutoff = age_upper.map(lambda x: (safe_int_cast(x) or 0) > 90).tolist()
+        # Records with no age have code -1, which picks the trailing item
+        age_cutoff = numpy.array(age_cutoff + [False], dtype=bool)
+        data.loc[age_cutoff[age_codes], "age"] = "90-"
 
         # Stratified age uses a prefix since it's less obvious from the value names
         data["age"] = age_prefix + data["age"]
@@ -396,16 +582,29 @@ def backfill_cumulative_fields_inplace(data: DataFrame, columns: Optional[List]
         # Early return, nothing to do here.
         return data
 
-    groups = data.groupby(["key"])
-    for group in groups:
-        name, group_data = group
-        group_data = group_data.sort_values(by="date", ascending=False)
-        for column in columns:
-            # Need to fill the last item with 0 if it's null for bfill purposes.
-            if isna(group_data.loc[group_data.last_valid_index(), column]):
-                group_data.loc[group_data.last_valid_index(), column] = 0
+    # Sort the records with a key once, so the records of each key are contiguous and in date
+    # order. Records without a date come first, like they would be last in descending order.
+    index = DataFrame({"key": data["key"].values, "date": data["date"].values})
+    index = index[index["key"].notna()]
+    index = index.sort_values(["key", "date"], kind="stable", na_position="first")
+    order = index.index.values
+    if len(order) == 0:
+        return data
+
+    # Flag the first record of each key, which is filled with 0 if null for bfill purposes
+    keys = index["key"].values
+    first = numpy.concatenate([[True], keys[1:] != keys[:-1]])
+    group_ids = numpy.cumsum(first)
+
+    for column in columns:
+        values = data[column].iloc[order].reset_index(drop=True)
+        seed_mask = first & values.isna().values
+        if seed_mask.any():
+            values[seed_mask] = 0
 
-            data.loc[data["key"] == name, column] = group_data[column].bfill()
+        # Filling forward in date order is the same as backfilling in descending date order
+        values = values.groupby(group_ids).ffill()
+        data.iloc[order, data.columns.get_loc(column)] = values.values
 
 
 def filter_columns(expr_list: List[str], columns: List[str]) -> List[str]:
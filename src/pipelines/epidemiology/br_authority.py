@@ -30,7 +30,7 @@ from lib.error_logger import ErrorLogger
 from lib.concurrent import process_map, thread_map
 from lib.io import temporary_directory
 from lib.memory_efficient import table_concat
-from lib.net import download_snapshot
+from lib.net import download_snapshot, snapshot_path, url_probe
 from lib.pipeline import DataSource
 from lib.time import datetime_isoformat, date_today
 from lib.utils import table_rename
@@ -173,6 +173,30 @@ _open_data_portal_column_adapter = {
 }
 
 
+def _discover_volumes(
+    url_tpl: str,
+    output_folder: Path,
+    ibge_code: str,
+    max_volumes: int,
+    skip_existing: bool = False,
+    **download_opts,
+) -> List[int]:
+    """ Outputs the volume numbers available for the state, stopping at the first missing one """
+    probe = url_probe(**download_opts)
+    ext = download_opts.get("ext")
+    for idx in range(max_volumes):
+        url = url_tpl.format(f"{ibge_code}-{idx + 1}")
+
+        # Volumes which were already downloaded do not need to be probed
+        if skip_existing and snapshot_path(url, output_folder, ext=ext).exists():
+            continue
+
+        if not probe(url):
+            return list(range(1, idx + 1))
+
+    return list(range(1, max_volumes + 1))
+
+
 def _download_open_data(
     logger: ErrorLogger,
     url_tpl: str,
@@ -183,14 +207,17 @@ def _download_open_data(
 ) -> Dict[str, str]:
     logger.log_debug(f"Downloading Brazil data for {ibge_code}...")
 
+    # Find out which volumes exist using lightweight requests before downloading them
+    volumes = _discover_volumes(url_tpl, output_folder, ibge_code, max_volumes, **download_opts)
+
     # Since we are guessing the URL, we forgive errors in the download
     output = {}
     download_opts = dict(download_opts, ignore_failure=True)
     map_func = partial(download_snapshot, output_folder=output_folder, **download_opts)
-    map_iter = [url_tpl.format(f"{ibge_code}-{idx + 1}") for idx in range(max_volumes)]
-    for idx, file_path in enumerate(thread_map(map_func, map_iter)):
+    map_iter = [url_tpl.format(f"{ibge_code}-{volume}") for volume in volumes]
+    for volume, file_path in zip(volumes, thread_map(map_func, map_iter)):
         if file_path is not None:
-            output[f"{ibge_code}-{idx + 1}"] = file_path
+            output[f"{ibge_code}-{volume}"] = file_path
 
     # Filter out empty files, which can happen if download fails in an unexpected way
     output = {name: path for name, path in output.items() if Path(path).stat().st_size > 0}
@@ -12,7 +12,6 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-import json
 import uuid
 from pathlib import Path
 from datetime import datetime
@@ -21,7 +20,7 @@ from typing import Any, Callable, Dict, List
 import requests
 from pandas import DataFrame, concat
 
-from lib.arcgis_data_source import ArcGISDataSource
+from lib.arcgis_data_source import ArcGISDataSource, read_arcgis_records
 from lib.utils import table_merge
 
 
@@ -38,8 +37,7 @@ _island_map = {
 
 class CanaryIslandsDataSource(ArcGISDataSource):
     def parse(self, sources: Dict[str, str], aux: Dict[str, DataFrame], **parse_opts) -> DataFrame:
-        with open(sources[0], "r") as fd:
-            features = json.load(fd)["features"]
+        features = read_arcgis_records(sources[0])
 
         records = {"confirmed": [], "deceased": [], "recovered": []}
         for record in features:
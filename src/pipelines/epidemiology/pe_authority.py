@@ -17,7 +17,7 @@ from pandas import DataFrame, concat
 from lib.cast import safe_int_cast, safe_str_cast
 from lib.data_source import DataSource
 from lib.case_line import convert_cases_to_time_series
-from lib.io import fuzzy_text
+from lib.io import fuzzy_text_series
 from lib.time import datetime_isoformat
 from lib.utils import table_merge, table_rename
 
@@ -114,8 +114,8 @@ class PeruDataSource(DataSource):
         data["subregion2_name"] = ""
 
         # Convert other text fields to lowercase for consistent processing
-        data["match_string"] = data["match_string"].apply(fuzzy_text)
-        data["province_name"] = data["province_name"].apply(fuzzy_text)
+        data["match_string"] = fuzzy_text_series(data["match_string"])
+        data["province_name"] = fuzzy_text_series(data["province_name"])
 
         # Drop bogus records
         data = data[~data["match_string"].isna()]
@@ -12,13 +12,12 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-import json
 import datetime
 from typing import Any, Dict
 
 from pandas import DataFrame, concat
 
-from lib.arcgis_data_source import ArcGISDataSource
+from lib.arcgis_data_source import ArcGISDataSource, read_arcgis_records
 from lib.case_line import convert_cases_to_time_series
 from lib.cast import safe_int_cast
 
@@ -27,8 +26,7 @@ fromtimestamp = datetime.datetime.fromtimestamp
 
 class FloridaDataSource(ArcGISDataSource):
     def parse(self, sources: Dict[Any, str], aux: Dict[str, DataFrame], **parse_opts) -> DataFrame:
-        with open(sources[0], "r") as fd:
-            records = json.load(fd)["features"]
+        records = read_arcgis_records(sources[0])
 
         cases = DataFrame.from_records(records)
         cases["date_new_confirmed"] = cases["ChartDate"].apply(
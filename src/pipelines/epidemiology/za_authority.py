@@ -12,20 +12,18 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-import json
 from datetime import datetime
 from typing import Dict
 
 from pandas import DataFrame
 
-from lib.arcgis_data_source import ArcGISDataSource
+from lib.arcgis_data_source import ArcGISDataSource, read_arcgis_records
 from lib.utils import table_rename
 
 
 class SouthAfricaDataSource(ArcGISDataSource):
     def parse(self, sources: Dict[str, str], aux: Dict[str, DataFrame], **parse_opts) -> DataFrame:
-        with open(sources[0], "r") as fd:
-            features = json.load(fd)["features"]
+        features = read_arcgis_records(sources[0])
 
         data = table_rename(
             DataFrame.from_records(features),
@@ -17,6 +17,7 @@ from typing import Any, Dict, List
 from pandas import DataFrame, concat
 from lib.concurrent import thread_map
 from lib.data_source import DataSource
+from lib.net import parallel_download, snapshot_path
 
 
 def _normalize_column_name(column: str) -> str:
@@ -118,9 +119,25 @@ class GoogleSearchTrendsDataSource(DataSource):
                             level="sub_region_1", region_code=key, year=year
                         )
 
-        # Replace the fetch options with our own processed options
-        fetch_opts = [{"name": key, "url": url, **base_opts} for key, url in url_list.items()]
-        return super().fetch(output_folder, cache, fetch_opts, skip_existing=skip_existing)
+        # Download all the files using a single event loop, since there can be thousands of them
+        (output_folder / "snapshot").mkdir(parents=True, exist_ok=True)
+        download_opts = dict(base_opts.get("opts", {}))
+        ext = download_opts.pop("ext", None)
+        file_paths = {key: snapshot_path(url, output_folder, ext) for key, url in url_list.items()}
+        download_keys = [
+            key for key, path in file_paths.items() if not skip_existing or not path.exists()
+        ]
+
+        # Files which have not changed since they were last downloaded are not downloaded again
+        parallel_download(
+            [url_list[key] for key in download_keys],
+            [file_paths[key] for key in download_keys],
+            engine="asyncio",
+            conditional=True,
+            logger=self,
+            **download_opts,
+        )
+        return {key: str(path.absolute()) for key, path in file_paths.items()}
 
     def parse_dataframes(
         self, dataframes: Dict[str, DataFrame], aux: Dict[str, DataFrame], **parse_opts
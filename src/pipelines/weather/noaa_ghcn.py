@@ -20,11 +20,13 @@ from typing import Any, Dict, List
 
 import numpy
 from pandas import DataFrame, Series, read_csv, concat
+from pandas.api.types import is_bool_dtype, is_numeric_dtype
 
 from lib.cast import safe_int_cast
 from lib.concurrent import thread_map
 from lib.constants import URL_OUTPUTS_PROD
 from lib.data_source import DataSource
+from lib.geo import GeoIndex
 from lib.net import download_snapshot
 from lib.utils import combine_tables
 
@@ -57,41 +59,33 @@ _STATION_URL_TPL = "https://open-covid-19.github.io/weather/ghcn/{}.csv"
 
 
 class NoaaGhcnDataSource(DataSource):
-    @staticmethod
-    def haversine_distance(
-        stations: DataFrame, lat: float, lon: float, radius: float = 6373.0
-    ) -> Series:
-        """ Compute the distance between two <latitude, longitude> pairs in kilometers """
-
-        # Compute the pairwise deltas
-        lat_diff = stations.lat - lat
-        lon_diff = stations.lon - lon
-
-        # Apply Haversine formula
-        a = numpy.sin(lat_diff / 2) ** 2
-        a += math.cos(lat) * numpy.cos(stations.lat) * numpy.sin(lon_diff / 2) ** 2
-        c = numpy.arctan2(numpy.sqrt(a), numpy.sqrt(1 - a)) * 2
-
-        return radius * c
-
     @staticmethod
     def fix_temp(value: int):
         value = safe_int_cast(value)
         return None if value is None else "%.1f" % (value / 10.0)
 
     @staticmethod
-    def station_records(station_cache: Dict[str, DataFrame], stations: DataFrame, location: Series):
-        nearest = stations.copy()
-        nearest["key"] = location.key
-
-        # Get the nearest stations from our list of stations given lat and lon
-        nearest["distance"] = NoaaGhcnDataSource.haversine_distance(
-            nearest, location.lat, location.lon
-        )
-
-        # Filter out the 10 nearest stations
-        nearest = nearest[nearest.distance < _DISTANCE_THRESHOLD].sort_values("distance").iloc[:20]
+    def fix_temps(values: Series) -> Series:
+        """
+        Same as `fix_temp` applied to each value, but vectorized for numeric columns. Values are
+        truncated to integers and only the distinct values are formatted, which are few since
+        temperatures are measured in tenths of a degree.
+        """
+        if len(values) == 0 or not is_numeric_dtype(values) or is_bool_dtype(values):
+            return values.apply(NoaaGhcnDataSource.fix_temp)
+
+        numbers = values.values.astype(float)
+        valid = numpy.isfinite(numbers)
+        integers = numpy.trunc(numpy.where(valid, numbers, 0)).astype(numpy.int64)
+        distinct, inverse = numpy.unique(integers, return_inverse=True)
+        labels = numpy.array([NoaaGhcnDataSource.fix_temp(int(x)) for x in distinct], dtype=object)
+
+        output = Series(labels[inverse], index=values.index, dtype=object)
+        output[~valid] = None
+        return output
 
+    @staticmethod
+    def station_records(station_cache: Dict[str, DataFrame], nearest: DataFrame):
         # Early exit: no stations found within distance threshold
         if len(nearest) == 0:
             return DataFrame(columns=_OUTPUT_COLUMNS)
@@ -106,12 +100,8 @@ class NoaaGhcnDataSource(DataSource):
             data = data.rename(columns=_COLUMN_MAPPING)
 
             # Convert temperature to correct values
-            data["minimum_temperature"] = data["minimum_temperature"].apply(
-                NoaaGhcnDataSource.fix_temp
-            )
-            data["maximum_temperature"] = data["maximum_temperature"].apply(
-                NoaaGhcnDataSource.fix_temp
-            )
+            for col in ("minimum_temperature", "maximum_temperature"):
+                data[col] = NoaaGhcnDataSource.fix_temps(data[col])
 
             # Get only data for 2020 and add location values
             data = data[data.date > "2019-12-31"]
@@ -159,14 +149,29 @@ class NoaaGhcnDataSource(DataSource):
         metadata["lat"] = metadata.latitude.apply(math.radians)
         metadata["lon"] = metadata.longitude.apply(math.radians)
 
+        # Find the 20 nearest stations to every location within the distance threshold at once
+        station_index = GeoIndex(stations.lat.values, stations.lon.values)
+        location_idx, station_idx, distance = station_index.nearest(
+            metadata.lat.values, metadata.lon.values, k=20, max_distance=_DISTANCE_THRESHOLD
+        )
+        nearest = DataFrame(
+            {
+                "key": metadata.key.values[location_idx],
+                "id": stations.id.values[station_idx],
+                "distance": distance,
+            }
+        )
+        nearest_groups = {idx: group for idx, group in nearest.groupby(location_idx)}
+
         # Use a cache to avoid having to query the same station multiple times
         station_cache: Dict[str, DataFrame] = {}
 
-        # Make sure the stations and the cache are sent to each function call
-        map_func = partial(NoaaGhcnDataSource.station_records, station_cache, stations)
+        # Make sure the cache is sent to each function call
+        map_func = partial(NoaaGhcnDataSource.station_records, station_cache)
 
-        # We don't care about the index while iterating over each metadata item
-        map_iter = [record for _, record in metadata.iterrows()]
+        # Each location only needs the table of its nearest stations
+        empty = nearest.iloc[:0]
+        map_iter = [nearest_groups.get(idx, empty) for idx in range(len(metadata))]
 
         # Shuffle the iterables to try to make better use of the caching
         shuffle(map_iter)
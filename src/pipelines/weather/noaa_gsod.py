@@ -17,16 +17,20 @@ import math
 import tarfile
 import datetime
 from functools import partial
-from multiprocessing import Manager
-from typing import Dict
+from io import BytesIO
+from itertools import islice
+from pathlib import Path
+from typing import Dict, Iterator, List, Optional, Tuple
 
 import numpy
-from pandas import DataFrame, Series, concat
+from pandas import DataFrame, Series, concat, isna
+from pandas.api.types import is_bool_dtype, is_numeric_dtype
 
 from lib.cast import safe_float_cast
 from lib.concurrent import process_map
 from lib.data_source import DataSource
-from lib.io import pbar, read_file
+from lib.geo import GeoIndex
+from lib.io import read_file, temporary_directory
 
 
 _COLUMN_MAPPING = {
@@ -42,22 +46,8 @@ _COLUMN_MAPPING = {
 _OUTPUT_COLUMNS = ["date", "key", "noaa_station", "noaa_distance"]
 _DISTANCE_THRESHOLD = 300
 
-
-def haversine_distance(
-    stations: DataFrame, lat: float, lon: float, radius: float = 6373.0
-) -> Series:
-    """ Compute the distance between two <latitude, longitude> pairs in kilometers """
-
-    # Compute the pairwise deltas
-    lat_diff = stations["lat"] - lat
-    lon_diff = stations["lon"] - lon
-
-    # Apply Haversine formula
-    a = numpy.sin(lat_diff / 2) ** 2
-    a += math.cos(lat) * numpy.cos(stations["lat"]) * numpy.sin(lon_diff / 2) ** 2
-    c = numpy.arctan2(numpy.sqrt(a), numpy.sqrt(1 - a)) * 2
-
-    return radius * c
+# Maximum number of station files read into memory before they are parsed by other processes
+_DECOMPRESS_BATCH_SIZE = 4096
 
 
 def noaa_number(value: int):
@@ -74,6 +64,33 @@ def conv_dist(value: int):
     return numpy.nan if value is None else value * 25.4
 
 
+def noaa_numbers(values: Series) -> Series:
+    """
+    Same as `noaa_number` applied to each value, but vectorized for numeric columns. Missing values
+    are encoded as numbers whose digits start with 999, which are the numbers with a mantissa
+    between 9.99 and 10 if they are at least 1. Only values too close to the boundaries to decide
+    using floating point arithmetic are checked using their string representation.
+    """
+    if not is_numeric_dtype(values) or is_bool_dtype(values):
+        return values.apply(noaa_number).astype(float)
+
+    numbers = values.values.astype(float)
+    with numpy.errstate(divide="ignore", invalid="ignore"):
+        mantissa = numbers / 10 ** numpy.floor(numpy.log10(numbers))
+
+    # Values within a small margin of the boundaries are checked using the scalar function
+    margin = 1e-9
+    in_range = (numbers >= 1) & (numbers < 1e15)
+    missing = in_range & (mantissa >= 9.99 + margin) & (mantissa <= 10 - margin)
+    boundary = numpy.abs(mantissa - 9.99) < 2 * margin
+    boundary |= (mantissa < 1 + margin) | (mantissa > 10 - 2 * margin)
+    undecided = (numbers >= 1e15) | (in_range & boundary)
+    for idx in numpy.flatnonzero(undecided):
+        missing[idx] = noaa_number(values.iloc[idx]) is None
+
+    return Series(numpy.where(missing, numpy.nan, numbers), index=values.index)
+
+
 def relative_humidity(temp: float, dew_point: float) -> float:
     """ http://bmcnoldy.rsmas.miami.edu/humidity_conversions.pdf """
     a = 17.625
@@ -81,48 +98,132 @@ def relative_humidity(temp: float, dew_point: float) -> float:
     return 100 * numpy.exp(a * dew_point / (b + dew_point)) / numpy.exp(a * temp / (b + temp))
 
 
-def _extract_station(
-    stations_tar: tarfile.TarFile, tar_member: tarfile.TarInfo
-) -> Dict[str, DataFrame]:
-
-    if not tar_member.name.endswith(".csv"):
-        return None
+def _extract_station(tar_item: Tuple[str, bytes]) -> Optional[DataFrame]:
+    member_name, contents = tar_item
 
     # Read the records from the provided station
-    data = read_file(
-        stations_tar.extractfile(tar_member), file_type="csv", usecols=_COLUMN_MAPPING.keys()
-    ).rename(columns=_COLUMN_MAPPING)
+    data = read_file(BytesIO(contents), file_type="csv", usecols=_COLUMN_MAPPING.keys()).rename(
+        columns=_COLUMN_MAPPING
+    )
 
     # Fix data types
-    noaa_station = tar_member.name.replace(".csv", "")
+    noaa_station = member_name.replace(".csv", "")
     data["noaa_station"] = noaa_station
-    data["rainfall"] = data["rainfall"].apply(conv_dist)
-    data["snowfall"] = data["snowfall"].apply(conv_dist)
-    data["dew_point"] = data["dew_point"].apply(conv_temp)
-    for temp_type in ("average", "minimum", "maximum"):
-        col = f"{temp_type}_temperature"
-        data[col] = data[col].apply(conv_temp)
+    for col in ("rainfall", "snowfall"):
+        data[col] = noaa_numbers(data[col]) * 25.4
+    for col in ("dew_point", "average_temperature", "minimum_temperature", "maximum_temperature"):
+        data[col] = (noaa_numbers(data[col]) - 32) * 5 / 9
 
     # Compute the relative humidity from the dew point and average temperature
-    data["relative_humidity"] = data.apply(
-        lambda x: relative_humidity(x["average_temperature"], x["dew_point"]), axis=1
-    )
+    data["relative_humidity"] = relative_humidity(data["average_temperature"], data["dew_point"])
 
-    return {noaa_station: data}
+    return data
 
 
-def _process_location(station_cache: Dict[str, DataFrame], stations: DataFrame, location: Series):
-    # Get the nearest stations from our list of stations given lat and lon
-    distance = haversine_distance(stations, location.lat, location.lon)
+def _read_tar_members(stations_tar: tarfile.TarFile) -> Iterator[Tuple[str, bytes]]:
+    """ Reads the contents of each station file, which are then parsed by other processes """
+    for tar_member in stations_tar:
+        if tar_member.name.endswith(".csv"):
+            yield tar_member.name, stations_tar.extractfile(tar_member).read()
 
-    # Filter out all but the 10 nearest stations
-    mask = distance < _DISTANCE_THRESHOLD
-    nearest = stations.loc[mask].copy()
-    nearest["key"] = location["key"]
-    nearest["distance"] = distance.loc[mask]
-    nearest.sort_values("distance", inplace=True)
-    nearest = nearest.iloc[:10]
 
+def _extract_stations(stations_tar: tarfile.TarFile) -> Iterator[DataFrame]:
+    """
+    Parses all the station files in parallel, reading them in batches so only a bounded number of
+    them are held in memory while they wait to be parsed.
+    """
+    tar_members = _read_tar_members(stations_tar)
+    while True:
+        batch = list(islice(tar_members, _DECOMPRESS_BATCH_SIZE))
+        if not batch:
+            break
+        yield from process_map(_extract_station, batch, desc="Decompressing", chunk_size=64)
+
+
+# Arrays of each station store opened by the current process, indexed by the store's path
+_STATION_STORE_ARRAYS: Dict[
+    str, Tuple[Dict[str, Tuple[int, int]], Dict[str, numpy.ndarray], Dict[str, numpy.ndarray]]
+] = {}
+
+
+class _StationStore:
+    """
+    Records of all stations laid out as one memory-mapped array per column, with the records of
+    each station in a contiguous range of rows. Only the path of the store is sent to other
+    processes, which map the same files and only load the rows of the stations they read.
+    """
+
+    def __init__(self, path: Path):
+        self.path = str(path)
+
+    @staticmethod
+    def create(path: Path, station_tables: List[DataFrame]) -> "_StationStore":
+        if len(station_tables) == 0:
+            station_tables = [DataFrame(columns=["noaa_station"])]
+        data = concat(station_tables, ignore_index=True).sort_values("noaa_station", kind="stable")
+
+        # Write the row range of each station followed by the contents of each column
+        stations, starts, counts = numpy.unique(
+            data["noaa_station"].values.astype(str), return_index=True, return_counts=True
+        )
+        numpy.save(path / "index.station.npy", stations)
+        numpy.save(path / "index.start.npy", starts)
+        numpy.save(path / "index.end.npy", starts + counts)
+        for col in data.columns.drop("noaa_station"):
+            values = data[col].values
+
+            # Strings are stored with a fixed width, so their null values are kept in a mask
+            if values.dtype == object:
+                nulls = isna(values)
+                numpy.save(path / f"null.{col}.npy", nulls)
+                values = numpy.where(nulls, "", values).astype(str)
+
+            numpy.save(path / f"{col}.npy", values)
+
+        return _StationStore(path)
+
+    def _arrays(
+        self,
+    ) -> Tuple[Dict[str, Tuple[int, int]], Dict[str, numpy.ndarray], Dict[str, numpy.ndarray]]:
+        if self.path not in _STATION_STORE_ARRAYS:
+            path = Path(self.path)
+            stations, starts, ends = [
+                numpy.load(path / f"index.{name}.npy") for name in ("station", "start", "end")
+            ]
+            index = {station: (start, end) for station, start, end in zip(stations, starts, ends)}
+            arrays = {
+                file_path.stem: numpy.load(file_path, mmap_mode="r")
+                for file_path in sorted(path.glob("*.npy"))
+                if not file_path.name.startswith("index.")
+            }
+            columns = {name: arr for name, arr in arrays.items() if not name.startswith("null.")}
+            nulls = {name[5:]: arr for name, arr in arrays.items() if name.startswith("null.")}
+            _STATION_STORE_ARRAYS[self.path] = (index, columns, nulls)
+        return _STATION_STORE_ARRAYS[self.path]
+
+    def __contains__(self, station_id: str) -> bool:
+        return station_id in self._arrays()[0]
+
+    def get(self, station_id: str) -> Optional[DataFrame]:
+        index, columns, nulls = self._arrays()
+        if station_id not in index:
+            return None
+        start, end = index[station_id]
+
+        data = {}
+        for col, values in columns.items():
+            values = values[start:end]
+            if col in nulls:
+                values = values.astype(object)
+                values[nulls[col][start:end]] = numpy.nan
+            data[col] = values
+
+        data = DataFrame(data)
+        data["noaa_station"] = station_id
+        return data
+
+
+def _process_location(station_cache: _StationStore, nearest: DataFrame):
     # Early exit: no stations found within distance threshold
     if len(nearest) == 0 or all(
         station_id not in station_cache for station_id in nearest.id.values
@@ -167,15 +268,10 @@ class NoaaGsodDataSource(DataSource):
         stations["id"] = stations["USAF"] + stations["WBAN"].apply(lambda x: f"{x:05d}")
 
         # Open the station data as a compressed file
-        station_cache = dict()
         with tarfile.open(sources["gsod"], mode="r:gz") as stations_tar:
 
-            # Build the station cache by decompressing all files in memory
-            map_iter = stations_tar.getmembers()
-            map_func = partial(_extract_station, stations_tar)
-            map_opts = dict(desc="Decompressing", total=len(map_iter))
-            for station_item in pbar(map(map_func, map_iter), **map_opts):
-                station_cache.update(station_item)
+            # Decompress the files sequentially while they are parsed in parallel
+            station_tables = list(_extract_stations(stations_tar))
 
         # Get all the POI from metadata and go through each key
         keep_columns = ["key", "latitude", "longitude"]
@@ -190,17 +286,34 @@ class NoaaGsodDataSource(DataSource):
         metadata["lat"] = metadata["latitude"].apply(math.radians)
         metadata["lon"] = metadata["longitude"].apply(math.radians)
 
-        # Use a manager to handle memory accessed across processes
-        manager = Manager()
-        station_cache = manager.dict(station_cache)
+        # Find the 10 nearest stations to every location within the distance threshold at once
+        station_index = GeoIndex(stations["lat"].values, stations["lon"].values)
+        location_idx, station_idx, distance = station_index.nearest(
+            metadata["lat"].values, metadata["lon"].values, k=10, max_distance=_DISTANCE_THRESHOLD
+        )
+        nearest = DataFrame(
+            {
+                "key": metadata["key"].values[location_idx],
+                "id": stations["id"].values[station_idx],
+                "distance": distance,
+            }
+        )
+        nearest_groups = {idx: group for idx, group in nearest.groupby(location_idx)}
+
+        with temporary_directory() as workdir:
+
+            # Lay out the records of all stations in memory-mapped files shared across processes
+            station_cache = _StationStore.create(workdir, station_tables)
+            del station_tables
 
-        # Make sure the stations and the cache are sent to each function call
-        map_func = partial(_process_location, station_cache, stations)
+            # Make sure the cache is sent to each function call
+            map_func = partial(_process_location, station_cache)
 
-        # We don't care about the index while iterating over each metadata item
-        map_iter = (record for _, record in metadata.iterrows())
+            # Each location only needs the table of its nearest stations
+            empty = nearest.iloc[:0]
+            map_iter = (nearest_groups.get(idx, empty) for idx in range(len(metadata)))
 
-        # Bottleneck is network so we can use lots of threads in parallel
-        records = process_map(map_func, map_iter, total=len(metadata))
+            # Locations are processed in parallel, each reading its stations from the shared store
+            records = list(process_map(map_func, map_iter, total=len(metadata)))
 
         return concat(records)
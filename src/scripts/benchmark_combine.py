@@ -0,0 +1,95 @@
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# A script to compare the performance of the different `combine_tables` engines using synthetic
+# data shaped like the intermediate results of the epidemiology pipeline, where several data
+# sources report overlapping subsets of the same keys and dates with some missing values.
+#
+# Example usage: `python src/scripts/benchmark_combine.py --keys 1000 --dates 300`
+
+import os
+import sys
+import time
+from argparse import ArgumentParser
+from typing import List
+
+import numpy
+from pandas import DataFrame, date_range
+
+# Add our library utils to the path
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+from lib.utils import combine_tables
+
+
+VALUE_COLUMNS = [
+    f"{prefix}_{suffix}"
+    for prefix in ("new", "total")
+    for suffix in ("confirmed", "deceased", "recovered", "tested")
+]
+
+
+def make_intermediate_tables(
+    key_count: int, date_count: int, source_count: int, seed: int = 0
+) -> List[DataFrame]:
+    rng = numpy.random.default_rng(seed)
+    keys = numpy.array([f"K{idx:05d}" for idx in range(key_count)])
+    dates = date_range("2020-01-01", periods=date_count).strftime("%Y-%m-%d").values
+
+    tables = []
+    for _ in range(source_count):
+        # Each data source covers a random subset of the keys for all dates
+        source_keys = keys[rng.random(key_count) < 0.5]
+        table = DataFrame(
+            {
+                "date": numpy.tile(dates, len(source_keys)),
+                "key": numpy.repeat(source_keys, date_count),
+            }
+        )
+        for col in VALUE_COLUMNS:
+            values = rng.integers(0, 1000, len(table)).astype(float)
+            values[rng.random(len(table)) < 0.3] = numpy.nan
+            table[col] = values
+        tables.append(table)
+
+    return tables
+
+
+def main():
+    argparser = ArgumentParser()
+    argparser.add_argument("--keys", type=int, default=1000)
+    argparser.add_argument("--dates", type=int, default=100)
+    argparser.add_argument("--sources", type=int, default=3)
+    argparser.add_argument("--engines", type=str, default="numpy,python")
+    args = argparser.parse_args()
+
+    tables = make_intermediate_tables(args.keys, args.dates, args.sources)
+    row_count = sum(len(table) for table in tables)
+    print(f"Combining {row_count} records from {args.sources} tables")
+
+    results = {}
+    for engine in args.engines.split(","):
+        start_time = time.monotonic()
+        results[engine] = combine_tables(tables, ["date", "key"], engine=engine)
+        elapsed = time.monotonic() - start_time
+        print(f"{engine}: {elapsed:.3f} seconds for {len(results[engine])} combined records")
+
+    # Make sure that all engines produce the same output
+    outputs = list(results.values())
+    for output in outputs[1:]:
+        assert outputs[0].equals(output), "Combined outputs differ between engines"
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,135 @@
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# A script to compare the performance of the per-value and the vectorized unit conversions used
+# by the NOAA weather data sources. It reads the station files from a GSOD tarball, which can be
+# downloaded from https://www.ncei.noaa.gov/data/global-summary-of-the-day/archive/, or from a
+# synthetic tarball shaped like one if no path is given.
+#
+# Example usage: `python src/scripts/benchmark_weather.py --tarball 2020.tar.gz`
+
+import os
+import sys
+import tarfile
+import time
+from argparse import ArgumentParser
+from io import BytesIO
+from typing import List, Tuple
+
+import numpy
+from pandas import DataFrame, Series, date_range
+
+# Add our library utils to the path
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+from lib.io import read_file, temporary_directory
+from pipelines.weather.noaa_ghcn import NoaaGhcnDataSource
+from pipelines.weather.noaa_gsod import (
+    _COLUMN_MAPPING,
+    _extract_station,
+    _read_tar_members,
+    conv_dist,
+    conv_temp,
+    relative_humidity,
+)
+
+
+def extract_station_per_value(tar_item: Tuple[str, bytes]) -> DataFrame:
+    """ Equivalent to `_extract_station` converting one value at a time """
+    member_name, contents = tar_item
+    data = read_file(BytesIO(contents), file_type="csv", usecols=_COLUMN_MAPPING.keys()).rename(
+        columns=_COLUMN_MAPPING
+    )
+    data["noaa_station"] = member_name.replace(".csv", "")
+    data["rainfall"] = data["rainfall"].apply(conv_dist)
+    data["snowfall"] = data["snowfall"].apply(conv_dist)
+    data["dew_point"] = data["dew_point"].apply(conv_temp)
+    for temp_type in ("average", "minimum", "maximum"):
+        col = f"{temp_type}_temperature"
+        data[col] = data[col].apply(conv_temp)
+    data["relative_humidity"] = data.apply(
+        lambda x: relative_humidity(x["average_temperature"], x["dew_point"]), axis=1
+    )
+    return data
+
+
+def make_gsod_tarball(path: str, station_count: int, day_count: int, seed: int = 0) -> None:
+    rng = numpy.random.default_rng(seed)
+    dates = date_range("2020-01-01", periods=day_count).strftime("%Y-%m-%d").values
+    with tarfile.open(path, "w:gz") as tar:
+        for idx in range(station_count):
+            station = f"{idx:011d}"
+            data = DataFrame({"STATION": station, "DATE": dates})
+            for col in ("TEMP", "MIN", "MAX", "DEWP"):
+                data[col] = rng.uniform(-20, 100, day_count).round(1)
+            for col in ("PRCP", "SNDP"):
+                data[col] = rng.uniform(0, 5, day_count).round(2)
+
+            # Missing values are reported using numbers made of nines
+            for col, sentinel in [("MAX", 9999.9), ("DEWP", 9999.9), ("PRCP", 99.99)]:
+                data.loc[rng.random(day_count) < 0.1, col] = sentinel
+            data["SNDP"] = 999.9
+
+            contents = data.to_csv(index=False).encode()
+            tar_member = tarfile.TarInfo(f"{station}.csv")
+            tar_member.size = len(contents)
+            tar.addfile(tar_member, BytesIO(contents))
+
+
+def read_gsod_tarball(path: str) -> List[Tuple[str, bytes]]:
+    with tarfile.open(path, mode="r:gz") as stations_tar:
+        return list(_read_tar_members(stations_tar))
+
+
+def main():
+    argparser = ArgumentParser()
+    argparser.add_argument("--tarball", type=str, default=None)
+    argparser.add_argument("--stations", type=int, default=500)
+    argparser.add_argument("--days", type=int, default=366)
+    args = argparser.parse_args()
+
+    if args.tarball:
+        tar_items = read_gsod_tarball(args.tarball)
+    else:
+        with temporary_directory() as workdir:
+            make_gsod_tarball(workdir / "gsod.tar.gz", args.stations, args.days)
+            tar_items = read_gsod_tarball(workdir / "gsod.tar.gz")
+    print(f"Converting {len(tar_items)} station files")
+
+    results = {}
+    engines = [("per-value", extract_station_per_value), ("vectorized", _extract_station)]
+    for name, map_func in engines:
+        start_time = time.monotonic()
+        results[name] = [map_func(tar_item) for tar_item in tar_items]
+        elapsed = time.monotonic() - start_time
+        record_count = sum(len(table) for table in results[name])
+        print(f"GSOD {name}: {elapsed:.3f} seconds for {record_count} records")
+
+    # Make sure that both conversions produce the same output
+    for expected, output in zip(results["per-value"], results["vectorized"]):
+        assert expected.equals(output[expected.columns]), "GSOD outputs differ"
+
+    # GHCN temperatures are reported as integer tenths of a degree
+    values = Series(numpy.random.default_rng(0).integers(-500, 500, 1_000_000))
+    start_time = time.monotonic()
+    expected = values.apply(NoaaGhcnDataSource.fix_temp)
+    print(f"GHCN per-value: {time.monotonic() - start_time:.3f} seconds for {len(values)} values")
+    start_time = time.monotonic()
+    output = NoaaGhcnDataSource.fix_temps(values)
+    print(f"GHCN vectorized: {time.monotonic() - start_time:.3f} seconds for {len(values)} values")
+    assert expected.equals(output), "GHCN outputs differ"
+
+
+if __name__ == "__main__":
+    main()
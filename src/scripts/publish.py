@@ -19,14 +19,14 @@ import os
 import shutil
 import sys
 from argparse import ArgumentParser
+from multiprocessing import cpu_count
 from pathlib import Path
 from pstats import Stats
 from typing import Dict, Iterable, List, Optional, TextIO
 
 from lib.publish import publish_global_tables
 from lib.publish import publish_subset_latest
-from lib.publish import publish_location_breakouts
-from lib.publish import publish_location_aggregates
+from lib.publish import publish_location_aggregates_from_tables
 from lib.publish import convert_tables_to_json
 from lib.publish import merge_location_breakout_tables
 
@@ -35,13 +35,18 @@ sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
 
 from lib.constants import OUTPUT_COLUMN_ADAPTER, SRC, V2_TABLE_LIST, V3_TABLE_LIST
 from lib.error_logger import ErrorLogger
-from lib.io import pbar, read_lines, temporary_directory
+from lib.io import pbar, read_lines
 from lib.memory_efficient import table_read_column
 from lib.pipeline_tools import get_schema
 from lib.time import date_range
 
 
-def main(output_folder: Path, tables_folder: Path, use_table_names: List[str] = None) -> None:
+def main(
+    output_folder: Path,
+    tables_folder: Path,
+    use_table_names: List[str] = None,
+    process_count: int = 1,
+) -> None:
     """
     This script takes the processed outputs located in `tables_folder` and publishes them into the
     output folder by performing the following operations:
@@ -52,6 +57,13 @@ def main(output_folder: Path, tables_folder: Path, use_table_names: List[str] =
            for the last day of data, files for each individual region.
         3. Produce a main table, created by iteratively performing left outer joins on all other
            tables for each slice of data (bot not for the global tables).
+
+    Arguments:
+        output_folder: Folder where the published files are written.
+        tables_folder: Folder containing the processed outputs.
+        use_table_names: Tables which should be included in the published outputs.
+        process_count: Maximum number of processes used to aggregate the location tables and to
+            convert the tables to JSON.
     """
     # Wipe the output folder first
     for item in output_folder.glob("*"):
@@ -74,24 +86,19 @@ def main(output_folder: Path, tables_folder: Path, use_table_names: List[str] =
     latest_folder.mkdir(exist_ok=True, parents=True)
     publish_subset_latest(output_folder, latest_folder)
 
-    # Create a temporary folder which will host all the location breakouts
-    with temporary_directory() as breakout_folder:
-
-        # Break out each table into separate folders based on the location key
-        publish_location_breakouts(output_folder, breakout_folder, use_table_names=use_table_names)
-
-        # Create a folder which will host all the location aggregates
-        location_aggregates_folder = output_folder / "location"
-        location_aggregates_folder.mkdir(exist_ok=True, parents=True)
+    # Create a folder which will host all the location aggregates
+    location_aggregates_folder = output_folder / "location"
+    location_aggregates_folder.mkdir(exist_ok=True, parents=True)
 
-        # Aggregate the tables for each location independently
-        location_keys = table_read_column(output_folder / "index.csv", "location_key")
-        publish_location_aggregates(
-            breakout_folder,
-            location_aggregates_folder,
-            location_keys,
-            use_table_names=use_table_names,
-        )
+    # Aggregate the tables for each location in a single pass, without breaking them out first
+    location_keys = table_read_column(output_folder / "index.csv", "location_key")
+    publish_location_aggregates_from_tables(
+        output_folder,
+        location_aggregates_folder,
+        location_keys,
+        use_table_names=use_table_names,
+        process_count=process_count,
+    )
 
     # Create the aggregated table and put it in a compressed file
     agg_file_path = output_folder / "aggregated.csv.gz"
@@ -99,7 +106,7 @@ def main(output_folder: Path, tables_folder: Path, use_table_names: List[str] =
         merge_location_breakout_tables(location_aggregates_folder, compressed_file)
 
     # Convert all CSV files to JSON using values format
-    convert_tables_to_json(output_folder, output_folder)
+    convert_tables_to_json(output_folder, output_folder, process_count=process_count)
 
 
 if __name__ == "__main__":
@@ -111,13 +118,19 @@ if __name__ == "__main__":
     argparser.add_argument("--no-progress", action="store_true")
     argparser.add_argument("--tables-folder", type=str, default=str(output_root / "tables"))
     argparser.add_argument("--output-folder", type=str, default=str(output_root / "public"))
+    argparser.add_argument("--process-count", type=int, default=cpu_count())
     args = argparser.parse_args()
 
     if args.profile:
         profiler = cProfile.Profile()
         profiler.enable()
 
-    main(Path(args.output_folder), Path(args.tables_folder), use_table_names=V3_TABLE_LIST)
+    main(
+        Path(args.output_folder),
+        Path(args.tables_folder),
+        use_table_names=V3_TABLE_LIST,
+        process_count=args.process_count,
+    )
 
     if args.profile:
         stats = Stats(profiler)
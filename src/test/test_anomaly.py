@@ -0,0 +1,83 @@
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import sys
+import warnings
+from typing import List
+from unittest import main
+
+import numpy
+from pandas import DataFrame
+
+from lib.anomaly import (
+    ANOMALY_REPORT_COLUMNS,
+    detect_stale_columns,
+    report_anomalies,
+    stale_columns_report,
+)
+
+from .profiled_test_case import ProfiledTestCase
+
+
+SCHEMA = {"key": str, "date": str, "total_confirmed": int, "total_deceased": int}
+
+
+def _stale_warnings(func) -> List[str]:
+    with warnings.catch_warnings(record=True) as records:
+        warnings.simplefilter("always")
+        func()
+    return sorted(str(record.message) for record in records if "Stale" in str(record.message))
+
+
+class TestAnomaly(ProfiledTestCase):
+    def test_stale_columns_report(self):
+        dates = [f"2020-01-{day:02d}" for day in range(1, 11)]
+        data = DataFrame(
+            [{"key": key, "date": date} for key in ("US", "ES", "FR", "GB") for date in dates]
+        )
+        data["total_confirmed"] = 1
+        data["total_deceased"] = 1
+
+        # US stopped reporting deaths, ES only reported deaths once and FR never reported deaths
+        data.loc[(data.key == "US") & (data.date > "2020-01-05"), "total_deceased"] = numpy.nan
+        data.loc[(data.key == "ES") & (data.date != "2020-01-02"), "total_deceased"] = numpy.nan
+        data.loc[data.key == "FR", "total_deceased"] = numpy.nan
+
+        # GB has fewer dates, and it has values in one of its last 3 dates
+        data = data[(data.key != "GB") | (data.date < "2020-01-04")].copy()
+        data.loc[(data.key == "GB") & (data.date > "2020-01-01"), "total_confirmed"] = numpy.nan
+
+        report = stale_columns_report(SCHEMA, data.sample(frac=1, random_state=0))
+        self.assertListEqual(list(report.columns), ANOMALY_REPORT_COLUMNS)
+        self.assertListEqual(list(report.key), ["ES", "US"])
+        self.assertListEqual(list(report.column), ["total_deceased", "total_deceased"])
+        self.assertListEqual(list(report.last_date), ["2020-01-02", "2020-01-05"])
+
+        # The warnings are the same as checking each key separately
+        expected = _stale_warnings(
+            lambda: [
+                detect_stale_columns(SCHEMA, data[data.key == key], ["test", key])
+                for key in data.key.unique()
+            ]
+        )
+        self.assertListEqual(expected, _stale_warnings(lambda: report_anomalies(report, ["test"])))
+
+    def test_stale_columns_report_no_date(self):
+        data = DataFrame([{"key": "US", "total_confirmed": 1}])
+        report = stale_columns_report({"key": str, "total_confirmed": int}, data)
+        self.assertEqual(0, len(report))
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -17,7 +17,7 @@ from io import StringIO
 from unittest import main
 
 from pandas import read_csv
-from lib.case_line import convert_cases_to_time_series
+from lib.case_line import convert_cases_to_time_series, convert_cases_to_time_series_chunked
 from .profiled_test_case import ProfiledTestCase
 
 
@@ -134,6 +134,33 @@ class TestCaseLine(ProfiledTestCase):
         table = convert_cases_to_time_series(cases)
         self.assertSetEqual({"age_unknown"}, set(table.age))
 
+    def test_convert_cases_to_time_series_chunked(self):
+        data = CASE_LINE_DATA_SIMPLE + CASE_LINE_DATA_NULL_DEATHS.split("\n", 1)[-1]
+        cases = read_csv(StringIO(data))
+        expected = convert_cases_to_time_series(cases)
+
+        # Records with the same <key,age,sex,ethnicity,date> are counted in different chunks
+        for chunk_size in (1, 3, len(cases)):
+            chunks = read_csv(StringIO(data), chunksize=chunk_size)
+            table = convert_cases_to_time_series_chunked(chunks)
+            self.assertTrue(expected.equals(table))
+
+        # Each statistic is counted, even if all of its values in a chunk are null
+        self.assertEqual(len(cases), expected["new_confirmed"].sum())
+        self.assertEqual(len(cases) // 2, expected["new_deceased"].sum())
+
+    def test_convert_cases_to_time_series_chunked_null_index(self):
+        data = CASE_LINE_DATA_SIMPLE + ",30,F,white,2020-01-09,\n,31,M,black,2020-01-10,\n"
+        cases = read_csv(StringIO(data))
+        expected = convert_cases_to_time_series(cases)
+
+        # The last chunk has only null keys, so it is not read as a column of strings
+        chunks = list(read_csv(StringIO(data), chunksize=len(cases) - 2))
+        self.assertNotEqual(object, chunks[-1]["key"].dtype)
+        table = convert_cases_to_time_series_chunked(chunks)
+        self.assertTrue(expected.equals(table))
+        self.assertEqual(2, len(table[table.key == ""]))
+
 
 if __name__ == "__main__":
     sys.exit(main())
@@ -17,7 +17,7 @@ from unittest import main
 
 import numpy
 import pandas
-from lib.cast import age_group, safe_int_cast
+from lib.cast import age_group, cast_column, column_converters, safe_int_cast
 
 from .profiled_test_case import ProfiledTestCase
 
@@ -52,6 +52,25 @@ class TestCastFunctions(ProfiledTestCase):
             result = safe_int_cast(value)
             self.assertEqual(result, expected, f"[{value}] Expected: {expected}. Found: {result}")
 
+    def test_cast_column(self):
+        test_values = ["1", "1.5", "1,000", "−1", "1e3", "", "a", None, numpy.nan, pandas.NA]
+        test_values += [1, 1.5, -0.0, True, 2 ** 60, float("inf")]
+        test_columns = [
+            pandas.Series(test_values, dtype=object),
+            pandas.Series(["1", "2.5", "−3", "4,000", "", None], dtype=object),
+            pandas.Series([1, 2.5, None, 3], dtype=object),
+            pandas.Series([1.5, numpy.nan, -2.5]),
+            pandas.Series([1, 2, 3]),
+            pandas.Series([1, None, 3], dtype="Int64"),
+        ]
+
+        for dtype in ("str", "int", "float"):
+            converter = column_converters({"col": dtype})["col"]
+            for column in test_columns:
+                expected = [None if pandas.isna(val) else val for val in column.apply(converter)]
+                result = [None if pandas.isna(val) else val for val in cast_column(column, dtype)]
+                self.assertListEqual(expected, result, f"{dtype}: {column.tolist()}")
+
     def test_age_group_standard(self):
         self.assertEqual("0-9", age_group(0, bin_size=10, age_cutoff=90))
         self.assertEqual("0-9", age_group(0.0, bin_size=10, age_cutoff=90))
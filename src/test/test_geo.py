@@ -0,0 +1,76 @@
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import math
+import sys
+from unittest import main
+
+import numpy
+
+from lib.geo import GeoIndex, haversine_distance
+
+from .profiled_test_case import ProfiledTestCase
+
+
+def _random_coordinates(rng: numpy.random.Generator, size: int):
+    lat = numpy.arcsin(rng.uniform(-1, 1, size))
+    lon = rng.uniform(-math.pi, math.pi, size)
+    return lat, lon
+
+
+class TestGeo(ProfiledTestCase):
+    def test_haversine_distance(self):
+        # A quarter of the great circle between the equator and the north pole
+        distance = haversine_distance(0, 0, math.pi / 2, 0, radius=1)
+        self.assertAlmostEqual(math.pi / 2, distance)
+
+        # Antipodal points are half of the great circle apart
+        distance = haversine_distance(0, -math.pi / 2, 0, math.pi / 2, radius=1)
+        self.assertAlmostEqual(math.pi, distance)
+
+    def test_geo_index_nearest(self):
+        rng = numpy.random.default_rng(0)
+        points_lat, points_lon = _random_coordinates(rng, 5000)
+        query_lat, query_lon = _random_coordinates(rng, 200)
+
+        # Include points with the same coordinates as the query and right at the antimeridian
+        points_lat[:2], points_lon[:2] = query_lat[:2], query_lon[:2]
+        points_lat[2], points_lon[2] = query_lat[2], math.pi
+        query_lon[2] = -math.pi
+
+        index = GeoIndex(points_lat, points_lon)
+        for k, max_distance in [(1, 100), (10, 300), (20, 1000), (50, 20000)]:
+            query_idx, point_idx, distance = index.nearest(query_lat, query_lon, k, max_distance)
+
+            for idx, (lat, lon) in enumerate(zip(query_lat, query_lon)):
+                # Compare against the distance from the query point to every point
+                expected_distance = haversine_distance(lat, lon, points_lat, points_lon)
+                expected_idx = numpy.argsort(expected_distance, kind="stable")
+                expected_idx = expected_idx[expected_distance[expected_idx] < max_distance][:k]
+
+                mask = query_idx == idx
+                self.assertListEqual(expected_idx.tolist(), point_idx[mask].tolist())
+                numpy.testing.assert_allclose(
+                    expected_distance[expected_idx], distance[mask], atol=1e-6
+                )
+
+        # Empty inputs produce empty outputs
+        for output in GeoIndex([], []).nearest(query_lat, query_lon, 10, 300):
+            self.assertEqual(0, len(output))
+        for output in index.nearest([], [], 10, 300):
+            self.assertEqual(0, len(output))
+
+
+if __name__ == "__main__":
+    sys.exit(main())
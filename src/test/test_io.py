@@ -18,12 +18,35 @@ from pathlib import Path
 from unittest import main
 
 import numpy
-from pandas import DataFrame
-from lib.io import export_csv, open_file_like, read_file, temporary_directory
+from pandas import DataFrame, Series
+from lib.constants import SRC
+from lib.io import (
+    export_csv,
+    fuzzy_text,
+    fuzzy_text_series,
+    open_file_like,
+    read_file,
+    temporary_directory,
+)
+from lib.pipeline_tools import get_schema
 
 from .profiled_test_case import ProfiledTestCase
 
 
+# Values which exercise the different casting and formatting rules for each schema dtype
+EXPORT_EDGE_CASES = {
+    "float_object": [1, 1.5, "2,500.25", "−3.5", "", None, numpy.nan, "abc", 1e20, -0.0]
+    + [0.1234567, 2.675, 1e-7, -1e-7, 123456789.1234565, True, float("inf"), 9.9999995, " 7 "]
+    + ["1e3"],
+    "int_object": ["1,000", "−7", 2.7, -2.7, "3.9", None, "x", 1e20, True, 12345678901234567890]
+    + [numpy.nan, "", 5, -0.0, 2 ** 53 + 1, "12", float("inf"), "1e3", 7.0, "−"],
+    "str_object": ["a", 1, 1.5, None, numpy.nan, True, "b,c", 'q"uote', "", "  ", 1e20, -0.0]
+    + [10 ** 20, "x\ny", "ñ", 2, 3.25, "", None, "z"],
+    "float_numeric": [value * 1.001 for value in range(-10, 10)],
+    "int_numeric": list(range(-10, 10)),
+}
+
+
 class TestIOFunctions(ProfiledTestCase):
     def _test_reimport_csv_helper(self, data: numpy.ndarray, test_case: str):
         tmpfile = Path(f"{__file__}.csv")
@@ -62,6 +85,23 @@ class TestIOFunctions(ProfiledTestCase):
         with open(file_path, "r") as fd:
             self.assertEqual(fd.read(), expected)
 
+    def test_export_csv_golden_edge_cases(self):
+        schema = {col: col.split("_")[0] for col in EXPORT_EDGE_CASES.keys()}
+        output = export_csv(DataFrame(EXPORT_EDGE_CASES), schema=schema)
+        golden_path = SRC / "test" / "data" / "golden" / "export_csv.csv"
+        with open(golden_path, "r", newline="") as fd:
+            self.assertEqual(fd.read(), output)
+
+    def test_export_csv_golden_tables(self):
+        # The sample tables were exported by the pipelines, so a round trip must be byte-identical
+        schema = get_schema()
+        for table_name in ("by-age", "epidemiology", "mobility", "weather", "vaccinations"):
+            table_path = SRC / "test" / "data" / f"{table_name}.csv"
+            data = read_file(table_path)
+            table_schema = {col: schema.get(col, "str") for col in data.columns}
+            with open(table_path, "r", newline="") as fd:
+                self.assertEqual(fd.read(), export_csv(data, schema=table_schema), table_name)
+
     def test_open_file_like_file(self):
         with temporary_directory() as workdir:
             temp_file_path = workdir / "temp.txt"
@@ -87,6 +127,24 @@ class TestIOFunctions(ProfiledTestCase):
 
             self._assert_file_contents_equal(temp_file_path, "hello world")
 
+    def test_fuzzy_text(self):
+        self.assertEqual(fuzzy_text("São Paulo"), "saopaulo")
+        self.assertEqual(fuzzy_text("Borough of Queens"), "queens")
+        self.assertEqual(fuzzy_text("County Region of Kerry"), "kerry")
+        self.assertEqual(fuzzy_text("x and y z"), "xz")
+        self.assertEqual(fuzzy_text("Lower  Saxony", remove_spaces=False), "lower saxony")
+        self.assertEqual(fuzzy_text("Area 51 District", remove_regex=None), "area51")
+
+    def test_fuzzy_text_series(self):
+        metadata = read_file(SRC / "data" / "metadata.csv")
+        for column in ("match_string", "subregion1_name", "subregion2_name", "locality_name"):
+            values = metadata[column]
+            self.assertTrue(values.apply(fuzzy_text).equals(fuzzy_text_series(values)), column)
+
+        # Null values are normalized as their string representation
+        values = Series(["Región de Murcia", None, float("nan"), 1, "Región de Murcia"])
+        self.assertListEqual(list(fuzzy_text_series(values)), list(values.apply(fuzzy_text)))
+
 
 if __name__ == "__main__":
     sys.exit(main())
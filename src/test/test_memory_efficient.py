@@ -37,12 +37,13 @@ from lib.memory_efficient import (
     table_breakout,
     table_concat,
     table_cross_product,
+    table_is_sorted,
     table_join,
     table_grouped_tail,
+    table_merge_sorted,
     table_rename,
     table_sort,
-    _convert_csv_to_json_records_fast,
-    _convert_csv_to_json_records_slow,
+    _convert_csv_to_json_records_streaming,
 )
 from lib.memory_efficient import table_merge as table_merge_mem
 from lib.pipeline_tools import get_schema
@@ -247,24 +248,46 @@ class TestMemoryEfficient(ProfiledTestCase):
             _compare_tables_equal(self, output_file, expected)
 
     def test_convert_csv_to_json_records(self):
-        for json_convert_method in (
-            _convert_csv_to_json_records_fast,
-            _convert_csv_to_json_records_slow,
-        ):
-            with temporary_directory() as workdir:
+        with temporary_directory() as workdir:
+
+            for csv_file in pbar([*(SRC / "test" / "data").glob("*.csv")], leave=False):
+                json_output = workdir / csv_file.name.replace("csv", "json")
+                _convert_csv_to_json_records_streaming(SCHEMA, csv_file, json_output)
 
-                for csv_file in pbar([*(SRC / "test" / "data").glob("*.csv")], leave=False):
-                    json_output = workdir / csv_file.name.replace("csv", "json")
-                    json_convert_method(SCHEMA, csv_file, json_output)
+                with json_output.open("r") as fd:
+                    json_obj = json.load(fd)
+                    json_df = DataFrame(data=json_obj["data"], columns=json_obj["columns"])
 
-                    with json_output.open("r") as fd:
-                        json_obj = json.load(fd)
-                        json_df = DataFrame(data=json_obj["data"], columns=json_obj["columns"])
+                csv_test_file = workdir / json_output.name.replace("json", "csv")
+                export_csv(json_df, csv_test_file, schema=SCHEMA)
 
-                    csv_test_file = workdir / json_output.name.replace("json", "csv")
-                    export_csv(json_df, csv_test_file, schema=SCHEMA)
+                _compare_tables_equal(self, csv_file, csv_test_file)
+
+    def test_convert_csv_to_json_records_golden(self):
+        schema = {"date": "str", "key": "str", "new_confirmed": "int", "total_tested": "float"}
+        test_csv = _make_test_csv_file(
+            """
+            date,key,new_confirmed,total_tested,extra
+            2020-01-01,US,1,1.5,a
+            2020-01-02,"US,CA",,inf,
+            2020-01-03,ES,-3,nan,"x ""y\"""
+            2020-01-04,,2.0,1e3,ñ
+            """
+        )
 
-                    _compare_tables_equal(self, csv_file, csv_test_file)
+        # Non-finite numbers and empty values of columns outside the schema are output as null
+        expected = (
+            '{"columns":["date","key","new_confirmed","total_tested","extra"],"data":['
+            '["2020-01-01","US",1,1.5,"a"],'
+            '["2020-01-02","US,CA",null,null,null],'
+            '["2020-01-03","ES",-3,null,"x \\"y\\""],'
+            '["2020-01-04","",2,1000.0,"\\u00f1"]]}'
+        )
+
+        with temporary_file() as output_file:
+            _convert_csv_to_json_records_streaming(schema, test_csv, output_file)
+            with open_file_like(output_file, mode="r") as fd:
+                self.assertEqual(expected, fd.read())
 
     def test_table_grouped_tail_synthetic(self):
         test_csv = _make_test_csv_file(
@@ -440,6 +463,75 @@ class TestMemoryEfficient(ProfiledTestCase):
 
                 _compare_tables_equal(self, output_file_1, output_file_2)
 
+    def test_table_sort_external(self):
+        test_csv = SRC / "test" / "data" / "oxford-government-response.csv"
+
+        with temporary_directory() as workdir:
+            # Sort the table in memory as a reference
+            output_file_1 = workdir / "in_memory.csv"
+            table_sort(test_csv, output_file_1, ["key"])
+
+            # Sort using many small runs, generated both serially and in parallel
+            for process_count in (1, 2):
+                output_file_2 = workdir / f"external.{process_count}.csv"
+                table_sort(
+                    test_csv,
+                    output_file_2,
+                    ["key"],
+                    memory_budget=2 ** 16,
+                    process_count=process_count,
+                )
+
+                # Sorting is stable, so both outputs must be exactly the same
+                with open(output_file_1, "r") as fd1, open(output_file_2, "r") as fd2:
+                    self.assertEqual(fd1.read(), fd2.read())
+
+            # Merging the runs in several passes gives the same output
+            output_file_3 = workdir / "external.passes.csv"
+            table_sort(test_csv, output_file_3, ["key"], memory_budget=2 ** 14, max_merge_fanin=3)
+            with open(output_file_1, "r") as fd1, open(output_file_3, "r") as fd3:
+                self.assertEqual(fd1.read(), fd3.read())
+
+    def test_table_merge_sorted(self):
+        test_csv_1 = _make_test_csv_file(
+            """
+            col1,col2
+            a,1
+            c,1
+            c,2
+            """
+        )
+
+        test_csv_2 = _make_test_csv_file(
+            """
+            col2,col1,col3
+            3,a,foo
+            4,b,bar
+            3,c,baz
+            """
+        )
+
+        self.assertTrue(table_is_sorted(test_csv_1, ["col1"]))
+        self.assertFalse(table_is_sorted(test_csv_2, ["col2"]))
+        test_csv_2.seek(0)
+
+        # Records with the same key are output in the same order as the input tables
+        records = table_merge_sorted([test_csv_1, test_csv_2], ["col1"], ["col1", "col2", "col3"])
+        expected = [
+            ["a", "1", None],
+            ["a", "3", "foo"],
+            ["b", "4", "bar"],
+            ["c", "1", None],
+            ["c", "2", None],
+            ["c", "3", "baz"],
+        ]
+        self.assertListEqual(expected, [record for _, record in records])
+
+        # Merging unsorted tables is an error
+        test_csv_2.seek(0)
+        with self.assertRaises(RuntimeError):
+            list(table_merge_sorted([test_csv_2], ["col2"], ["col2"]))
+
     def test_table_concat(self):
         test_csv_1 = _make_test_csv_file(
             """
@@ -0,0 +1,308 @@
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import asyncio
+import datetime
+import json
+import socket
+import sys
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from io import BytesIO
+from unittest import main
+from urllib.parse import parse_qs, urlparse
+
+from lib.arcgis_data_source import download_arcgis_records, read_arcgis_records
+from lib.error_logger import ErrorLogger
+from lib.io import temporary_directory
+from lib.net import download, download_snapshot, get_session, parallel_download
+from lib.net_async import _download_all
+from lib.time import date_today
+from .profiled_test_case import ProfiledTestCase
+
+
+class _SnapshotRequestHandler(BaseHTTPRequestHandler):
+    """ Serves the server's `content`, using its hash as the ETag of the resource """
+
+    def _dated_path_exists(self) -> bool:
+        date = self.path.split("/")[-1].split(".")[0]
+        return date <= self.server.latest_date
+
+    def do_HEAD(self):
+        self.server.paths.append(self.path)
+        if self.path.startswith("/nohead/"):
+            self.send_response(405)
+        else:
+            self.send_response(200 if self._dated_path_exists() else 404)
+        self.end_headers()
+
+    def do_GET(self):
+        self.server.requests.append(dict(self.headers))
+        self.server.paths.append(self.path)
+        etag = f'"{hash(self.server.content)}"'
+        if self.path.startswith("/arcgis/"):
+            self._arcgis_query()
+        elif self.path.startswith("/dated/") or self.path.startswith("/nohead/"):
+            self.send_response(200 if self._dated_path_exists() else 404)
+            self.end_headers()
+            if self._dated_path_exists():
+                self.wfile.write(self.path.encode())
+        elif self.path == "/missing.csv":
+            self.send_response(404)
+            self.end_headers()
+        elif self.path == "/stalled.csv":
+            # Send part of the contents and wait until the test is done
+            self.send_response(200)
+            self.send_header("Content-Length", "1024")
+            self.end_headers()
+            self.wfile.write(self.server.content)
+            self.wfile.flush()
+            self.server.stalled.wait(10)
+        elif self.server.unavailable or (
+            self.path == "/flaky.csv" and self.server.paths.count(self.path) == 1
+        ):
+            self.send_response(503)
+            self.end_headers()
+        elif self.headers.get("If-None-Match") == etag:
+            self.send_response(304)
+            self.end_headers()
+        else:
+            self.send_response(200)
+            self.send_header("ETag", etag)
+            self.send_header("Content-Length", str(len(self.server.content)))
+            self.end_headers()
+            self.wfile.write(self.server.content)
+
+    def _arcgis_query(self):
+        """ Serves the server's `records`, returning at most 7 records per request """
+        query = parse_qs(urlparse(self.path).query)
+        if "returnCountOnly" in query:
+            body = {"count": len(self.server.records)}
+        else:
+            offset = int(query.get("resultOffset", ["0"])[0])
+            rows = self.server.records[offset : offset + 7]
+            body = {"features": [{"attributes": row} for row in rows]}
+        self.send_response(200)
+        self.end_headers()
+        self.wfile.write(json.dumps(body).encode())
+
+    def log_message(self, *args):
+        pass
+
+
+class TestNet(ProfiledTestCase):
+    def setUp(self):
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), _SnapshotRequestHandler)
+        self.server.content = b"key,value\nAA,1\n"
+        self.server.requests = []
+        self.server.paths = []
+        self.server.latest_date = "2020-01-01"
+        self.server.unavailable = False
+        self.server.stalled = threading.Event()
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.url = f"http://127.0.0.1:{self.server.server_address[1]}"
+
+    def tearDown(self):
+        self.server.stalled.set()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_download(self):
+        buffer = BytesIO()
+        response = download(f"{self.url}/data.csv", buffer)
+        self.assertEqual(200, response.status_code)
+        self.assertEqual(self.server.content, buffer.getvalue())
+
+        # Requests to the same host share the same session
+        self.assertIs(get_session(f"{self.url}/data.csv"), get_session(f"{self.url}/other.csv"))
+
+    def test_download_snapshot_conditional(self):
+        with temporary_directory() as workdir:
+            url = f"{self.url}/data.csv"
+
+            # First download has no validators, so the request is not conditional
+            snapshot_path = download_snapshot(url, workdir)
+            with open(snapshot_path, "rb") as fd:
+                self.assertEqual(b"key,value\nAA,1\n", fd.read())
+            self.assertNotIn("If-None-Match", self.server.requests[-1])
+
+            # Second download sends the validators and reuses the existing file on 304
+            self.assertEqual(snapshot_path, download_snapshot(url, workdir))
+            self.assertIn("If-None-Match", self.server.requests[-1])
+            with open(snapshot_path, "rb") as fd:
+                self.assertEqual(b"key,value\nAA,1\n", fd.read())
+
+            # Once the contents change, the new contents are downloaded
+            self.server.content = b"key,value\nAA,2\n"
+            self.assertEqual(snapshot_path, download_snapshot(url, workdir))
+            with open(snapshot_path, "rb") as fd:
+                self.assertEqual(b"key,value\nAA,2\n", fd.read())
+
+            # Failed downloads do not leave any files behind
+            self.assertIsNone(
+                download_snapshot(f"{self.url}/missing.csv", workdir, ignore_failure=True)
+            )
+            snapshot_files = sorted(path.name for path in (workdir / "snapshot").iterdir())
+            self.assertEqual(2, len(snapshot_files))
+            self.assertTrue(snapshot_files[1].endswith(".validators.json"))
+
+            # Failing to refresh an existing snapshot keeps the previous file and its validators
+            self.server.unavailable = True
+            self.assertIsNone(download_snapshot(url, workdir, ignore_failure=True))
+            with open(snapshot_path, "rb") as fd:
+                self.assertEqual(b"key,value\nAA,2\n", fd.read())
+            self.assertEqual(
+                snapshot_files, sorted(path.name for path in (workdir / "snapshot").iterdir())
+            )
+
+    def test_download_snapshot_try_date(self):
+        latest_date = datetime.date.fromisoformat(date_today(offset=-5))
+        self.server.latest_date = latest_date.isoformat()
+
+        for prefix in ("dated", "nohead"):
+            with temporary_directory() as workdir:
+                self.server.paths.clear()
+                url = f"{self.url}/{prefix}/{{date}}.csv"
+
+                # The first download searches for the latest date using few requests
+                snapshot_path = download_snapshot(url, workdir, date_format="%Y-%m-%d")
+                with open(snapshot_path, "r") as fd:
+                    self.assertEqual(f"/{prefix}/{latest_date.isoformat()}.csv", fd.read())
+                self.assertLess(len(self.server.paths), 20)
+
+                # Following downloads only check the dates after the last one that worked
+                for offset in (0, 1, 3):
+                    self.server.paths.clear()
+                    date = latest_date + datetime.timedelta(days=offset)
+                    self.server.latest_date = date.isoformat()
+                    snapshot_path = download_snapshot(url, workdir, date_format="%Y-%m-%d")
+                    with open(snapshot_path, "r") as fd:
+                        self.assertEqual(f"/{prefix}/{date.isoformat()}.csv", fd.read())
+                    self.assertLess(len(self.server.paths), 10)
+
+                # URLs which do not exist for any date fail
+                self.assertIsNone(
+                    download_snapshot(
+                        f"{self.url}/{prefix}/missing-{{date}}.csv",
+                        workdir,
+                        date_format="%Y-%m-%d",
+                        ignore_failure=True,
+                    )
+                )
+                self.server.latest_date = latest_date.isoformat()
+
+    def test_download_snapshot_try_date_unreachable(self):
+        # Find a local port which nothing is listening to
+        with socket.socket() as sock:
+            sock.bind(("127.0.0.1", 0))
+            port = sock.getsockname()[1]
+
+        with temporary_directory() as workdir:
+            url = f"http://127.0.0.1:{port}/{{date}}.csv"
+            opts = dict(date_format="%Y-%m-%d", ignore_failure=True)
+            self.assertIsNone(download_snapshot(url, workdir, **opts))
+
+    def test_download_arcgis_records(self):
+        with temporary_directory() as workdir:
+            url = f"{self.url}/arcgis/query?where=1%3D1&f=json"
+            for record_count in (0, 5, 7, 100):
+                self.server.paths.clear()
+                self.server.records = [dict(idx=idx, value=str(idx)) for idx in range(record_count)]
+                download_arcgis_records(url, workdir / "records.jsonl", max_workers=4)
+                records = list(read_arcgis_records(workdir / "records.jsonl"))
+                self.assertListEqual(self.server.records, records)
+
+                # One request for each page, plus the count and a last empty page
+                expected_requests = -(-record_count // 7) + 2 if record_count > 0 else 1
+                self.assertEqual(expected_requests, len(self.server.paths))
+
+    def test_parallel_download_asyncio(self):
+        with temporary_directory() as workdir:
+            url_list = [f"{self.url}/{idx}.csv" for idx in range(32)] + [f"{self.url}/flaky.csv"]
+            path_list = [workdir / f"{idx}.csv" for idx in range(len(url_list))]
+            download_opts = dict(max_per_host=4, max_inflight_bytes=16, backoff=0.01)
+
+            # Transient errors are retried until the download succeeds
+            results = parallel_download(url_list, path_list, engine="asyncio", **download_opts)
+            self.assertListEqual([str(path.absolute()) for path in path_list], results)
+            for path in path_list:
+                self.assertEqual(self.server.content, path.read_bytes())
+            self.assertEqual(2, self.server.paths.count("/flaky.csv"))
+
+            # Failed downloads output None when failures are ignored, and raise otherwise
+            url_list = [f"{self.url}/data.csv", f"{self.url}/missing.csv"]
+            path_list = [workdir / "data.csv", workdir / "missing.csv"]
+            results = parallel_download(
+                url_list, path_list, engine="asyncio", ignore_failure=True, **download_opts
+            )
+            self.assertListEqual([str(path_list[0].absolute()), None], results)
+            self.assertFalse(path_list[1].exists())
+            with self.assertRaises(Exception):
+                parallel_download(url_list, path_list, engine="asyncio", **download_opts)
+
+    def test_parallel_download_asyncio_conditional(self):
+        with temporary_directory() as workdir:
+            url_list = [f"{self.url}/data.csv"]
+            path_list = [workdir / "data.csv"]
+            download_opts = dict(engine="asyncio", conditional=True, headers={"X-Test": "1"})
+
+            # First download has no validators, so the request is not conditional
+            parallel_download(url_list, path_list, **download_opts)
+            self.assertEqual(self.server.content, path_list[0].read_bytes())
+            self.assertNotIn("If-None-Match", self.server.requests[-1])
+            self.assertEqual("1", self.server.requests[-1].get("X-Test"))
+
+            # Second download sends the validators and keeps the existing file on 304
+            parallel_download(url_list, path_list, **download_opts)
+            self.assertIn("If-None-Match", self.server.requests[-1])
+            self.assertEqual(self.server.content, path_list[0].read_bytes())
+
+            # Once the contents change, the new contents are downloaded
+            self.server.content = b"key,value\nAA,2\n"
+            parallel_download(url_list, path_list, **download_opts)
+            self.assertEqual(self.server.content, path_list[0].read_bytes())
+
+    def test_parallel_download_asyncio_cancelled(self):
+        async def _cancel_download(url, path):
+            download_opts = dict(
+                max_per_host=1,
+                max_inflight_bytes=1024,
+                max_retries=0,
+                backoff=0,
+                timeout=60,
+                headers={},
+                conditional=False,
+                ignore_failure=False,
+                progress=False,
+                logger=ErrorLogger(),
+            )
+            task = asyncio.ensure_future(_download_all([url], [path], **download_opts))
+
+            # Cancel the download once its temporary file has been created
+            while not any(path.parent.glob("*.tmp")):
+                await asyncio.sleep(0.01)
+            task.cancel()
+            with self.assertRaises(asyncio.CancelledError):
+                await task
+
+        with temporary_directory() as workdir:
+            coroutine = _cancel_download(f"{self.url}/stalled.csv", workdir / "stalled.csv")
+            asyncio.run(asyncio.wait_for(coroutine, timeout=10))
+
+            # Cancelled downloads do not leave any files behind
+            self.assertListEqual([], list(workdir.iterdir()))
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,249 @@
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import sys
+from unittest import main
+
+from pandas import DataFrame
+from lib.constants import AUXILIARY_CACHE_ENV
+from lib.data_source import DataSource
+from lib.io import export_csv, read_file, temporary_directory
+from lib.pipeline import DataPipeline, _prune_auxiliary_cache
+from .profiled_test_case import ProfiledTestCase
+
+
+METADATA_CSV = """key,country_code,country_name,subregion1_code,subregion1_name,\
+subregion2_code,subregion2_name,locality_code,locality_name,match_string
+AA,AA,Country A,,,,,,,
+AA_1,AA,Country A,1,First Area,,,,,
+"""
+
+
+class DummyDataSource(DataSource):
+    def parse_dataframes(self, dataframes, aux, **parse_opts):
+        # Modify the auxiliary table to verify that other data sources are not affected by it
+        metadata = aux["metadata"]
+        keys = metadata["key"].tolist()
+        metadata["key"] = None
+        return DataFrame.from_records([{"key": key, "value": len(keys)} for key in keys])
+
+
+class MergeDataSource(DummyDataSource):
+    def merge(self, record, aux, keys):
+        # Modify the auxiliary tables during the merge step too
+        aux["metadata"]["key"] = None
+        aux["localities"]["locality"] = None
+        return record["key"] if record["key"] in keys else None
+
+
+class SnapshotDataSource(DataSource):
+    parse_count = 0
+
+    def fetch(self, output_folder, cache, fetch_opts, skip_existing=False):
+        return {"data": self.config["snapshot"]}
+
+    def parse(self, sources, aux, **parse_opts):
+        SnapshotDataSource.parse_count += 1
+        return read_file(sources["data"])
+
+
+def _dummy_pipeline(metadata_path, data_sources=None) -> DataPipeline:
+    schema = {"key": "str", "value": "int"}
+    localities_path = metadata_path.parent / "localities.csv"
+    localities_path.write_text("key,locality\n")
+    auxiliary = {"metadata": metadata_path, "localities": localities_path}
+    return DataPipeline("dummy", schema, auxiliary, data_sources or [], {})
+
+
+def _combine_pipeline(data_sources) -> DataPipeline:
+    schema = {"date": "str", "key": "str", "value": "int", "total": "float"}
+    return DataPipeline("dummy", schema, {}, data_sources, {})
+
+
+class TestPipeline(ProfiledTestCase):
+    def setUp(self):
+        self._cache_env = os.environ.get(AUXILIARY_CACHE_ENV)
+
+    def tearDown(self):
+        if self._cache_env is None:
+            os.environ.pop(AUXILIARY_CACHE_ENV, None)
+        else:
+            os.environ[AUXILIARY_CACHE_ENV] = self._cache_env
+
+    def test_auxiliary_cache(self):
+        with temporary_directory() as workdir:
+            os.environ[AUXILIARY_CACHE_ENV] = str(workdir / "cache")
+            metadata_path = workdir / "metadata.csv"
+            metadata_path.write_text(METADATA_CSV)
+
+            # First load populates the cache with the preprocessed tables
+            aux = _dummy_pipeline(metadata_path).auxiliary_tables
+            self.assertEqual(1, len(list((workdir / "cache").glob("*.pickle"))))
+            self.assertEqual("firstarea", aux["metadata"]["subregion1_name_fuzzy"].iloc[1])
+
+            # Second load reads the same tables back from the cache
+            aux_cached = _dummy_pipeline(metadata_path).auxiliary_tables
+            self.assertTrue(aux["metadata"].equals(aux_cached["metadata"]))
+            self.assertEqual(1, len(list((workdir / "cache").glob("*.pickle"))))
+
+            # Changing the contents of the auxiliary file invalidates the cache
+            metadata_path.write_text(METADATA_CSV + "AA_2,AA,Country A,2,Second Area,,,,,\n")
+            aux_updated = _dummy_pipeline(metadata_path).auxiliary_tables
+            metadata_updated = aux_updated["metadata"]
+            self.assertEqual(3, len(metadata_updated))
+            self.assertEqual("secondarea", metadata_updated["subregion1_name_fuzzy"].iloc[-1])
+            self.assertEqual(2, len(list((workdir / "cache").glob("*.pickle"))))
+
+            # Pruning the cache keeps the most recently used entries
+            pipeline = _dummy_pipeline(metadata_path)
+            pipeline.auxiliary_tables
+            _prune_auxiliary_cache(workdir / "cache", 1)
+            cache_entries = list((workdir / "cache").glob("*.pickle"))
+            self.assertListEqual([pipeline._auxiliary_tables_path], cache_entries)
+
+    def test_parse_shared_auxiliary_tables(self):
+        with temporary_directory() as workdir:
+            os.environ[AUXILIARY_CACHE_ENV] = str(workdir / "cache")
+            metadata_path = workdir / "metadata.csv"
+            metadata_path.write_text(METADATA_CSV)
+
+            data_sources = [DummyDataSource(), MergeDataSource(), DummyDataSource()]
+            pipeline = _dummy_pipeline(metadata_path, data_sources=data_sources)
+            aux = pipeline.auxiliary_tables
+            localities = aux["localities"].copy()
+
+            for process_count in (1, 2):
+                results = list(pipeline.parse(workdir, process_count=process_count))
+                self.assertEqual(3, len(results))
+                for _, result in results:
+                    self.assertListEqual(["AA", "AA_1"], result["key"].tolist())
+
+                # The shared auxiliary tables must not be modified by the data sources
+                self.assertListEqual(["AA", "AA_1"], aux["metadata"]["key"].tolist())
+                self.assertTrue(localities.equals(aux["localities"]))
+
+    def test_incremental_parse(self):
+        with temporary_directory() as workdir:
+            os.environ[AUXILIARY_CACHE_ENV] = str(workdir / "cache")
+            metadata_path = workdir / "metadata.csv"
+            metadata_path.write_text(METADATA_CSV)
+            snapshot_path = workdir / "snapshot.csv"
+            snapshot_path.write_text("key,value\nAA,1\n")
+            intermediate_folder = workdir / "intermediate"
+            intermediate_folder.mkdir()
+
+            data_source = SnapshotDataSource({"snapshot": str(snapshot_path)})
+            pipeline = _dummy_pipeline(metadata_path, data_sources=[data_source])
+            intermediate_path = intermediate_folder / f"{data_source.uuid(pipeline.table)}.csv"
+
+            def _run_pipeline():
+                results = pipeline.parse(
+                    workdir, process_count=1, intermediate_folder=intermediate_folder
+                )
+                return pipeline._save_intermediate_results(intermediate_folder, results)
+
+            # First run has no previous results, so the data source must be run
+            parse_count = SnapshotDataSource.parse_count
+            self.assertListEqual(["SnapshotDataSource"], _run_pipeline()["recomputed"])
+            self.assertEqual(parse_count + 1, SnapshotDataSource.parse_count)
+            self.assertEqual("key,value\nAA,1\n", intermediate_path.read_text())
+
+            # Second run has the same inputs, so the existing results are reused
+            self.assertListEqual(["SnapshotDataSource"], _run_pipeline()["skipped"])
+            self.assertEqual(parse_count + 1, SnapshotDataSource.parse_count)
+            self.assertEqual("key,value\nAA,1\n", intermediate_path.read_text())
+
+            # Changing the contents of the snapshot means the data source must be run again
+            snapshot_path.write_text("key,value\nAA,2\n")
+            self.assertListEqual(["SnapshotDataSource"], _run_pipeline()["recomputed"])
+            self.assertEqual(parse_count + 2, SnapshotDataSource.parse_count)
+            self.assertEqual("key,value\nAA,2\n", intermediate_path.read_text())
+
+    def test_combine_files(self):
+        data_sources = [DummyDataSource({"idx": idx}) for idx in range(3)]
+        pipeline = _combine_pipeline(data_sources)
+        records = [
+            [
+                {"date": "2020-01-02", "key": "AA", "value": 1, "total": 1.5},
+                {"date": "2020-01-01", "key": "AA", "value": 2, "total": 2.5},
+                {"date": "2020-01-01", "key": "BB", "value": 3},
+            ],
+            [
+                {"date": "2020-01-01", "key": "AA", "value": None, "total": 3.5},
+                {"date": "2020-01-02", "key": "AA", "value": 4},
+                {"date": "2020-01-03", "key": "BB", "total": 4.5},
+            ],
+            [
+                {"date": "2020-01-01", "key": "BB", "value": 5},
+                {"date": "2020-01-03", "key": "AA"},
+            ],
+        ]
+
+        with temporary_directory() as workdir:
+            results = zip(data_sources, [DataFrame.from_records(rows) for rows in records])
+            pipeline._save_intermediate_results(workdir, results)
+
+            # Intermediate files written in an arbitrary order must also be combined correctly
+            unsorted_path = workdir / f"{data_sources[2].uuid(pipeline.table)}.csv"
+            export_csv(DataFrame.from_records(records[2][::-1]), unsorted_path)
+
+            # Results must be the same regardless of how many records are combined at once
+            intermediate_files = pipeline._intermediate_files(workdir)
+            for block_size in (1, 2, 1000):
+                output_blocks = list(pipeline.combine_files(intermediate_files, block_size))
+                output = pipeline._concat_output(output_blocks)
+                self.assertEqual(
+                    "date,key,value,total\n"
+                    "2020-01-01,AA,2,3.5\n"
+                    "2020-01-01,BB,5,\n"
+                    "2020-01-02,AA,4,1.5\n"
+                    "2020-01-03,BB,,4.5\n",
+                    export_csv(output, schema=pipeline.schema),
+                )
+
+                # Writing the blocks one at a time produces the same table
+                output_blocks = pipeline.combine_files(intermediate_files, block_size)
+                pipeline._export_output(output_blocks, workdir / "output.csv")
+                self.assertEqual(
+                    export_csv(output, schema=pipeline.schema),
+                    (workdir / "output.csv").read_text(),
+                )
+
+    def test_run_output_path(self):
+        with temporary_directory() as workdir:
+            os.environ[AUXILIARY_CACHE_ENV] = str(workdir / "cache")
+            metadata_path = workdir / "metadata.csv"
+            metadata_path.write_text(METADATA_CSV)
+            snapshot_path = workdir / "snapshot.csv"
+            snapshot_path.write_text("key,value\nAA_1,2\nAA,1\n")
+            (workdir / "intermediate").mkdir()
+
+            data_source = SnapshotDataSource({"snapshot": str(snapshot_path)})
+            pipeline = _dummy_pipeline(metadata_path, data_sources=[data_source])
+            output_path = workdir / "output.csv"
+
+            # Without verification, the output is only written to disk
+            run_opts = dict(process_count=1, output_path=output_path)
+            self.assertIsNone(pipeline.run(workdir, verify_level=None, **run_opts))
+            self.assertEqual("key,value\nAA,1\nAA_1,2\n", output_path.read_text())
+
+            # With verification, the output is also returned
+            output_path.unlink()
+            output = pipeline.run(workdir, verify_level="simple", **run_opts)
+            self.assertListEqual(["AA", "AA_1"], output["key"].tolist())
+            self.assertEqual("key,value\nAA,1\nAA_1,2\n", output_path.read_text())
+
+if __name__ == "__main__":
+    sys.exit(main())
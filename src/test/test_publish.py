@@ -20,13 +20,16 @@ from unittest import main
 from pandas import DataFrame
 from lib.constants import OUTPUT_COLUMN_ADAPTER, SRC, V3_TABLE_LIST
 from lib.io import read_table, read_lines, temporary_directory
-from lib.memory_efficient import get_table_columns
+from lib.memory_efficient import get_table_columns, table_read_column
 from lib.pipeline_tools import get_pipelines, get_schema
 from lib.publish import (
     copy_tables,
     convert_tables_to_json,
     publish_global_tables,
     merge_output_tables,
+    publish_location_aggregates,
+    publish_location_aggregates_from_tables,
+    publish_location_breakouts,
 )
 
 from .profiled_test_case import ProfiledTestCase
@@ -127,6 +130,78 @@ class TestPublish(ProfiledTestCase):
 
             self._test_make_main_table_helper(main_table_path, OUTPUT_COLUMN_ADAPTER)
 
+    def test_make_main_table_unsorted_tables(self):
+        with temporary_directory() as workdir:
+            (workdir / "index.csv").write_text("key,name\nBB,B\nAA,A\n")
+            (workdir / "demographics.csv").write_text("key,population\nBB,2\nAA,1\nBB,3\n")
+            (workdir / "epidemiology.csv").write_text(
+                "date,key,new_confirmed\n"
+                "2020-01-02,BB,5\n"
+                "2020-01-01,AA,1\n"
+                "2020-01-01,BB,4\n"
+                "2020-01-01,AA,2\n"
+                "2020-01-02,CC,6\n"
+            )
+
+            main_table_path = workdir / "main.csv"
+            merge_output_tables(workdir, main_table_path)
+
+            # Keys are sorted, every date is present and the last duplicate record is used
+            lines = [line.strip() for line in read_lines(main_table_path)]
+            self.assertEqual("key,date,name,new_confirmed,population", lines[0])
+            self.assertEqual("AA,2020-01-01,A,2,1", lines[1])
+            self.assertEqual("AA,2020-01-02,A,,1", lines[2])
+            location_offset = len(lines) // 2 + 1
+            self.assertEqual("BB,2020-01-01,B,4,3", lines[location_offset])
+            self.assertEqual("BB,2020-01-02,B,5,3", lines[location_offset + 1])
+            self.assertEqual("BB", lines[-1].split(",")[0])
+
+    def test_publish_location_aggregates(self):
+        with temporary_directory() as workdir:
+            tables_folder = workdir / "tables"
+            tables_folder.mkdir()
+            publish_global_tables(
+                SRC / "test" / "data", tables_folder, V3_TABLE_LIST, OUTPUT_COLUMN_ADAPTER
+            )
+            location_keys = list(table_read_column(tables_folder / "index.csv", "location_key"))
+
+            outputs = {}
+            for mode in ("serial", "parallel", "streaming", "streaming_parallel"):
+                output_folder = workdir / mode
+                output_folder.mkdir()
+                if mode.startswith("streaming"):
+                    publish_location_aggregates_from_tables(
+                        tables_folder,
+                        output_folder,
+                        location_keys,
+                        use_table_names=V3_TABLE_LIST,
+                        process_count=1 if mode == "streaming" else 3,
+                    )
+                else:
+                    process_count = 1 if mode == "serial" else 2
+                    breakout_folder = workdir / f"{mode}_breakout"
+                    publish_location_breakouts(
+                        tables_folder,
+                        breakout_folder,
+                        use_table_names=V3_TABLE_LIST,
+                        process_count=process_count,
+                    )
+                    publish_location_aggregates(
+                        breakout_folder,
+                        output_folder,
+                        location_keys,
+                        use_table_names=V3_TABLE_LIST,
+                        process_count=process_count,
+                        chunk_size=3,
+                    )
+                outputs[mode] = {path.name: path.read_text() for path in output_folder.iterdir()}
+
+            # All modes must produce the same aggregated table for every location key
+            self.assertEqual(len(set(location_keys)), len(outputs["serial"]))
+            self.assertDictEqual(outputs["serial"], outputs["parallel"])
+            self.assertDictEqual(outputs["serial"], outputs["streaming"])
+            self.assertDictEqual(outputs["serial"], outputs["streaming_parallel"])
+
     def test_convert_to_json(self):
         with temporary_directory() as workdir:
 
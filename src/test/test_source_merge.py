@@ -17,6 +17,8 @@ from unittest import main
 
 from pandas import DataFrame
 from lib.data_source import DataSource
+from lib.io import fuzzy_text_series
+from lib.key_resolver import KeyResolver
 from .profiled_test_case import ProfiledTestCase
 
 # Synthetic data used for testing
@@ -165,6 +167,36 @@ TEST_AUX_DATA = DataFrame.from_records(
 TEST_METADATA_KEYS = set(TEST_AUX_DATA["key"].values)
 
 
+def _named_metadata() -> DataFrame:
+    """ Metadata with names, match strings and regexes, plus the fuzzy columns of the pipeline """
+    columns = ["country", "subregion1", "subregion2", "locality"]
+    records = [
+        ("XX", None, None, None, None, "Country"),
+        ("XX", "N", None, None, None, "North Province"),
+        ("XX", "S", None, None, "south.*", "Southern Region"),
+        ("XX", "E", None, None, "(e)a\\1st.*", "Eastern Region"),
+        ("XX", "W", None, None, "w(est|estern)$", "Western Region"),
+        ("XX", "N", "01", None, "capital", "San José"),
+        ("XX", "N", "02", None, None, "Saint Mary"),
+        ("XX", "N", "02", "L1", None, "Old Town"),
+    ]
+    metadata = []
+    for country, subregion1, subregion2, locality, match_string, name in records:
+        codes = [country, subregion1, subregion2, locality]
+        level = max(idx for idx, code in enumerate(codes) if code is not None)
+        record = {"key": "_".join(code for code in codes if code is not None)}
+        for idx, prefix in enumerate(columns):
+            record[f"{prefix}_code"] = codes[idx]
+            record[f"{prefix}_name"] = name if idx == level else None
+        record["match_string"] = match_string
+        metadata.append(record)
+
+    metadata = DataFrame.from_records(metadata)
+    for column in ("match_string", "subregion1_name", "subregion2_name", "locality_name"):
+        metadata[f"{column}_fuzzy"] = fuzzy_text_series(metadata[column])
+    return metadata
+
+
 class TestSourceMerge(ProfiledTestCase):
     def test_merge_no_match(self):
         aux = TEST_AUX_DATA.copy()
@@ -237,6 +269,107 @@ class TestSourceMerge(ProfiledTestCase):
         key = data_source.merge(record, {"metadata": aux}, keys=TEST_METADATA_KEYS)
         self.assertEqual(key, "AD_1_1")
 
+    def test_resolver_same_as_merge(self):
+        aux = TEST_AUX_DATA.copy()
+        data_source = DataSource()
+        resolver = KeyResolver(aux)
+
+        records = [
+            {"country_code": "__"},
+            {"key": "AE_1_2"},
+            {"key": "AE_1_9"},
+            {"country_code": "AA"},
+            {"country_code": "AB"},
+            {"country_code": "AB", "subregion1_code": None},
+            {"country_code": "AB", "subregion1_code": "1"},
+            {"country_code": "AD", "subregion1_code": None},
+            {"country_code": "AD", "subregion1_code": ""},
+            {"country_code": "AD", "subregion1_code": "1"},
+            {"country_code": "AD", "subregion1_code": None, "subregion2_code": "1"},
+            {"country_code": "AD", "subregion1_code": "1", "subregion2_code": "1"},
+            {"country_code": "AD", "subregion1_code": "", "subregion2_code": "1"},
+            {"country_code": "AE", "subregion1_code": "1", "subregion2_code": "5"},
+        ]
+        for record in records:
+            expected = data_source.merge(record, {"metadata": aux}, keys=TEST_METADATA_KEYS)
+            self.assertEqual(resolver.lookup(record), expected, record)
+
+    def test_resolver_batch(self):
+        aux = TEST_AUX_DATA.copy()
+        resolver = KeyResolver(aux)
+
+        data = DataFrame.from_records(
+            [
+                {"country_code": "AE", "subregion1_code": "1", "subregion2_code": "1"},
+                {"country_code": "AE", "subregion1_code": "1", "subregion2_code": "2"},
+                {"country_code": "AE", "subregion1_code": "1", "subregion2_code": "1"},
+                {"country_code": "AE", "subregion1_code": "1", "subregion2_code": "9"},
+                {"country_code": "AC", "subregion1_code": "3", "subregion2_code": None},
+            ]
+        )
+        keys, unmatched = resolver.resolve(data)
+        self.assertListEqual(keys.tolist(), ["AE_1_1", "AE_1_2", "AE_1_1", None, "AC_3"])
+        self.assertListEqual(unmatched.index.tolist(), [3])
+
+    def _assert_resolver_same_as_merge(self, metadata, records):
+        data_source = DataSource()
+        resolver = KeyResolver(metadata)
+        keys = set(metadata["key"].values)
+        expected = [data_source.merge(record, {"metadata": metadata}, keys) for record in records]
+        for record, key in zip(records, expected):
+            self.assertEqual(resolver.lookup(record), key, record)
+
+        # Resolving a table gives the same keys as merging each of its rows, where columns missing
+        # from a record are null instead of absent
+        data = DataFrame.from_records(records)
+        aux = {"metadata": metadata}
+        expected = [data_source.merge(row, aux, keys) for _, row in data.iterrows()]
+        actual, _ = resolver.resolve(data)
+        self.assertListEqual(actual.tolist(), expected)
+
+    def test_resolver_same_as_merge_match_string(self):
+        records = [
+            {"country_code": "XX", "match_string": "capital"},
+            {"country_code": "XX", "match_string": "CAPITAL"},
+            {"country_code": "XX", "match_string": "N"},
+            {"country_code": "XX", "match_string": "01"},
+            {"country_code": "XX", "match_string": "L1"},
+            {"country_code": "XX", "match_string": "unknown"},
+            {"country_code": "XX", "subregion1_code": "N", "match_string": "02"},
+        ]
+        self._assert_resolver_same_as_merge(_named_metadata(), records)
+
+    def test_resolver_same_as_merge_fuzzy_name(self):
+        records = [
+            {"country_code": "XX", "match_string": "north province"},
+            {"country_code": "XX", "match_string": "San Jose"},
+            {"country_code": "XX", "match_string": "SAN-JOSÉ"},
+            {"country_code": "XX", "match_string": "St. Mary"},
+            {"country_code": "XX", "match_string": "Old  Town"},
+            {"country_code": "XX", "subregion1_code": "N", "match_string": "saint mary"},
+            {"country_code": "XX", "subregion1_name": "North Province"},
+        ]
+        self._assert_resolver_same_as_merge(_named_metadata(), records)
+
+    def test_resolver_same_as_merge_regex(self):
+        records = [
+            {"country_code": "XX", "match_string": "South"},
+            {"country_code": "XX", "match_string": "southwest"},
+            {"country_code": "XX", "match_string": "eaest"},
+            {"country_code": "XX", "match_string": "EAEST side"},
+            {"country_code": "XX", "match_string": "east"},
+            {"country_code": "XX", "match_string": "western"},
+            {"country_code": "XX", "match_string": "west"},
+            {"country_code": "XX", "match_string": "westerly"},
+        ]
+        self._assert_resolver_same_as_merge(_named_metadata(), records)
+
+    def test_resolver_no_match_columns(self):
+        resolver = KeyResolver(_named_metadata())
+        keys, unmatched = resolver.resolve(DataFrame({"date": ["2020-01-01", "2020-01-02"]}))
+        self.assertListEqual(keys.tolist(), [None, None])
+        self.assertListEqual(unmatched.index.tolist(), [0, 1])
+
 
 if __name__ == "__main__":
     sys.exit(main())
@@ -14,17 +14,22 @@
 
 import sys
 from io import StringIO
+from typing import List
 from unittest import main
 
 import numpy
-from pandas import DataFrame, isnull
+from pandas import DataFrame, date_range, isnull
 from lib.constants import SRC
 from lib.io import read_file
 from lib.utils import (
     combine_tables,
     derive_localities,
+    grouped_cumsum,
+    grouped_diff,
+    grouped_transform,
     infer_new_and_total,
     stack_table,
+    stratify_age_sex_ethnicity,
     backfill_cumulative_fields_inplace,
 )
 from .profiled_test_case import ProfiledTestCase
@@ -192,6 +197,57 @@ class TestTableUtils(ProfiledTestCase):
         self.assertEqual(2, result.loc[0, "value_column_1"])
         self.assertEqual(1, result.loc[0, "value_column_2"])
 
+    def test_combine_engines_equal(self):
+        data = read_file(SRC / "test" / "data" / "epidemiology.csv")
+        data = data[data["date"] < "2020-06-01"]
+
+        # Split the data into overlapping tables with missing values
+        rng = numpy.random.default_rng(0)
+        tables = []
+        for _ in range(3):
+            table = data.sample(frac=0.5, random_state=rng.integers(1000)).copy()
+            for col in table.columns[2:]:
+                table.loc[rng.random(len(table)) < 0.3, col] = None
+            tables.append(table)
+        tables.append(DataFrame.from_records([{"date": "2020-01-01", "key": None}]))
+
+        result_python = combine_tables(tables, ["date", "key"], engine="python")
+        result_numpy = combine_tables(tables, ["date", "key"], engine="numpy")
+        self.assertTrue(result_python.equals(result_numpy))
+
+    def test_grouped_diff_and_cumsum_equal_transform(self):
+        data = read_file(SRC / "test" / "data" / "epidemiology.csv")
+        data = data[["date", "key", "new_confirmed", "total_confirmed", "total_deceased"]]
+
+        # Shuffle the records and add missing values, including records without any values
+        rng = numpy.random.default_rng(0)
+        data = data.sample(frac=1, random_state=0).copy()
+        data["total_deceased"] = data["total_deceased"].fillna(0).astype(int)
+        data["total_recovered"] = rng.normal(1000, 500, len(data))
+        data["total_label"] = "label"
+        for col in ("new_confirmed", "total_confirmed", "total_recovered"):
+            data.loc[rng.random(len(data)) < 0.3, col] = None
+        data.loc[data.index[:10], ["new_confirmed", "total_confirmed", "total_recovered"]] = None
+
+        keys = ["key", "date"]
+        for function, transform in [
+            (grouped_diff, lambda x: x.ffill().diff()),
+            (grouped_cumsum, lambda x: x.fillna(0).cumsum()),
+        ]:
+            # Columns which cannot be transformed must be skipped
+            prefix = ("new_", "total_") if function == grouped_diff else ("total_", "new_")
+            for skip in (None, ["total_label"]):
+                table = data if skip else data.drop(columns=["total_label"])
+                expected = grouped_transform(table, keys, transform, skip=skip, prefix=prefix)
+                result = function(table, keys, skip=skip)
+                self.assertTrue(expected.equals(result))
+
+            # Records with null keys are not part of any group
+            null_key = DataFrame.from_records([{"key": None, "date": "2020-01-01", "total_x": 1}])
+            for table in (data[keys + ["total_confirmed"]].iloc[:0], null_key):
+                expected = grouped_transform(table, keys, transform, prefix=prefix)
+                self.assertTrue(expected.equals(function(table, keys)))
+
     def test_stack_data(self):
         expected = DataFrame.from_records(
             [
@@ -210,6 +266,68 @@ class TestTableUtils(ProfiledTestCase):
 
         self.assertEqual(buffer1.getvalue(), buffer2.getvalue())
 
+    def test_stack_data_many_columns(self):
+        data = DataFrame.from_records(
+            [
+                {"idx": 0, "sex": "male", "age": "0-9", "val_1": 1, "val_2": 1.5},
+                {"idx": 0, "sex": "female", "age": "0-9", "val_1": 2, "val_2": None},
+                {"idx": 0, "sex": "male", "age": "10-19", "val_1": 3, "val_2": 2.5},
+                {"idx": 1, "sex": None, "age": "10-19", "val_1": 4, "val_2": 3.5},
+                {"idx": 2, "sex": "female", "age": None, "val_1": 5, "val_2": 4.5},
+            ]
+        )
+        nan = numpy.nan
+        expected = DataFrame(
+            {
+                "idx": [0, 1, 2],
+                "val_1": [6, 4, 5],
+                "val_2": [4.0, 3.5, 4.5],
+                "val_1_male": [4, nan, nan],
+                "val_1_female": [2, nan, 5],
+                "val_2_male": [4.0, nan, nan],
+                "val_2_female": [0.0, nan, 4.5],
+                "val_1_0-9": [3, nan, nan],
+                "val_1_10-19": [3, 4, nan],
+                "val_2_0-9": [1.5, nan, nan],
+                "val_2_10-19": [2.5, 3.5, nan],
+            }
+        )
+
+        output = stack_table(
+            data,
+            index_columns=["idx"],
+            value_columns=["val_1", "val_2"],
+            stack_columns=["sex", "age"],
+        )
+        self.assertEqual(list(output.columns), list(expected.columns))
+        self.assertTrue(output.astype(float).equals(expected.astype(float)))
+
+    def test_stratify_age_sex_ethnicity(self):
+        data = DataFrame.from_records(
+            [
+                {"key": "A", "age": "0-9", "sex": "male", "new_confirmed": 1},
+                {"key": "A", "age": "95-99", "sex": "female", "new_confirmed": 2},
+                {"key": "A", "age": "100-104", "sex": "female", "new_confirmed": 3},
+                {"key": "A", "age": "unknown", "sex": "male", "new_confirmed": 4},
+                {"key": "B", "age": "20-29", "sex": "male", "new_confirmed": 5},
+            ]
+        )
+        output = stratify_age_sex_ethnicity(data).set_index("key")
+
+        # Buckets over 90 are compressed, and unknown ages are not part of the numbered buckets
+        self.assertEqual(output.loc["A", "new_confirmed"], 10)
+        self.assertEqual(output.loc["A", "new_confirmed_male"], 5)
+        self.assertEqual(output.loc["A", "new_confirmed_female"], 5)
+        self.assertEqual(output.loc["A", "new_confirmed_age_00"], 1)
+        self.assertTrue(isnull(output.loc["A", "new_confirmed_age_01"]))
+        self.assertEqual(output.loc["A", "new_confirmed_age_02"], 5)
+        self.assertEqual(output.loc["B", "new_confirmed_age_01"], 5)
+        self.assertEqual(output.loc["A", "age_bin_00"], "0-9")
+        self.assertEqual(output.loc["A", "age_bin_01"], "20-29")
+        self.assertEqual(output.loc["A", "age_bin_02"], "90-")
+        self.assertEqual(output.loc["A", "new_confirmed_age_unknown"], 4)
+        self.assertNotIn("age_bin_03", output.columns)
+
     def test_infer_nothing(self):
 
         # Ensure that no columns are added when both new_* and total_* are present
@@ -374,6 +492,43 @@ class TestTableUtils(ProfiledTestCase):
 
         self.assertTrue(test_data.equals(expected))
 
+    def test_backfill_cumulative_fields_inplace_many_keys(self):
+        def _backfill_reference(data: DataFrame, columns: List[str]):
+            """ Original implementation which backfills each key and column separately """
+            for name, group_data in data.groupby(["key"]):
+                group_data = group_data.sort_values(by="date", ascending=False)
+                for column in columns:
+                    if isnull(group_data.loc[group_data.last_valid_index(), column]):
+                        group_data.loc[group_data.last_valid_index(), column] = 0
+                    data.loc[data["key"] == name, column] = group_data[column].bfill()
+
+        # Build records for hundreds of keys, each with a different number of dates
+        rng = numpy.random.default_rng(0)
+        dates = date_range("2020-01-01", periods=20).strftime("%Y-%m-%d").values
+        records = DataFrame(
+            [
+                {"key": f"K{key_idx:04d}", "date": date}
+                for key_idx in range(500)
+                for date in dates[: rng.integers(1, len(dates))]
+            ]
+        )
+        records["total_confirmed"] = rng.integers(0, 1000, len(records)).astype(float)
+        records["total_deceased"] = rng.integers(0, 100, len(records)).astype(float)
+        records["total_recovered"] = numpy.nan
+        records["extra_col"] = "check"
+        for col in ("total_confirmed", "total_deceased"):
+            records.loc[rng.random(len(records)) < 0.4, col] = numpy.nan
+
+        # Shuffle the records and use an index which is not a range
+        records = records.sample(frac=1, random_state=0)
+        records.index = records.index * 2 + 1
+
+        columns = ["total_confirmed", "total_deceased", "total_recovered"]
+        expected = records.copy()
+        _backfill_reference(expected, columns)
+        backfill_cumulative_fields_inplace(records)
+        self.assertTrue(records.equals(expected))
+
     def test_backfill_cumulative_fields_inplace_no_total_column(self):
         test_data = BACKFILL_TEST_DATA.copy().rename(columns={"total_deceased": "val"})
         expected = test_data.copy()
@@ -382,7 +537,6 @@ class TestTableUtils(ProfiledTestCase):
         self.assertTrue(test_data.equals(expected))
 
     # TODO: Add test for complex infer example (e.g. missing values)
-    # TODO: Add test for stratify_age_sex_ethnicity
 
 
 if __name__ == "__main__":
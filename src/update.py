@@ -35,6 +35,7 @@ def main(
     strict_match: bool = False,
     process_count: int = cpu_count(),
     skip_download: bool = False,
+    incremental: bool = False,
 ) -> None:
     """
     Executes the data pipelines and places all outputs into `output_folder`. This is typically
@@ -52,6 +53,7 @@ def main(
         strict_match: In combination with `location_key`, filter data to only output `location_key`.
         process_count: Maximum number of processes to use during the data pipeline execution.
         skip_download: Skip downloading data sources if a cached version is available.
+        incremental: Skip running data sources whose inputs have not changed since the last run.
     """
 
     assert not (
@@ -101,24 +103,23 @@ def main(
                 if any(re.match(expr_, location_key) for expr_ in expr)
             ]
 
-        # Run the data pipeline to retrieve live data
+        # Run the data pipeline to retrieve live data, which is exported to disk as a CSV file
+        # directly unless it needs to be filtered first
+        table_path = output_folder / "tables" / f"{table_name}.csv"
+        strict_filter = location_key is not None and strict_match
         pipeline_output = data_pipeline.run(
             output_folder,
             process_count=process_count,
             verify_level=verify,
             skip_existing=skip_download,
+            incremental=incremental,
+            output_path=None if strict_filter else table_path,
         )
 
         # Filter out data output if requested
-        if location_key is not None and strict_match:
+        if strict_filter:
             pipeline_output = pipeline_output[pipeline_output["key"] == location_key]
-
-        # Export the data output to disk as a CSV file
-        export_csv(
-            pipeline_output,
-            output_folder / "tables" / f"{table_name}.csv",
-            schema=data_pipeline.schema,
-        )
+            export_csv(pipeline_output, table_path, schema=data_pipeline.schema)
 
 
 if __name__ == "__main__":
@@ -130,6 +131,7 @@ if __name__ == "__main__":
     argparser.add_argument("--location-key", type=str, default=None)
     argparser.add_argument("--strict-match", action="store_true")
     argparser.add_argument("--skip-download", action="store_true")
+    argparser.add_argument("--incremental", action="store_true")
     argparser.add_argument("--verify", type=str, default=None)
     argparser.add_argument("--profile", action="store_true")
     argparser.add_argument("--process-count", type=int, default=cpu_count())
@@ -152,6 +154,7 @@ if __name__ == "__main__":
         strict_match=args.strict_match,
         process_count=args.process_count,
         skip_download=args.skip_download,
+        incremental=args.incremental,
     )
 
     if args.profile: